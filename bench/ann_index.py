@@ -0,0 +1,73 @@
+"""
+Recall@10 and latency of the disk-backed IVFIndex at several probe counts, against exact brute force.
+
+    python bench/ann_index.py --rows 200000 --dim 384
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from llmchat.ann_index import IVFIndex
+from llmchat.embedding_index import normalize
+from llmchat.logger import logger
+
+logger.setLevel(logging.WARNING)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    # embeddings of real conversations are clustered by topic, uniform noise would be a worst case for any IVF
+    centers = rng.standard_normal((args.rows // 500 or 1, args.dim))
+    vectors = (centers[rng.integers(len(centers), size=args.rows)] + 1.0 * rng.standard_normal((args.rows, args.dim))).astype(np.float32)
+    queries = vectors[rng.choice(args.rows, args.queries, replace=False)] + 0.3 * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+    unit = normalize(vectors)
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = IVFIndex(os.path.join(directory, "ann"), compact_threshold=10 ** 9)
+        index.open(5, args.dim)
+        started = time.perf_counter()
+        for start in range(0, args.rows, 10000):
+            end = min(start + 10000, args.rows)
+            index.add_batch(5, np.arange(start + 1, end + 1), np.arange(start + 1, end + 1), vectors[start:end])
+        index.close()
+        index.compact(5)
+        partition = index._partitions[5]
+        print(f"{args.rows} rows of {args.dim} dims, added and compacted into {len(partition.centroids)} lists "
+              f"in {time.perf_counter() - started:.1f}s")
+
+        timings, exact = [], []
+        for query in queries:
+            started = time.perf_counter()
+            similarities = unit @ normalize(query)
+            exact.append(set(np.argpartition(-similarities, args.k)[:args.k] + 1))
+            timings.append(time.perf_counter() - started)
+        brute = np.median(timings) * 1000
+
+        for probes in (1, 4, 8, 32):
+            index.probes = probes
+            timings, recall = [], []
+            for query, expected in zip(queries, exact):
+                started = time.perf_counter()
+                found = index.search(5, query, limit=args.k)
+                timings.append(time.perf_counter() - started)
+                recall.append(len(expected & {r for r, _ in found}) / args.k)
+            print(f"  probes={probes:<3d} recall@{args.k} {np.mean(recall):.3f}  median {np.median(timings) * 1000:6.2f} ms")
+        print(f"  brute force                 median {brute:6.2f} ms")
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Per turn cost of building a channel's context, the ContextAssembler against rendering and counting the whole
+window again every turn as the context builders used to.
+
+    python bench/context.py --windows 50 200 1000 5000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from llmchat.context_assembler import ContextAssembler
+from llmchat.logger import logger
+
+logger.setLevel(logging.WARNING)
+
+BOT = 999
+WORDS = "the quick brown fox jumps over lazy dog while server latency matters more than throughput for chat".split()
+
+
+class Identities:
+    generation = 0
+
+    def changed_since(self, generation: int) -> set[int]:
+        return set()
+
+    async def get_names(self, ids):
+        return {i: f"user{i}" for i in ids}
+
+
+def render(author_id: int, content: str, name: str) -> str:
+    return f"{name or 'Bot'}: {content}\n"
+
+
+def count(entries: list[str]) -> list[int]:
+    # the same estimate as sources without a tokenizer
+    return [len(e) // 4 + 1 for e in entries]
+
+
+def message(i: int) -> tuple[int, str, int]:
+    return (random.randrange(20) if i % 3 else BOT, " ".join(random.choices(WORDS, k=random.randint(5, 40))), 10 ** 6 + i)
+
+
+async def naive(client, rows: list, budget: int) -> list[str]:
+    names = await client.identities.get_names(r[0] for r in rows if r[0] != BOT)
+    entries = [render(author_id, content, names.get(author_id)) for author_id, content, _ in rows]
+    packed, used = [], 0
+    for entry, tokens in zip(reversed(entries), reversed(count(entries))):
+        if used + tokens > budget:
+            break
+        packed.append(entry)
+        used += tokens
+    packed.reverse()
+    return packed
+
+
+async def turns(build, window: int, count_turns: int) -> tuple[float, list]:
+    random.seed(1)
+    history = [message(i) for i in range(window)]
+    await build(history[-window:])
+    timings = []
+    for turn in range(count_turns):
+        history.append(message(window + turn))
+        started = time.perf_counter()
+        result = await build(history[-window:])
+        timings.append(time.perf_counter() - started)
+    return np.median(timings), result
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--windows", type=int, nargs="+", default=[50, 200, 1000, 5000])
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--budget", type=int, default=8000)
+    args = parser.parse_args()
+
+    client = SimpleNamespace(user=SimpleNamespace(id=BOT), identities=Identities())
+    for window in args.windows:
+        assembler = ContextAssembler(client, render, count)
+        incremental, packed = await turns(lambda rows: assembler.pack(5, rows, [], args.budget), window, args.turns)
+        full, expected = await turns(lambda rows: naive(client, rows, args.budget), window, args.turns)
+        assert packed[1] == expected
+        print(f"window {window:5d}: assembler {incremental * 1e6:8.0f} us/turn  full re-render {full * 1e6:8.0f} us/turn"
+              f"  ({len(expected)} messages packed)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,73 @@
+"""
+Similarity recall over one channel, the in-memory EmbeddingIndex against the per-row scan it replaced.
+
+    python bench/embedding_index.py --rows 100000 --dim 1536
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from llmchat.logger import logger
+from llmchat.persistence import EMBEDDING_DTYPE, PersistentData
+
+logger.setLevel(logging.WARNING)
+
+
+def scan(db: PersistentData, embedding: np.ndarray, limit: int) -> list:
+    # the old get_most_similar: every row of the table read and compared one at a time
+    query = embedding / np.linalg.norm(embedding)
+    scored = []
+    for author_id, content, message_id, blob in db.cursor.execute(
+            "SELECT author_id, content, message_id, embedding FROM message_embeddings"):
+        vector = np.frombuffer(blob, dtype=EMBEDDING_DTYPE)
+        scored.append(((author_id, content, message_id), float(vector @ query / np.linalg.norm(vector))))
+    scored.sort(key=lambda m: m[1], reverse=True)
+    return scored[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        db = PersistentData(None, os.path.join(directory, "persistent.db"), write_batch_size=10000)
+        for start in range(0, args.rows, 5000):
+            count = min(5000, args.rows - start)
+            vectors = rng.standard_normal((count, args.dim)).astype(np.float32)
+            db.add_embeddings([((1, f"message {start + i}", start + i + 1), vectors[i], 5) for i in range(count)])
+        db.flush()
+        queries = rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+
+        started = time.perf_counter()
+        db.load_embedding_index(5, args.dim)
+        print(f"{args.rows} rows of {args.dim} dims, first load {time.perf_counter() - started:.2f}s")
+
+        timings = []
+        for query in queries:
+            started = time.perf_counter()
+            db.get_most_similar(query, 0.0, 5, 5)
+            timings.append(time.perf_counter() - started)
+        print(f"  index  median {np.median(timings) * 1000:8.2f} ms  p95 {np.percentile(timings, 95) * 1000:8.2f} ms")
+
+        timings = []
+        for query in queries[:5]:
+            started = time.perf_counter()
+            expected = scan(db, query, 5)
+            timings.append(time.perf_counter() - started)
+        assert [m for m, _ in db.get_most_similar(queries[4], 0.0, 5, 5)] == [m for m, _ in expected]
+        print(f"  scan   median {np.median(timings) * 1000:8.2f} ms")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Embedding, keyword and hybrid recall over one channel: how often the message a query refers to by name is in the
+top 5, and how long a search takes. The stand-in embeddings only encode which of 50 buckets a name falls into, the
+way a real embedding model blurs rare names and numbers.
+
+    python bench/recall.py --messages 100000
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from llmchat.logger import logger
+from llmchat.persistence import PersistentData
+
+logger.setLevel(logging.WARNING)
+
+VOCABULARY = 5000
+DIM = 384
+NAME_BUCKETS = 50
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    vocabulary = [f"w{i}" for i in range(VOCABULARY)]
+    zipf = 1 / np.arange(1, VOCABULARY + 1)
+    zipf /= zipf.sum()
+    word_vectors = rng.standard_normal((VOCABULARY, DIM)).astype(np.float32)
+    name_vectors = rng.standard_normal((NAME_BUCKETS, DIM)).astype(np.float32)
+
+    def embed(words, names):
+        vector = word_vectors[words].mean(axis=0)
+        for name in names:
+            vector = vector + name_vectors[int(name[2:-1]) // 100 % NAME_BUCKETS] * 0.5
+        return vector
+
+    channel = SimpleNamespace(id=5, guild=SimpleNamespace(id=1))
+    with tempfile.TemporaryDirectory() as directory:
+        db = PersistentData(None, os.path.join(directory, "persistent.db"), write_batch_size=1000)
+        # one in a hundred messages mentions a name nothing else does
+        targets = {}
+        started = time.perf_counter()
+        for i in range(args.messages):
+            words = list(rng.choice(VOCABULARY, 12, p=zipf))
+            names = []
+            if i % 100 == 0:
+                names = [f"zq{i}x"]
+                targets[names[0]] = i + 1
+            content = " ".join([vocabulary[w] for w in words] + names)
+            db._insert_history(7, content, i + 1, channel)
+            db.add_embedding((7, content, i + 1), embed(words, names), channel_id=channel.id)
+        db.flush()
+        print(f"{args.messages} messages stored in {time.perf_counter() - started:.1f}s")
+
+        queries = []
+        for name, message_id in list(targets.items())[:args.queries]:
+            words = list(rng.choice(VOCABULARY, 10, p=zipf))
+            queries.append((" ".join([vocabulary[w] for w in words] + [name]), embed(words, [name]), message_id))
+        db.get_most_similar(queries[0][1], channel_id=channel.id, limit=5)
+
+        for label, search in (("embedding", lambda text, embedding: db.get_most_similar(embedding, 0.0, channel.id, 5)),
+                              ("keyword", lambda text, embedding: db.search_text(text, channel.id, 5)),
+                              ("hybrid", lambda text, embedding: db.search_hybrid(text, embedding, 0.0, channel.id, 5))):
+            hits, timings = 0, []
+            for text, embedding, message_id in queries:
+                started = time.perf_counter()
+                found = search(text, embedding)
+                timings.append(time.perf_counter() - started)
+                hits += any(m[2] == message_id for m, _ in found)
+            print(f"  {label:<9s} hit@5 {hits / len(queries):.3f}  median {np.median(timings) * 1000:6.2f} ms  "
+                  f"p95 {np.percentile(timings, 95) * 1000:6.2f} ms")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+import json
+import os
+import shutil
+import threading
+import numpy as np
+from llmchat.embedding_index import normalize, top_matches
+from llmchat.logger import logger
+
+# below this many live vectors a channel isn't clustered, its rows are searched exhaustively
+MIN_TRAIN_ROWS = 2048
+KMEANS_ITERATIONS = 8
+KMEANS_SAMPLES_PER_LIST = 32
+CHUNK_ROWS = 8192
+
+
+def _train_centroids(vectors: np.ndarray, lists: int, seed: int = 0) -> np.ndarray:
+    """
+    Spherical k-means: centroids are kept unit length so assignment is the highest dot product.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), lists, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        empty = ~sums.any(axis=1)
+        # re-seed empty lists so no probe is wasted on them
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = normalize(sums)
+    return centroids
+
+
+class _Partition:
+    """
+    The on-disk IVF index of one channel. Everything lives in flat files that are memory-mapped per search:
+
+    - base: vectors sorted by inverted list, `offsets[l]:offsets[l + 1]` is list l. Rewritten by compaction.
+    - delta: vectors appended since the last compaction along with the list each was assigned to.
+    - tombstones: rowids deleted since the last compaction.
+
+    Files carry the generation that wrote them, compaction builds the next generation next to the current
+    one and switches over by rewriting meta.json.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.compacting = False
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.dim = meta["dim"]
+        self.generation = meta["generation"]
+        self.base_count = meta["base_count"]
+        self.trained_count = meta["trained_count"]
+        self.centroids = self._load_npy("centroids")
+        self.offsets = self._load_npy("offsets")
+        self.tombstones = np.fromfile(self._file("tombstones.ids"), dtype=np.int64) if os.path.exists(self._file("tombstones.ids")) else np.empty(0, dtype=np.int64)
+        self.delta_count = self._delta_rows_on_disk()
+        self.max_rowid = max(self._max_rowid("base", self.base_count), self._max_rowid("delta", self.delta_count))
+        self._remove_stale_generations()
+
+    @staticmethod
+    def create(path: str, dim: int) -> "_Partition":
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        _Partition._write_meta(path, {"dim": dim, "generation": 0, "base_count": 0, "trained_count": 0})
+        return _Partition(path)
+
+    @staticmethod
+    def _write_meta(path: str, meta: dict):
+        tmp = os.path.join(path, "meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(path, "meta.json"))
+
+    def _file(self, name: str, generation: int = None) -> str:
+        return os.path.join(self.path, f"{self.generation if generation is None else generation}-{name}")
+
+    def _load_npy(self, name: str):
+        path = self._file(name + ".npy")
+        return np.load(path) if os.path.exists(path) else None
+
+    def _delta_rows_on_disk(self) -> int:
+        sizes = [
+            os.path.getsize(self._file(name)) // itemsize if os.path.exists(self._file(name)) else 0
+            for name, itemsize in (("delta.vec", 4 * self.dim), ("delta.ids", 16), ("delta.lists", 4))
+        ]
+        # a torn append leaves the files at different lengths, only rows present in all of them count
+        return min(sizes)
+
+    def _map(self, name: str, dtype, shape: tuple, generation: int = None):
+        if not shape[0]:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self._file(name, generation), dtype=dtype, mode="r", shape=shape)
+
+    def _max_rowid(self, segment: str, count: int) -> int:
+        if not count:
+            return 0
+        return int(self._map(f"{segment}.ids", np.int64, (count, 2))[:, 0].max())
+
+    def _remove_stale_generations(self, generation: int = None):
+        """
+        Deletes the files of `generation`, or of every generation but the current one.
+        """
+        for f in os.listdir(self.path):
+            prefix = f.split("-", 1)[0]
+            if prefix.isdigit() and (int(prefix) == generation if generation is not None else int(prefix) != self.generation):
+                try:
+                    os.remove(os.path.join(self.path, f))
+                except OSError:
+                    pass  # still mapped somewhere, retried on next open
+
+    def assign(self, vectors: np.ndarray, centroids: np.ndarray = None) -> np.ndarray:
+        centroids = self.centroids if centroids is None else centroids
+        if centroids is None:
+            return np.full(len(vectors), -1, dtype=np.int32)
+        return np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+
+    def append(self, rowids: np.ndarray, message_ids: np.ndarray, vectors: np.ndarray):
+        with self.lock:
+            self._append_delta(self.generation, rowids, message_ids, vectors, self.assign(vectors))
+            self.delta_count += len(rowids)
+            self.max_rowid = max(self.max_rowid, int(rowids.max()))
+
+    def _append_delta(self, generation: int, rowids, message_ids, vectors, lists):
+        with open(self._file("delta.vec", generation), "ab") as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with open(self._file("delta.ids", generation), "ab") as f:
+            f.write(np.stack([rowids, message_ids], axis=1).astype(np.int64).tobytes())
+        with open(self._file("delta.lists", generation), "ab") as f:
+            f.write(lists.astype(np.int32).tobytes())
+
+    def tombstone(self, rowids: list[int]):
+        rowids = np.asarray(rowids, dtype=np.int64)
+        with self.lock:
+            with open(self._file("tombstones.ids"), "ab") as f:
+                f.write(rowids.tobytes())
+            self.tombstones = np.concatenate([self.tombstones, rowids])
+
+    def search(self, embedding: np.ndarray, threshold: float, limit: int, exclude_ids: list[int], probes: int):
+        query = normalize(embedding)
+        similarities, ids = [], []
+        with self.lock:
+            lists = None
+            if self.centroids is not None:
+                lists = np.argsort(-(self.centroids @ query))[:probes]
+
+            if lists is not None and self.base_count:
+                base_vectors = self._map("base.vec", np.float32, (self.base_count, self.dim))
+                base_ids = self._map("base.ids", np.int64, (self.base_count, 2))
+                for l in lists:
+                    start, end = self.offsets[l], self.offsets[l + 1]
+                    if end > start:
+                        similarities.append(base_vectors[start:end] @ query)
+                        ids.append(np.asarray(base_ids[start:end]))
+
+            if self.delta_count:
+                delta_vectors = self._map("delta.vec", np.float32, (self.delta_count, self.dim))
+                delta_ids = self._map("delta.ids", np.int64, (self.delta_count, 2))
+                if lists is None:
+                    # not clustered yet, scan everything
+                    similarities.append(delta_vectors @ query)
+                    ids.append(np.asarray(delta_ids))
+                else:
+                    rows = np.flatnonzero(np.isin(self._map("delta.lists", np.int32, (self.delta_count,)), lists))
+                    similarities.append(delta_vectors[rows] @ query)
+                    ids.append(delta_ids[rows])
+
+            if not similarities:
+                return []
+            similarities = np.concatenate(similarities)
+            ids = np.concatenate(ids)
+            if len(self.tombstones):
+                live = ~np.isin(ids[:, 0], self.tombstones)
+                similarities, ids = similarities[live], ids[live]
+
+        return top_matches(similarities, ids[:, 0], ids[:, 1], threshold, limit, exclude_ids)
+
+    def compact(self, lists: int):
+        """
+        Folds the delta into the base, drops tombstoned rows and (re)clusters when the partition has grown enough.
+        Runs without holding the lock except for taking a snapshot and switching generations,
+        rows appended or deleted in the meantime are carried over to the new generation.
+        """
+        with self.lock:
+            if self.compacting:
+                return
+            self.compacting = True
+            generation, base_count, delta_count = self.generation, self.base_count, self.delta_count
+            tombstones, tombstone_count = self.tombstones.copy(), len(self.tombstones)
+            centroids, offsets, trained_count = self.centroids, self.offsets, self.trained_count
+
+        try:
+            base_vectors = self._map("base.vec", np.float32, (base_count, self.dim), generation)
+            base_ids = self._map("base.ids", np.int64, (base_count, 2), generation)
+            delta_vectors = self._map("delta.vec", np.float32, (delta_count, self.dim), generation)
+            delta_ids = self._map("delta.ids", np.int64, (delta_count, 2), generation)
+            delta_lists = self._map("delta.lists", np.int32, (delta_count,), generation)
+
+            # live rows as indices into base followed by delta, vectors are only gathered chunk by chunk
+            live = np.concatenate([
+                np.flatnonzero(~np.isin(base_ids[:, 0], tombstones)),
+                base_count + np.flatnonzero(~np.isin(delta_ids[:, 0], tombstones)),
+            ])
+
+            def gather(rows: np.ndarray, source_base, source_delta) -> np.ndarray:
+                from_base = rows < base_count
+                out = np.empty((len(rows),) + source_base.shape[1:], dtype=source_base.dtype)
+                out[from_base] = source_base[rows[from_base]]
+                out[~from_base] = source_delta[rows[~from_base] - base_count]
+                return out
+
+            if len(live) >= MIN_TRAIN_ROWS and (centroids is None or len(live) >= 2 * trained_count):
+                list_count = min(lists or int(np.sqrt(len(live))), len(live) // KMEANS_SAMPLES_PER_LIST)
+                sample = np.sort(np.random.default_rng(0).choice(live, min(len(live), list_count * KMEANS_SAMPLES_PER_LIST), replace=False))
+                logger.debug(f"Clustering {len(live)} embeddings into {list_count} lists")
+                centroids = _train_centroids(gather(sample, base_vectors, delta_vectors), list_count)
+                trained_count = len(live)
+                list_of = np.concatenate([
+                    self.assign(gather(live[i:i + CHUNK_ROWS], base_vectors, delta_vectors), centroids)
+                    for i in range(0, len(live), CHUNK_ROWS)
+                ]) if len(live) else np.empty(0, dtype=np.int32)
+            elif centroids is not None:
+                base_list_of = np.repeat(np.arange(len(offsets) - 1, dtype=np.int32), np.diff(offsets))
+                list_of = gather(live, base_list_of, np.asarray(delta_lists))
+            else:
+                list_of = None
+
+            next_generation = generation + 1
+            # leftovers of an earlier compaction that failed half way
+            self._remove_stale_generations(next_generation)
+            if list_of is None:
+                # too small to cluster, everything stays in the exhaustively searched delta
+                new_base_count, new_offsets = 0, None
+                for i in range(0, len(live), CHUNK_ROWS):
+                    rows = live[i:i + CHUNK_ROWS]
+                    chunk_ids = gather(rows, base_ids, delta_ids)
+                    self._append_delta(next_generation, chunk_ids[:, 0], chunk_ids[:, 1],
+                                       gather(rows, base_vectors, delta_vectors), np.full(len(rows), -1, dtype=np.int32))
+            else:
+                order = np.argsort(list_of, kind="stable")
+                new_offsets = np.searchsorted(list_of[order], np.arange(len(centroids) + 1)).astype(np.int64)
+                new_base_count = len(live)
+                with open(self._file("base.vec", next_generation), "wb") as vec_file, \
+                        open(self._file("base.ids", next_generation), "wb") as ids_file:
+                    for i in range(0, len(order), CHUNK_ROWS):
+                        rows = live[order[i:i + CHUNK_ROWS]]
+                        vec_file.write(gather(rows, base_vectors, delta_vectors).tobytes())
+                        ids_file.write(gather(rows, base_ids, delta_ids).tobytes())
+                np.save(self._file("centroids.npy", next_generation), centroids)
+                np.save(self._file("offsets.npy", next_generation), new_offsets)
+            del base_vectors, base_ids, delta_vectors, delta_ids, delta_lists
+
+            with self.lock:
+                # carry over whatever arrived while compacting
+                if self.delta_count > delta_count:
+                    late_vectors = np.array(self._map("delta.vec", np.float32, (self.delta_count, self.dim))[delta_count:])
+                    late_ids = np.array(self._map("delta.ids", np.int64, (self.delta_count, 2))[delta_count:])
+                    self._append_delta(next_generation, late_ids[:, 0], late_ids[:, 1], late_vectors,
+                                       self.assign(late_vectors, centroids if list_of is not None else None))
+                late_tombstones = self.tombstones[tombstone_count:]
+                if len(late_tombstones):
+                    with open(self._file("tombstones.ids", next_generation), "wb") as f:
+                        f.write(late_tombstones.tobytes())
+
+                self._write_meta(self.path, {"dim": self.dim, "generation": next_generation, "base_count": new_base_count,
+                                             "trained_count": trained_count if list_of is not None else 0})
+                self.generation = next_generation
+                self.base_count = new_base_count
+                self.centroids = centroids if list_of is not None else None
+                self.offsets = new_offsets
+                self.trained_count = trained_count if list_of is not None else 0
+                self.tombstones = late_tombstones
+                self.delta_count = self._delta_rows_on_disk()
+                self._remove_stale_generations()
+            logger.debug(f"Compacted {self.path}: {new_base_count} clustered, {self.delta_count} pending")
+        finally:
+            self.compacting = False
+
+
+class IVFIndex:
+    """
+    Disk-backed approximate nearest neighbour index with the same interface as EmbeddingIndex.
+    Each channel is an inverted file index (IVF) kept in memory-mapped segment files under `path`,
+    so memory use doesn't grow with the number of stored embeddings.
+
+    `probes` is the recall/latency trade-off: how many of the closest lists are scanned per search.
+    `lists` fixes the number of lists (0 picks sqrt of the row count), and once `compact_threshold`
+    rows were appended or deleted since the last compaction a background compaction is started.
+    """
+    persistent = True
+
+    def __init__(self, path: str, lists: int = 0, probes: int = 8, compact_threshold: int = 20000):
+        self.path = path
+        self.lists = lists
+        self.probes = probes
+        self.compact_threshold = compact_threshold
+        self._partitions: dict[int, _Partition] = {}
+        self._compactions: dict[int, threading.Thread] = {}
+        os.makedirs(path, exist_ok=True)
+
+    def _partition_path(self, channel_id: int) -> str:
+        return os.path.join(self.path, str(channel_id) if channel_id is not None else "none")
+
+    def _get(self, channel_id: int) -> _Partition or None:
+        partition = self._partitions.get(channel_id)
+        if partition is None and os.path.exists(os.path.join(self._partition_path(channel_id), "meta.json")):
+            partition = self._partitions[channel_id] = _Partition(self._partition_path(channel_id))
+        return partition
+
+    def is_loaded(self, channel_id: int, dim: int) -> bool:
+        partition = self._partitions.get(channel_id)
+        return partition is not None and partition.dim == dim
+
+    def open(self, channel_id: int, dim: int) -> int:
+        partition = self._get(channel_id)
+        if partition is None or partition.dim != dim:
+            self._wait_for_compaction(channel_id)
+            partition = self._partitions[channel_id] = _Partition.create(self._partition_path(channel_id), dim)
+        self._maybe_compact(channel_id)
+        return partition.max_rowid
+
+    def add_batch(self, channel_id: int, rowids: np.ndarray, message_ids: np.ndarray, vectors: np.ndarray):
+        partition = self._partitions.get(channel_id)
+        # unopened channels catch up from the database when they are first searched
+        if partition is None or partition.dim != vectors.shape[-1]:
+            return
+        partition.append(np.asarray(rowids, dtype=np.int64), np.asarray(message_ids, dtype=np.int64), normalize(vectors))
+        self._maybe_compact(channel_id)
+
+    def add(self, channel_id: int, rowid: int, message_id: int, vector: np.ndarray):
+        self.add_batch(channel_id, np.array([rowid]), np.array([message_id]), np.asarray(vector)[np.newaxis])
+
+    def remove(self, channel_id: int, rowids: list[int]) -> int:
+        partition = self._get(channel_id)
+        if partition is None:
+            return 0
+        partition.tombstone(rowids)
+        self._maybe_compact(channel_id)
+        return len(rowids)
+
+    def drop(self, channel_id: int = None):
+        for c in list(self._partitions if channel_id is None else [channel_id]):
+            self._wait_for_compaction(c)
+            self._partitions.pop(c, None)
+        if channel_id is None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path, exist_ok=True)
+        else:
+            shutil.rmtree(self._partition_path(channel_id), ignore_errors=True)
+
+    def __len__(self):
+        return sum(p.base_count + p.delta_count - len(p.tombstones) for p in self._partitions.values())
+
+    def search(self, channel_id: int, embedding: np.ndarray, threshold: float = 0.0, limit: int = 0,
+               exclude_ids: list[int] = None) -> list[tuple[int, float]]:
+        partition = self._partitions.get(channel_id)
+        if partition is None or partition.dim != len(embedding):
+            return []
+        return partition.search(embedding, threshold, limit, exclude_ids, self.probes)
+
+    def compact(self, channel_id: int):
+        partition = self._get(channel_id)
+        if partition is not None:
+            partition.compact(self.lists)
+
+    def _maybe_compact(self, channel_id: int):
+        partition = self._partitions[channel_id]
+        pending = partition.delta_count + len(partition.tombstones)
+        # the clustering goes stale once the partition doubled since it was trained
+        grown = partition.delta_count >= max(MIN_TRAIN_ROWS, partition.trained_count)
+        if pending < self.compact_threshold and not grown:
+            return
+        if partition.compacting or (channel_id in self._compactions and self._compactions[channel_id].is_alive()):
+            return
+        thread = threading.Thread(target=self.compact, args=(channel_id,), daemon=True)
+        self._compactions[channel_id] = thread
+        thread.start()
+
+    def _wait_for_compaction(self, channel_id: int):
+        thread = self._compactions.pop(channel_id, None)
+        if thread:
+            thread.join()
+
+    def close(self):
+        for channel_id in list(self._compactions):
+            self._wait_for_compaction(channel_id)
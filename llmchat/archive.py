@@ -0,0 +1,158 @@
+import json
+import sqlite3
+import zlib
+
+import numpy as np
+
+from llmchat.embedding_index import EmbeddingIndex
+from llmchat.logger import logger
+
+# rows per archive segment, also the stride of the ids handed to the archive's embedding index
+SEGMENT_ROWS = 4096
+COMPRESSION_LEVEL = 6
+CACHED_SEGMENTS = 8
+
+
+def _pack_rows(rows: list) -> bytes:
+    return zlib.compress(json.dumps(rows, separators=(",", ":")).encode("utf-8"), COMPRESSION_LEVEL)
+
+
+def _unpack_rows(blob: bytes) -> list:
+    return json.loads(zlib.decompress(blob))
+
+
+class MessageArchive:
+    """
+    Cold storage for history that aged out of persistent.db under the retention policy.
+    Rows are kept in their own database as zlib compressed segments of up to SEGMENT_ROWS rows each,
+    archived embeddings stay searchable so old messages can still be recalled. `index` is what they're searched
+    with, the same kind as the hot database's (an on-disk ann_index.IVFIndex keeps the archive out of RAM as well).
+    """
+
+    def __init__(self, path: str, index: EmbeddingIndex = None):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute(
+            """
+    CREATE TABLE IF NOT EXISTS archived_history (
+        id INTEGER PRIMARY KEY,
+        channel_id INTEGER,
+        guild_id INTEGER,
+        first_created_at REAL,
+        last_created_at REAL,
+        count INTEGER,
+        rows BLOB
+    )
+    """
+        )
+        self.cursor.execute(
+            """
+    CREATE TABLE IF NOT EXISTS archived_embeddings (
+        id INTEGER PRIMARY KEY,
+        channel_id INTEGER,
+        model TEXT,
+        dim INTEGER,
+        count INTEGER,
+        rows BLOB,
+        vectors BLOB
+    )
+    """
+        )
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS archived_history_channel_idx ON archived_history (channel_id, last_created_at)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS archived_embeddings_channel_idx ON archived_embeddings (channel_id, dim)")
+        self.connection.commit()
+
+        # ids in this index are segment_id * SEGMENT_ROWS + row within the segment
+        self.index = index if index is not None else EmbeddingIndex()
+        self._segments: dict[int, list] = {}
+        # segments written but not committed yet, indexed once they are so the index never gets ahead of the database
+        self._unindexed: list[tuple] = []
+
+    def add_history(self, channel_id: int, guild_id: int, rows: list[tuple[int, str, int, float]]):
+        for start in range(0, len(rows), SEGMENT_ROWS):
+            segment = rows[start:start + SEGMENT_ROWS]
+            self.cursor.execute(
+                "INSERT INTO archived_history (channel_id, guild_id, first_created_at, last_created_at, count, rows) VALUES (?, ?, ?, ?, ?, ?)",
+                (channel_id, guild_id, segment[0][3], segment[-1][3], len(segment), _pack_rows(segment)),
+            )
+
+    def add_embeddings(self, channel_id: int, model: str, rows: list[tuple[int, str, int]], vectors: np.ndarray):
+        for start in range(0, len(rows), SEGMENT_ROWS):
+            segment, segment_vectors = rows[start:start + SEGMENT_ROWS], vectors[start:start + SEGMENT_ROWS]
+            self.cursor.execute(
+                "INSERT INTO archived_embeddings (channel_id, model, dim, count, rows, vectors) VALUES (?, ?, ?, ?, ?, ?)",
+                (channel_id, model, vectors.shape[1], len(segment), _pack_rows(segment),
+                 zlib.compress(segment_vectors.tobytes(), COMPRESSION_LEVEL)),
+            )
+            self._unindexed.append((channel_id, self.cursor.lastrowid, segment, segment_vectors))
+
+    def _index_segment(self, channel_id: int, segment_id: int, rows: list, vectors: np.ndarray, after: int = -1):
+        ids = segment_id * SEGMENT_ROWS + np.arange(len(rows))
+        new = ids > after
+        if new.any():
+            self.index.add_batch(channel_id, ids[new], np.array([r[2] for r in rows])[new], vectors[new])
+
+    def commit(self):
+        self.connection.commit()
+        for segment in self._unindexed:
+            self._index_segment(*segment)
+        self._unindexed.clear()
+
+    def _load(self, channel_id: int, dim: int):
+        # a persistent index already holds the segments up to `after`
+        after = self.index.open(channel_id, dim)
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT id, rows, vectors FROM archived_embeddings WHERE channel_id IS ? AND dim = ? AND (id + 1) * ? > ?",
+                       (channel_id, dim, SEGMENT_ROWS, after + 1))
+        loaded = 0
+        for segment_id, rows, vectors in cursor:
+            rows = _unpack_rows(rows)
+            vectors = np.frombuffer(zlib.decompress(vectors), dtype="<f4").reshape(len(rows), dim)
+            self._index_segment(channel_id, segment_id, rows, vectors, after)
+            loaded += len(rows)
+        logger.debug(f"Loaded {loaded} archived embeddings for channel {channel_id}")
+
+    def _segment(self, segment_id: int) -> list:
+        rows = self._segments.get(segment_id)
+        if rows is None:
+            self.cursor.execute("SELECT rows FROM archived_embeddings WHERE id = ?", (segment_id,))
+            row = self.cursor.fetchone()
+            rows = _unpack_rows(row[0]) if row else []
+            if len(self._segments) >= CACHED_SEGMENTS:
+                self._segments.pop(next(iter(self._segments)))
+            self._segments[segment_id] = rows
+        return rows
+
+    def search(self, channel_id: int, embedding: np.ndarray, threshold: float = 0.0, limit: int = 0,
+               exclude_ids: list[int] = None) -> list[tuple[tuple[int, str, int], float]]:
+        if not self.index.is_loaded(channel_id, len(embedding)):
+            # most channels never had anything archived, don't set up an empty partition for each of them
+            self.cursor.execute("SELECT 1 FROM archived_embeddings WHERE channel_id IS ? AND dim = ? LIMIT 1", (channel_id, len(embedding)))
+            if self.cursor.fetchone() is None:
+                return []
+            self._load(channel_id, len(embedding))
+        matches = []
+        for archive_id, similarity in self.index.search(channel_id, embedding, threshold, limit, exclude_ids):
+            segment_id, row = divmod(archive_id, SEGMENT_ROWS)
+            rows = self._segment(segment_id)
+            if row < len(rows):
+                matches.append((tuple(rows[row]), similarity))
+        return matches
+
+    def drop(self, channel_id: int = None):
+        if channel_id is None:
+            self.cursor.execute("DELETE FROM archived_history")
+            self.cursor.execute("DELETE FROM archived_embeddings")
+        else:
+            self.cursor.execute("DELETE FROM archived_history WHERE channel_id IS ?", (channel_id,))
+            self.cursor.execute("DELETE FROM archived_embeddings WHERE channel_id IS ?", (channel_id,))
+        self._unindexed = [u for u in self._unindexed if channel_id is not None and u[0] != channel_id]
+        self.connection.commit()
+        self.index.drop(channel_id)
+        self._segments.clear()
+
+    def close(self):
+        self.commit()
+        self.index.close()
+        self.connection.close()
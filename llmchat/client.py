@@ -1,26 +1,34 @@
 import asyncio
 import ctypes
+import functools
 import io
+import time
 from time import sleep
 import discord
-import requests
 from PIL import Image
-from typing import Union
+from typing import Callable, Union
 from discord import app_commands
 from discord import voice_client 
 from discord.interactions import Interaction
-import openai
-from aiohttp import ClientSession
+import aiohttp
 from llmchat import ui_extensions
 import re
 from llmchat.blip import BLIP
 from llmchat.config import Config
 from llmchat.logger import logger, console_handler, color_formatter
 from llmchat.voice_support import BufferAudioSink
-from llmchat.persistence import PersistentData
+from llmchat.embedding_queue import EmbeddingQueue
+from llmchat.http_session import create_session
+from llmchat.identity_cache import IdentityCache
+from llmchat.persistence import AsyncPersistentData
+from llmchat.rate_limiter import RateLimiter
+from llmchat.scheduler import GenerationScheduler, Turn
+from llmchat.streaming import MessageStreamer
+from llmchat.summarizer import ChannelSummarizer
 
 from llmchat.llm_sources import LLMSource
 from llmchat.tts_sources import TTSSource
+from llmchat.embedding_sources import EmbeddingSource
 from llmchat.sr_sources import SRSource
 
 from llmchat.modules.vtubestudio_module import VTubeStudioClient
@@ -30,9 +38,16 @@ class DiscordClient(discord.Client):
     llm: LLMSource = None
     tts: TTSSource = None
     sr: SRSource = None
-    db: PersistentData
+    db: AsyncPersistentData
+    identities: IdentityCache
+    embedder: EmbeddingSource = None
+    embeddings: EmbeddingQueue = None
+    summarizer: ChannelSummarizer = None
+    scheduler: GenerationScheduler
+    openai_limits: RateLimiter
     blip: BLIP
     sink: BufferAudioSink = None
+    _http_session: aiohttp.ClientSession = None
 
     def __init__(self, config: Config):
         self.config = config
@@ -51,6 +66,9 @@ class DiscordClient(discord.Client):
         intents = discord.Intents.default()
         intents.message_content = True
         super(DiscordClient, self).__init__(intents=intents)
+        self.scheduler = GenerationScheduler(self.config, self.respond)
+        # shared by the OpenAI llm and embeddings, it reads the rate limit headers of every response
+        self.openai_limits = RateLimiter(self.config)
 
         self.tree = app_commands.CommandTree(self)
         self.tree.add_command(
@@ -150,42 +168,66 @@ class DiscordClient(discord.Client):
         if self.config.bot_blip_enabled:
             self.blip = BLIP()
 
+    @property
+    def http_session(self) -> aiohttp.ClientSession:
+        # shared by every llm/tts source and download, created on first use since it needs the running loop
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = create_session(self.config, [self.openai_limits.trace_config])
+        return self._http_session
+
+    async def _build(self, factory, *args):
+        # model loading runs off the event loop so the gateway keeps getting its heartbeats, and whatever is
+        # being replaced keeps working until the new one is ready
+        return await self.loop.run_in_executor(None, functools.partial(factory, *args))
+
     async def setup_tts(self):
         logger.info(f"TTS: {self.config.bot_tts_service}")
         params = [self, self.config, self.db]
 
         if self.config.bot_tts_service == "elevenlabs":
-            from tts_sources.elevenlabs import ElevenLabs
-            self.tts = ElevenLabs(*params)
+            from tts_sources.elevenlabs import ElevenLabs as source
         elif self.config.bot_tts_service == "azure":
-            from tts_sources.azure import Azure
-            self.tts = Azure(*params)
+            from tts_sources.azure import Azure as source
         elif self.config.bot_tts_service == "silero":
-            from tts_sources.silero import SileroTTS
-            self.tts = SileroTTS(*params)
+            from tts_sources.silero import SileroTTS as source
         elif self.config.bot_tts_service == "bark":
-            from tts_sources.bark import Bark
-            self.tts = Bark(*params)
+            from tts_sources.bark import Bark as source
         elif self.config.bot_tts_service == "play.ht":
-            from tts_sources.playht import PlayHt
-            self.tts = PlayHt(*params)
+            from tts_sources.playht import PlayHt as source
         else:
             logger.critical(f"Unknown TTS service: {self.config.bot_tts_service}")
+            return
+        self.tts = await self._build(source, *params)
 
-    async def setup_llm(self):
-        logger.info(f"LLM: {self.config.bot_llm}")
-        params = [self, self.config, self.db]
-        if self.config.bot_llm == "openai":
+    def llm_source(self, name: str) -> type or None:
+        if name == "openai":
             from llm_sources.oai import OpenAI
-            self.llm = OpenAI(*params)
-        elif self.config.bot_llm == "llama":
+            return OpenAI
+        elif name == "llama":
             from llm_sources.llama import LLaMA
-            self.llm = LLaMA(*params)
-        elif self.config.bot_llm == "ollama":
+            return LLaMA
+        elif name == "ollama":
             from llm_sources.ollama import OllamaLLM
-            self.llm = OllamaLLM(*params)            
-        else:
+            return OllamaLLM
+        elif name == "failover":
+            from llm_sources.failover import FailoverLLM
+            return FailoverLLM
+        return None
+
+    async def setup_llm(self):
+        logger.info(f"LLM: {self.config.bot_llm}")
+        params = [self, self.config, self.db]
+        source = self.llm_source(self.config.bot_llm)
+        if source is None:
             logger.critical(f"Unknown LLM: {self.config.bot_llm}")
+            return
+
+        await self.change_presence(activity=discord.Game(name=f"Loading {self.config.bot_llm}..."))
+        llm = await self._build(source, *params)
+        # the old source finishes the requests it already took before it lets go of its model
+        old, self.llm = self.llm, llm
+        if old:
+            await old.close()
 
         await self.change_presence(activity=discord.Game(name=self.llm.current_model_name))
         logger.info(f"Current model: {self.llm.current_model_name}")
@@ -194,22 +236,57 @@ class DiscordClient(discord.Client):
         logger.info(f"Speech recognition service: {self.config.bot_speech_recognition_service}")
         params = [self, self.config, self.db]
         if self.config.bot_speech_recognition_service == "whisper":
-            from sr_sources.whisper import Whisper
-            self.sr = Whisper(*params)
+            from sr_sources.whisper import Whisper as source
         elif self.config.bot_speech_recognition_service == "google":
-            from sr_sources.google import Google
-            self.sr = Google(*params)
+            from sr_sources.google import Google as source
         elif self.config.bot_speech_recognition_service == "azure":
-            from sr_sources.azure import Azure
-            self.sr = Azure(*params)
+            from sr_sources.azure import Azure as source
         else:
             logger.critical(f"Unknown speech recognition service: {self.config.bot_speech_recognition_service}")
+            return
+        self.sr = await self._build(source, *params)
+
+    async def setup_embeddings(self):
+        logger.info(f"Embeddings: {self.config.memory_embeddings}")
+        params = [self, self.config]
+        if self.embeddings:
+            await self.embeddings.close()
+            self.embeddings = None
+        if self.embedder:
+            await self.embedder.close()
+            self.embedder = None
+
+        if self.config.memory_embeddings == "openai":
+            from embedding_sources.oai import OpenAIEmbeddings
+            self.embedder = OpenAIEmbeddings(*params)
+        elif self.config.memory_embeddings == "ollama":
+            from embedding_sources.ollama import OllamaEmbeddings
+            self.embedder = OllamaEmbeddings(*params)
+        elif self.config.memory_embeddings == "local":
+            from embedding_sources.local import LocalEmbeddings
+            self.embedder = LocalEmbeddings(*params)
+        elif self.config.memory_embeddings != "off":
+            logger.critical(f"Unknown embedding service: {self.config.memory_embeddings}")
+
+        if self.embedder:
+            self.embeddings = EmbeddingQueue(self.db, self.embedder.embed, self.embedder.model,
+                                             batch_size=self.config.memory_embedding_batch_size,
+                                             max_delay=self.config.memory_embedding_batch_delay,
+                                             concurrency=self.config.memory_embedding_concurrency,
+                                             retries=self.config.memory_embedding_retries,
+                                             retry_on=self.embedder.retry_on)
+
+    async def setup_summarizer(self):
+        if self.summarizer:
+            await self.summarizer.close()
+        self.summarizer = ChannelSummarizer(self) if self.config.memory_summaries else None
 
     async def reload_config(self, ctx: Interaction):
         await ctx.response.defer()
 
         try:
             prev_llm, prev_blip, prev_tts, prev_speech = self.config.bot_llm, self.config.bot_blip_enabled, self.config.bot_tts_service, self.config.bot_speech_recognition_service
+            prev_embeddings, prev_summaries = self.config.memory_embeddings, self.config.memory_summaries
             self.config.load()
             # manually load new settings if necessary
             if prev_llm != self.config.bot_llm:
@@ -219,13 +296,15 @@ class DiscordClient(discord.Client):
                     del self.blip
                     self.blip = None
                 else:
-                    self.blip = BLIP()
+                    self.blip = await self._build(BLIP)
             if prev_tts != self.config.bot_tts_service:
                 await self.setup_tts()
             if prev_speech != self.config.bot_speech_recognition_service:
-                del self.sr
-                self.sr = None
                 await self.setup_sr()
+            if prev_embeddings != self.config.memory_embeddings:
+                await self.setup_embeddings()
+            if prev_summaries != self.config.memory_summaries:
+                await self.setup_summarizer()
 
             self.llm.on_config_reloaded()
 
@@ -256,15 +335,15 @@ class DiscordClient(discord.Client):
             await ctx.respond("VTube Studio integration is disabled.")
 
     async def retry_last_message(self, ctx: Interaction):
-        history_item = self.db.last
+        history_item = await self.db.get_last(ctx.channel.id)
+        self.note_activity(ctx.channel)
 
         await ctx.response.defer()
 
         if not history_item:
-            response = await self.llm.generate_response(ctx.user)
-            sent_message = await self.send_message(response, ctx.followup)
-            await self.store_embedding((ctx.user.id, response, sent_message[0].id))
-            self.db.append(sent_message[0], override_content=response)
+            response, sent_message = await self.send_response(ctx.user, ctx.channel, ctx.followup)
+            self.store_embedding((ctx.user.id, response, sent_message[0].id), ctx.channel)
+            await self.db.append(sent_message[0], override_content=response)
             if self.config.bot_audiobook_mode and ctx.guild.voice_client:
                 await self.say(response, ctx.guild.voice_client, ctx.channel)
             return
@@ -274,18 +353,17 @@ class DiscordClient(discord.Client):
 
         if author_id != self.user.id:
             # not from me
-            response = await self.llm.generate_response(ctx.user)
-            sent_message = await self.send_message(response, ctx.followup)
-            await self.store_embedding((ctx.user.id, response, sent_message[0].id))
-            self.db.append(sent_message[0], override_content=response)
+            response, sent_message = await self.send_response(ctx.user, ctx.channel, ctx.followup)
+            self.store_embedding((ctx.user.id, response, sent_message[0].id), ctx.channel)
+            await self.db.append(sent_message[0], override_content=response)
             if self.config.bot_audiobook_mode and ctx.guild.voice_client:
                 await self.say(response, ctx.guild.voice_client, ctx.channel)
         else:
             delete_me = await ctx.followup.send(content="Retrying...", silent=True)
             await delete_me.delete()
             await last_message.edit(content="*Retrying...*")
-            self.db.remove(last_message.id)
-            response = await self.llm.generate_response(ctx.user)
+            await self.db.remove(last_message.id)
+            response = await self.llm.generate_response(ctx.user, ctx.channel)
 
             if len(response) < 2000:
                 await last_message.edit(content=response)
@@ -294,8 +372,8 @@ class DiscordClient(discord.Client):
                 last_message = await self.send_message(response, ctx.channel)
                 last_message = last_message[0]
 
-            await self.store_embedding((ctx.user.id, response, last_message.id))
-            self.db.append(last_message, override_content=response)
+            self.store_embedding((ctx.user.id, response, last_message.id), ctx.channel)
+            await self.db.append(last_message, override_content=response)
             if self.config.bot_audiobook_mode and ctx.guild.voice_client:
                 await self.say(response, ctx.guild.voice_client, ctx.channel)
 
@@ -320,8 +398,10 @@ class DiscordClient(discord.Client):
         )
 
     async def set_avatar(self, ctx: Interaction, url: str):
-        r = requests.get(url, stream=True)
-        await self.user.edit(avatar=r.content)
+        async with self.http_session.get(url) as r:
+            r.raise_for_status()
+            avatar = await r.read()
+        await self.user.edit(avatar=avatar)
         await ctx.response.send_message(f"Avatar set!", delete_after=3)
 
     async def send_message(self, text: str, channel: Union[discord.TextChannel, discord.Webhook]) -> list[discord.Message]:
@@ -343,11 +423,33 @@ class DiscordClient(discord.Client):
                 await asyncio.sleep(0.5)
         return all_messages
 
+    async def send_response(self, invoker: discord.User, channel: discord.abc.Messageable,
+                            destination: Union[discord.TextChannel, discord.Webhook],
+                            before_send: Callable[[], None] = None) -> tuple[str, list[discord.Message]]:
+        """
+        Generates a response in `channel` and sends it to `destination`, streamed into the message as it's generated
+        when stream_responses is on. `before_send` is called right before any of it is sent.
+        """
+        if not self.config.llm_stream_responses:
+            response = await self.llm.generate_response(invoker, channel)
+            if before_send:
+                before_send()
+            return response, await self.send_message(response, destination)
+
+        streamer = MessageStreamer(destination, before_send=before_send)
+        try:
+            async for piece in self.llm.stream_response(invoker, channel):
+                await streamer.feed(piece)
+            return await streamer.finish()
+        except BaseException:
+            await streamer.discard()
+            raise
+
     async def print_info(self, ctx: Interaction):
         await ctx.response.defer()
 
         name, identity = (None, None)
-        _identity = self.db.get_identity(ctx.user.id)
+        _identity = await self.identities.get_identity(ctx.user.id)
         if _identity:
             name, identity = _identity
 
@@ -358,6 +460,12 @@ class DiscordClient(discord.Client):
         llm_str += f"⚙️ Frequency penalty: {self.config.llm_frequency_penalty}\n"
         llm_str += f"⚙️ Context history count: {self.config.llm_context_messages_count}\n"
         llm_str += f"⚙️ Max tokens: {'Unlimited' if self.config.llm_max_tokens == 0 else self.config.llm_max_tokens}\n"
+        worker = getattr(self.llm, "worker", None)
+        if worker:
+            llm_str += f"⚙️ Queue: {worker.depth} waiting, {worker.average_wait:.1f}s average wait, {worker.max_depth} at most\n"
+        limits = self.openai_limits
+        if limits.admitted:
+            llm_str += f"⚙️ OpenAI rate limits: {limits.waiting} waiting, {limits.throttled} of {limits.admitted} requests held back, {limits.rate_limited} rate limited\n"
 
         embed.add_field(name="📝 LLM", value=llm_str, inline=False)
         embed.add_field(name="🗣️ TTS", value=f"**{self.config.bot_tts_service}**: {self.tts.current_voice_name}",
@@ -390,20 +498,28 @@ class DiscordClient(discord.Client):
     async def purge_channel(self, ctx: Interaction):
         await ctx.response.send_message(f"Channel purged!", delete_after=3)
         await ctx.channel.purge()
-        self.db.clear()
+        await self.db.clear_channel(ctx.channel.id)
+        if self.summarizer:
+            self.summarizer.forget(ctx.channel.id)
 
     async def set_model(self, ctx: Interaction):
 
         await ctx.response.defer()
         async def llm_callback(ctx: Interaction):
+            model = ctx.data["values"][0]
+            await ctx.response.edit_message(content=f"Loading *{model}*, the current model keeps replying until it's ready...", embed=None, view=None)
+            await self.change_presence(activity=discord.Game(name=f"Loading {model}..."))
             try:
-                model = ctx.data["values"][0]
-                self.llm.set_model(model)
-                await self.change_presence(activity=discord.Game(name=model))
-                await ctx.response.edit_message(content=f"Model changed to *{self.llm.current_model_name}*", embed=None, view=None, delete_after=3)
+                start = time.monotonic()
+                await self.llm.change_model(model)
+                message = await ctx.edit_original_response(content=f"Model changed to *{self.llm.current_model_name}* ({time.monotonic() - start:.0f}s)")
+                await message.delete(delay=3)
             except Exception as e:
-                logger.error(f"Exception thrown while LLM model: {str(e)}")
-                await ctx.response.edit_message(content=f"Exception thrown while setting LLM model:\n```{str(e)}```", embed=None, view=None, delete_after=5)
+                logger.error(f"Exception thrown while setting LLM model: {str(e)}")
+                message = await ctx.edit_original_response(content=f"Exception thrown while setting LLM model:\n```{str(e)}```")
+                await message.delete(delay=5)
+            finally:
+                await self.change_presence(activity=discord.Game(name=self.llm.current_model_name))
 
         async def voice_callback(ctx: Interaction):
             try:
@@ -420,7 +536,7 @@ class DiscordClient(discord.Client):
 
             view = discord.ui.View()
             view.add_item(ui_extensions.PaginationDropdown(options=await self.llm.list_models(), callback=llm_callback, on_exception=on_exception))
-            view.add_item(ui_extensions.PaginationDropdown(options=self.tts.list_voices(), callback=voice_callback, on_exception=on_exception))
+            view.add_item(ui_extensions.PaginationDropdown(options=await self.tts.list_voices(), callback=voice_callback, on_exception=on_exception))
             await ctx.followup.send(content="Select an LLM model or a TTS voice:", view=view)
         except Exception as e:
             logger.error(f"Exception thrown while constructing model/voice pickers: {str(e)}")
@@ -431,7 +547,7 @@ class DiscordClient(discord.Client):
     async def send_system(self, ctx: Interaction, message: str):
         if self.config.bot_llm == "openai" and self.llm.use_chat_completion:
             await ctx.response.send_message(f"**System**: {message}")
-            self.db.system(message, ctx.id)
+            await self.db.system(message, ctx.id, ctx.channel)
         else:
             await ctx.response.send_message(
                 "Error: System messages are only supported in OpenAI models, gpt-3.5-turbo and newer.",
@@ -441,7 +557,7 @@ class DiscordClient(discord.Client):
     async def set_your_identity(self, ctx: Interaction):
         this = self
 
-        name, desc = self.db.get_identity(ctx.user.id) or (None, None)
+        name, desc = await self.identities.get_identity(ctx.user.id) or (None, None)
 
         class IdentityModal(discord.ui.Modal):
             def __init__(self, *args, **kwargs) -> None:
@@ -466,7 +582,7 @@ class DiscordClient(discord.Client):
                 )
 
             async def on_submit(self, interaction: Interaction):
-                this.db.set_identity(
+                await this.identities.set_identity(
                     ctx.user.id, self.children[0].value, self.children[1].value
                 )
                 await interaction.response.send_message("Changes committed.", delete_after=3)
@@ -543,38 +659,103 @@ class DiscordClient(discord.Client):
 
         await self.change_presence(activity=discord.Game(name="Loading..."))
 
-        self.db: PersistentData = PersistentData(self)
+        if self.embeddings:
+            await self.embeddings.close()
+            self.embeddings = None
+        if self.summarizer:
+            await self.summarizer.close()
+            self.summarizer = None
+        if getattr(self, "db", None):
+            # reconnecting, don't drop the writes still waiting in the old instance
+            await self.db.close()
+
+        embedding_index, archive_index = None, None
+        if self.config.memory_index == "ann":
+            from llmchat.ann_index import IVFIndex
+            # the archive is usually the bigger of the two, it's kept on disk just the same
+            embedding_index, archive_index = (
+                IVFIndex(path, lists=self.config.memory_ann_lists, probes=self.config.memory_ann_probes,
+                         compact_threshold=self.config.memory_ann_compact_threshold)
+                for path in ("persistent.db.ann", "persistent-archive.db.ann")
+            )
+        self.db = await AsyncPersistentData.open(self, embedding_index=embedding_index, archive_index=archive_index,
+                                                 write_batch_size=self.config.database_write_batch_size,
+                                                 write_flush_interval=self.config.database_write_flush_interval)
+        self.identities = IdentityCache(self, self.db)
+        self.loop.create_task(self.flush_db_periodically())
+        self.loop.create_task(self.apply_retention_periodically())
         await self.setup_llm()
         await self.setup_tts()
         await self.setup_sr()
+        await self.setup_embeddings()
+        await self.setup_summarizer()
 
         await self.tree.sync()
         self.event(self.on_voice_state_update)
         logger.info("Initialization complete.")
 
-    async def store_embedding(self, message: tuple[int, str, int]):
-        author_id, content, message_id = message
-        if self.config.openai_use_embeddings and self.llm.is_openai:
-            async with ClientSession() as s:
-                openai.aiosession.set(s)
-                embedding = await openai.Embedding.acreate(api_base=self.config.openai_reverse_proxy_url, input=content, model="text-embedding-ada-002")
-                self.db.add_embedding(message, embedding['data'][0]['embedding'])
-                logger.debug("Added embedding for message " + str(message_id))
+    async def flush_db_periodically(self):
+        # commits writes that are waiting on write_flush_interval in a quiet channel
+        db = self.db
+        while not self.is_closed() and db is self.db:
+            await asyncio.sleep(self.config.database_write_flush_interval or 1.0)
+            await db.flush(only_if_due=True)
+
+    async def apply_retention_periodically(self):
+        # archives expired history and hands the freed pages back, in small steps so other queries get in between
+        db = self.db
+        while not self.is_closed() and db is self.db:
+            archived = 0
+            while archived_step := await db.apply_retention(self.config.memory_retention_policies):
+                archived += archived_step
+            if archived:
+                logger.info(f"Archived {archived} messages past their retention")
+            remaining = await db.vacuum_step()
+            while remaining and (left := await db.vacuum_step()) < remaining:
+                remaining = left
+            await asyncio.sleep(self.config.memory_retention_interval)
+
+    async def close(self):
+        await self.scheduler.close()
+        if self.summarizer:
+            await self.summarizer.close()
+        if self.llm:
+            await self.llm.close()
+        if self.embeddings:
+            await self.embeddings.close()
+        if self.embedder:
+            await self.embedder.close()
+        if getattr(self, "db", None):
+            await self.db.close()
+        if self._http_session is not None:
+            await self._http_session.close()
+        await super(DiscordClient, self).close()
+
+    def store_embedding(self, message: tuple[int, str, int], channel: discord.abc.Messageable = None):
+        # queued and embedded in the background, recall waits for the one it needs
+        if self.embeddings:
+            self.embeddings.submit(message, channel.id if channel else None)
+
+    def note_activity(self, channel: discord.abc.Messageable = None):
+        # the channel's summary catches up once it's been quiet for a while
+        if self.summarizer and channel:
+            self.summarizer.touch(channel.id)
 
     async def on_speech(self, speaker_id, speech):
         speaker = discord.utils.get(self.get_all_members(), id=speaker_id)
-        await self.store_embedding((speaker_id, speech, -1))
-
         vc: discord.VoiceClient = speaker.guild.voice_client
+        self.store_embedding((speaker_id, speech, -1), vc.channel if vc else None)
+
         if not vc or not vc.is_connected():
             return
 
-        self.db.speech(speaker, speech)
+        await self.db.speech(speaker, speech, vc.channel)
+        self.note_activity(vc.channel)
 
         # Play thinking animation
         await self.vtube_client.play_thinking()
 
-        response = await self.llm.generate_response(speaker)
+        response = await self.llm.generate_response(speaker, vc.channel)
 
         # Parse emotion tag
         emotion_match = re.search(r"<emotion>(.*?)</emotion>", response)
@@ -583,12 +764,13 @@ class DiscordClient(discord.Client):
         # Strip the emotion tag from the message before saying it
         cleaned_response = re.sub(r"<emotion>.*?</emotion>", "", response, flags=re.DOTALL).strip()
 
-        await self.store_embedding((self.user.id, cleaned_response, -1))
+        self.store_embedding((self.user.id, cleaned_response, -1), vc.channel)
 
         # Play speaking emote for the emotion
         await self.vtube_client.play_emotion(emotion)
 
-        self.db.speech(self.user, cleaned_response)
+        await self.db.speech(self.user, cleaned_response, vc.channel)
+        self.note_activity(vc.channel)
 
         vc.stop()
 
@@ -624,8 +806,16 @@ class DiscordClient(discord.Client):
 #####################################################################################################################################################################################
 #####################################################################################################################################################################################
 
+    async def on_user_update(self, before: discord.User, after: discord.User):
+        if getattr(self, "identities", None):
+            self.identities.invalidate(after.id)
+
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if getattr(self, "identities", None):
+            self.identities.invalidate(after.id)
+
     async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
-        self.db.remove(payload.message_id)
+        await self.db.remove(payload.message_id)
 
         message = payload.cached_message
         if not message:
@@ -636,17 +826,21 @@ class DiscordClient(discord.Client):
         channel = self.get_channel(payload.channel_id)
         while message.reference:
             reference = await channel.fetch_message(message.reference.message_id)
-            self.db.remove(reference.id)
+            await self.db.remove(reference.id)
             await reference.delete()
             logger.debug(f"Deleted reference message: {reference.id}")
             message = reference
 
     async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
-        self.db.edit(payload.message_id, payload.data["content"])
+        author = payload.cached_message.author.id if payload.cached_message else int(payload.data.get("author", {}).get("id", 0))
+        if author == self.user.id:
+            # the bot only edits its own messages while streaming or retrying a reply, which stores the final text once done
+            return
+        await self.db.edit(payload.message_id, payload.data["content"])
 
         if payload.cached_message:
-            self.db.remove_embedding(payload.cached_message.id)  # remove existing
-            await self.store_embedding((payload.cached_message.author.id, payload.data["content"], payload.cached_message.id))  # regenerate
+            await self.db.remove_embedding(payload.cached_message.id)  # remove existing
+            self.store_embedding((payload.cached_message.author.id, payload.data["content"], payload.cached_message.id), payload.cached_message.channel)  # regenerate
 
     async def say(self, text: str, vc: discord.VoiceClient, text_channel_ctx: discord.TextChannel = None, after=None):
         try:
@@ -682,26 +876,35 @@ class DiscordClient(discord.Client):
                     continue
 
                 # download image
-                r = requests.get(a.url, stream=True)
-                r.raise_for_status()
-                img = Image.open(r.raw).convert("RGB")
+                async with self.http_session.get(a.url) as r:
+                    r.raise_for_status()
+                    img = Image.open(io.BytesIO(await r.read())).convert("RGB")
                 caption = self.blip.process_image(img)
                 logger.info(f"Image caption: {caption}")
                 message.content += f"\n[{caption}]"
 
-        self.db.append(message)
-        await self.store_embedding((message.author.id, message.content, message.id))
-
+        await self.db.append(message)
+        self.store_embedding((message.author.id, message.content, message.id), message.channel)
+        self.note_activity(message.channel)
+        # bursts are answered with one reply, see GenerationScheduler
+        self.scheduler.submit(message)
+
+    async def respond(self, messages: list[discord.Message], turn: Turn):
+        """
+        Replies to `messages`, the ones of a channel that came in since the bot's last reply there.
+        """
+        message = messages[-1]
         async with message.channel.typing():
             try:
-                response = await self.llm.generate_response(invoker=message.author)
+                response, sent_messages = await self.send_response(message.author, message.channel, message.channel, before_send=turn.deliver)
             except Exception as e:
                 view = discord.ui.View()
                 retry_btn = discord.ui.Button(label="Retry")
 
                 async def _retry(interaction: Interaction):
                     await interaction.message.delete(delay=2)
-                    await self.on_message(message)
+                    for m in messages:
+                        await self.on_message(m)
 
                 retry_btn.callback = _retry
                 view.add_item(retry_btn)
@@ -709,19 +912,20 @@ class DiscordClient(discord.Client):
                 await message.channel.send(f"Exception thrown while trying to generate message:\n```{str(e)}```",
                                            view=view)
 
-                # since it failed remove the message
-                self.db.remove(message.id)
+                # since it failed remove the messages
+                for m in messages:
+                    await self.db.remove(m.id)
                 raise e
 
         logger.debug(f"Response: {response}")
 
-        sent_message = await self.send_message(response, message.channel)
-        sent_message = sent_message[0]
+        sent_message = sent_messages[0]
 
         if self.config.bot_audiobook_mode and message.guild.voice_client:
             await self.say(response, message.guild.voice_client, message.channel)
 
         assert sent_message
-        self.db.append(sent_message, override_content=response)
+        await self.db.append(sent_message, override_content=response)
 
-        await self.store_embedding((self.user.id, response, sent_message.id))
+        self.store_embedding((self.user.id, response, sent_message.id), message.channel)
+        self.note_activity(message.channel)
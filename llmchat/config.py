@@ -109,6 +109,22 @@ class Config:
     @property
     def ollama_model(self) -> str:
         return self._config.get("ollama", "model", fallback="mistral")
+
+    @property
+    def ollama_keep_alive(self) -> str:
+        return self._config.get("ollama", "keep_alive", fallback="30m")
+
+    @property
+    def ollama_num_ctx(self) -> int:
+        return self._config.getint("ollama", "num_ctx", fallback=0)
+
+    @property
+    def ollama_num_thread(self) -> int:
+        return self._config.getint("ollama", "num_thread", fallback=0)
+
+    @property
+    def ollama_embedding_model(self) -> str:
+        return self._config.get("ollama", "embedding_model", fallback="nomic-embed-text")
     
     @property
     def openai_reverse_proxy_url(self) -> str:
@@ -128,6 +144,10 @@ class Config:
         self._config.set("OpenAI", "use_embeddings", "true" if use_embeddings else "false")
         self.save()
 
+    @property
+    def openai_embedding_model(self) -> str:
+        return self._config.get("OpenAI", "embedding_model", fallback="text-embedding-ada-002")
+
     @property
     def openai_similarity_threshold(self) -> float:
         return self._config.getfloat("OpenAI", "similarity_threshold", fallback=0.83)
@@ -146,6 +166,203 @@ class Config:
         self._config.set("OpenAI", "max_similar_messages", str(max_similar_messages))
         self.save()
 
+    @property
+    def openai_request_timeout(self) -> float:
+        return self._config.getfloat("OpenAI", "request_timeout", fallback=120)
+
+    @property
+    def openai_requests_per_minute(self) -> int:
+        return self._config.getint("OpenAI", "requests_per_minute", fallback=0)
+
+    @property
+    def openai_tokens_per_minute(self) -> int:
+        return self._config.getint("OpenAI", "tokens_per_minute", fallback=0)
+
+    @property
+    def openai_rate_limit_retries(self) -> int:
+        return self._config.getint("OpenAI", "rate_limit_retries", fallback=5)
+
+    @property
+    def failover_backends(self) -> list[str]:
+        return [b.strip() for b in self._config.get("Failover", "backends", fallback="").split(",") if b.strip()]
+
+    def failover_deadline(self, backend: str) -> float:
+        return self._config.getfloat("Failover", f"{backend}_deadline", fallback=self._config.getfloat("Failover", "deadline", fallback=60))
+
+    @property
+    def failover_hedge_after(self) -> float:
+        return self._config.getfloat("Failover", "hedge_after", fallback=10)
+
+    @property
+    def failover_hedge_percentile(self) -> float:
+        return self._config.getfloat("Failover", "hedge_percentile", fallback=95)
+
+    @property
+    def failover_hedge_min_samples(self) -> int:
+        return self._config.getint("Failover", "hedge_min_samples", fallback=20)
+
+    @property
+    def failover_breaker_failures(self) -> int:
+        return self._config.getint("Failover", "breaker_failures", fallback=3)
+
+    @property
+    def failover_breaker_cooldown(self) -> float:
+        return self._config.getfloat("Failover", "breaker_cooldown", fallback=60)
+
+    @property
+    def database_write_batch_size(self) -> int:
+        return self._config.getint("Database", "write_batch_size", fallback=32)
+
+    @property
+    def database_write_flush_interval(self) -> float:
+        return self._config.getfloat("Database", "write_flush_interval", fallback=1.0)
+
+    @property
+    def http_connection_limit(self) -> int:
+        return self._config.getint("HTTP", "connection_limit", fallback=100)
+
+    @property
+    def http_connection_limit_per_host(self) -> int:
+        return self._config.getint("HTTP", "connection_limit_per_host", fallback=10)
+
+    @property
+    def http_dns_cache_ttl(self) -> int:
+        return self._config.getint("HTTP", "dns_cache_ttl", fallback=300)
+
+    @property
+    def http_keepalive_timeout(self) -> float:
+        return self._config.getfloat("HTTP", "keepalive_timeout", fallback=60.0)
+
+    @property
+    def http_connect_timeout(self) -> float:
+        return self._config.getfloat("HTTP", "connect_timeout", fallback=10.0)
+
+    @property
+    def http_read_timeout(self) -> float:
+        return self._config.getfloat("HTTP", "read_timeout", fallback=0.0)
+
+    @property
+    def memory_index(self) -> str:
+        return self._config.get("Memory", "index", fallback="dense")
+
+    @property
+    def memory_ann_lists(self) -> int:
+        return self._config.getint("Memory", "ann_lists", fallback=0)
+
+    @property
+    def memory_ann_probes(self) -> int:
+        return self._config.getint("Memory", "ann_probes", fallback=8)
+
+    @property
+    def memory_ann_compact_threshold(self) -> int:
+        return self._config.getint("Memory", "ann_compact_threshold", fallback=20000)
+
+    @property
+    def memory_recall(self) -> str:
+        return self._config.get("Memory", "recall", fallback="embedding")
+
+    @property
+    def memory_embeddings(self) -> str:
+        # left empty it follows OpenAI's use_embeddings switch, which is all older configs have
+        return self._config.get("Memory", "embeddings", fallback="") or ("openai" if self.openai_use_embeddings else "off")
+
+    @property
+    def memory_local_embedding_model(self) -> str:
+        return self._config.get("Memory", "local_embedding_model", fallback="all-MiniLM-L6-v2")
+
+    @property
+    def memory_local_embedding_threads(self) -> int:
+        return self._config.getint("Memory", "local_embedding_threads", fallback=0)
+
+    @property
+    def memory_hybrid_weight(self) -> float:
+        return self._config.getfloat("Memory", "hybrid_weight", fallback=0.5)
+
+    @property
+    def memory_embedding_batch_size(self) -> int:
+        return self._config.getint("Memory", "embedding_batch_size", fallback=64)
+
+    @property
+    def memory_embedding_batch_delay(self) -> float:
+        return self._config.getfloat("Memory", "embedding_batch_delay", fallback=1.0)
+
+    @property
+    def memory_recall_deadline(self) -> float:
+        return self._config.getfloat("Memory", "recall_deadline", fallback=1.0)
+
+    @property
+    def memory_embedding_concurrency(self) -> int:
+        return self._config.getint("Memory", "embedding_concurrency", fallback=2)
+
+    @property
+    def memory_embedding_retries(self) -> int:
+        return self._config.getint("Memory", "embedding_retries", fallback=3)
+
+    @property
+    def memory_retention_days(self) -> float:
+        return self._config.getfloat("Memory", "retention_days", fallback=0)
+
+    @property
+    def memory_retention_rows(self) -> int:
+        return self._config.getint("Memory", "retention_rows", fallback=0)
+
+    @property
+    def memory_retention_interval(self) -> float:
+        return self._config.getfloat("Memory", "retention_interval", fallback=3600)
+
+    @property
+    def memory_summaries(self) -> bool:
+        return self._config.getboolean("Memory", "summaries", fallback=False)
+
+    @property
+    def memory_summary_idle(self) -> float:
+        return self._config.getfloat("Memory", "summary_idle", fallback=120)
+
+    @property
+    def memory_summary_batch(self) -> int:
+        return self._config.getint("Memory", "summary_batch", fallback=30)
+
+    @property
+    def memory_summary_max_tokens(self) -> int:
+        return self._config.getint("Memory", "summary_max_tokens", fallback=300)
+
+    @property
+    def memory_retention_policies(self) -> dict:
+        """
+        {channel or guild id: (max_age_days, max_rows)} from the [Retention] section, the None key holds the defaults.
+        """
+        policies = {None: (self.memory_retention_days, self.memory_retention_rows)}
+        if self._config.has_section("Retention"):
+            for key, value in self._config.items("Retention"):
+                if key.isdigit() and value:
+                    days, _, rows = value.partition(",")
+                    policies[int(key)] = (float(days.strip() or 0), int(rows.strip() or 0))
+        return policies
+
+    @property
+    def llm_stream_responses(self) -> bool:
+        return self._config.getboolean("LLM", "stream_responses", fallback=False)
+
+    @property
+    def llm_reply_debounce(self) -> float:
+        return self._config.getfloat("LLM", "reply_debounce", fallback=1.5)
+
+    @property
+    def llm_reply_max_delay(self) -> float:
+        return self._config.getfloat("LLM", "reply_max_delay", fallback=5.0)
+
+    @property
+    def llm_max_concurrent_replies(self) -> int:
+        return self._config.getint("LLM", "max_concurrent_replies", fallback=2)
+
+    @property
+    def llm_reply_queue_size(self) -> int:
+        return self._config.getint("LLM", "reply_queue_size", fallback=8)
+
+    @property
+    def llm_reply_drop_policy(self) -> str:
+        return self._config.get("LLM", "reply_drop_policy", fallback="oldest")
+
     @property
     def llm_context_messages_count(self) -> int:
         return self._config.getint("LLM", "context_messages_count")
@@ -258,6 +475,42 @@ class Config:
         self._config.set("LLaMA", "search_path", search_path)
         self.save()
 
+    @property
+    def llama_prompt_cache(self) -> str:
+        return self._config.get("LLaMA", "prompt_cache", fallback="ram")
+
+    @property
+    def llama_prompt_cache_size(self) -> int:
+        return self._config.getint("LLaMA", "prompt_cache_size", fallback=2048)
+
+    @property
+    def llama_prompt_cache_path(self) -> str:
+        return self._config.get("LLaMA", "prompt_cache_path", fallback="llama-cache")
+
+    @property
+    def llama_context_step(self) -> int:
+        return self._config.getint("LLaMA", "context_step", fallback=8)
+
+    @property
+    def llama_n_ctx(self) -> int:
+        return self._config.getint("LLaMA", "n_ctx", fallback=2048)
+
+    @property
+    def llama_n_threads(self) -> int:
+        return self._config.getint("LLaMA", "n_threads", fallback=0)
+
+    @property
+    def llama_n_batch(self) -> int:
+        return self._config.getint("LLaMA", "n_batch", fallback=512)
+
+    @property
+    def llama_use_mmap(self) -> bool:
+        return self._config.getboolean("LLaMA", "use_mmap", fallback=True)
+
+    @property
+    def llama_use_mlock(self) -> bool:
+        return self._config.getboolean("LLaMA", "use_mlock", fallback=False)
+
     @property
     def bot_identity(self) -> str:
         return self._config.get("Bot", "identity")
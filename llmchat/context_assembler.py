@@ -0,0 +1,161 @@
+import asyncio
+import bisect
+from collections import OrderedDict
+from typing import Any, Callable
+
+import discord
+
+from llmchat.logger import logger
+
+RECALLED_CACHE_SIZE = 256
+# rows that scrolled out of every window are dropped once this many have piled up in front of one
+COMPACT_AFTER = 512
+
+
+class _Window:
+    """
+    A channel's history as last rendered. entries[i] is rows[i] rendered, None if the source leaves it out,
+    and cumulative[i] is the token count of entries[:i]. The channel's current rows start at `start`.
+    """
+    __slots__ = ("rows", "entries", "cumulative", "start")
+
+    def __init__(self):
+        self.rows: list[tuple[int, str, int]] = []
+        self.entries: list = []
+        self.cumulative: list[int] = [0]
+        self.start = 0
+
+    def append(self, rows: list, entries: list, counts: list[int]):
+        total = self.cumulative[-1]
+        for count in counts:
+            total += count
+            self.cumulative.append(total)
+        self.rows += rows
+        self.entries += entries
+
+    def compact(self):
+        base = self.cumulative[self.start]
+        self.rows = self.rows[self.start:]
+        self.entries = self.entries[self.start:]
+        self.cumulative = [c - base for c in self.cumulative[self.start:]]
+        self.start = 0
+
+
+class ContextAssembler:
+    """
+    Renders history rows the way one LLM source wants them and packs them into its token budget, newest first.
+    Each channel's rendered window is kept between turns, only rows that are new since the last turn are rendered
+    and counted and packing is a binary search over running token totals, so a turn costs the same no matter how
+    long the window is.
+    """
+
+    def __init__(self, client: discord.Client, render: Callable[[int, str, str], Any], count: Callable[[list], list[int]]):
+        self.client = client
+        # render(author_id, content, author_name) -> entry or None, count(entries) -> token counts
+        self.render = render
+        self.count = count
+        self._windows: dict[int, _Window] = {}
+        self._recalled: OrderedDict[tuple[int, str, int], tuple[Any, int]] = OrderedDict()
+        # the IdentityCache and its generation the rendered entries are up to date with
+        self._identities = None
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+    def clear(self):
+        """
+        Forgets everything rendered, for when the way rows are rendered or counted changes.
+        """
+        self._windows.clear()
+        self._recalled.clear()
+
+    def _check_identities(self):
+        # a renamed user shows up under the new name everywhere
+        identities = self.client.identities
+        if id(identities) != self._identities:
+            self.clear()
+            self._identities, self._generation = id(identities), identities.generation
+            return
+        changed = identities.changed_since(self._generation)
+        self._generation = identities.generation
+        if changed is None:
+            self.clear()
+        elif changed:
+            self._forget(changed)
+
+    def _forget(self, user_ids: set[int]):
+        # only what those users wrote is rendered again
+        for channel_id, window in list(self._windows.items()):
+            if any(row[0] in user_ids for row in window.rows[window.start:]):
+                del self._windows[channel_id]
+        for row in [r for r in self._recalled if r[0] in user_ids]:
+            del self._recalled[row]
+
+    async def _render(self, rows: list[tuple[int, str, int]]) -> tuple[list, list[int]]:
+        names = await self.client.identities.get_names(r[0] for r in rows if r[0] not in (-1, self.client.user.id))
+        entries = [self.render(author_id, content, names.get(author_id)) for author_id, content, _ in rows]
+        rendered = [e for e in entries if e is not None]
+        counts = iter(self.count(rendered) if rendered else [])
+        return entries, [next(counts) if e is not None else 0 for e in entries]
+
+    async def _sync(self, channel_id: int, rows: list[tuple[int, str, int]]) -> _Window:
+        window = self._windows.get(channel_id)
+        if window is not None and window.rows and rows:
+            # the newest row we have is usually one of the last few in `rows`
+            last, overlap = window.rows[-1], 0
+            for i in range(len(rows) - 1, -1, -1):
+                if rows[i] == last:
+                    overlap = i + 1
+                    break
+            # everything before it has to match as well, an edit or a deletion in between means starting over
+            if overlap and overlap <= len(window.rows) and window.rows[len(window.rows) - overlap:] == rows[:overlap]:
+                if overlap < len(rows):
+                    window.append(rows[overlap:], *await self._render(rows[overlap:]))
+                window.start = len(window.rows) - len(rows)
+                if window.start >= COMPACT_AFTER:
+                    window.compact()
+                return window
+
+        window = _Window()
+        if rows:
+            window.append(rows, *await self._render(rows))
+        self._windows[channel_id] = window
+        return window
+
+    async def _pack_recalled(self, recalled: list[tuple[int, str, int]], budget: int) -> tuple[list, int]:
+        misses = [r for r in dict.fromkeys(recalled) if r not in self._recalled]
+        if misses:
+            for row, entry, count in zip(misses, *await self._render(misses)):
+                self._recalled[row] = (entry, count)
+
+        picked, used = [], 0
+        for row in recalled:
+            entry, count = self._recalled[row]
+            self._recalled.move_to_end(row)
+            if entry is not None and used + count <= budget:
+                picked.append((row, entry))
+                used += count
+        while len(self._recalled) > RECALLED_CACHE_SIZE:
+            self._recalled.popitem(last=False)
+        return [entry for row, entry in sorted(picked, key=lambda p: p[0][2])], used
+
+    async def pack(self, channel_id: int, rows: list[tuple[int, str, int]], recalled: list[tuple[int, str, int]],
+                   budget: int) -> tuple[list, list, int]:
+        """
+        Fits as many of the newest `rows` as possible into `budget` tokens, then as many of the `recalled` rows
+        (best first) as still fit. Returns the recalled and recent entries, each in chronological order,
+        and the tokens they take up.
+        """
+        async with self._lock:
+            self._check_identities()
+            window = await self._sync(channel_id, rows)
+            end = len(window.rows)
+            total = window.cumulative[end]
+            # the oldest row that still fits, every row after it fits too
+            first = bisect.bisect_left(window.cumulative, total - budget, window.start, end)
+            if first > window.start:
+                logger.debug(f"Context budget of {budget} tokens reached, leaving out the {first - window.start} oldest messages.")
+            recent = [e for e in window.entries[first:end] if e is not None]
+            used = total - window.cumulative[first]
+
+            recalled, recalled_used = await self._pack_recalled(recalled, budget - used) if recalled else ([], 0)
+        return recalled, recent, used + recalled_used
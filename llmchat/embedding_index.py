@@ -0,0 +1,142 @@
+import numpy as np
+
+INITIAL_CAPACITY = 256
+
+
+class _ChannelMatrix:
+    """
+    Unit-length embeddings of one channel packed into a growable float32 matrix,
+    with the embedding row id and message id of each row kept alongside.
+    """
+
+    def __init__(self, dim: int, capacity: int = INITIAL_CAPACITY):
+        self.dim = dim
+        self.size = 0
+        self.vectors = np.empty((capacity, dim), dtype=np.float32)
+        self.rowids = np.empty(capacity, dtype=np.int64)
+        self.message_ids = np.empty(capacity, dtype=np.int64)
+
+    def _reserve(self, count: int):
+        capacity = len(self.rowids)
+        if self.size + count <= capacity:
+            return
+        while capacity < self.size + count:
+            capacity *= 2
+        vectors = np.empty((capacity, self.dim), dtype=np.float32)
+        vectors[:self.size] = self.vectors[:self.size]
+        rowids = np.empty(capacity, dtype=np.int64)
+        rowids[:self.size] = self.rowids[:self.size]
+        message_ids = np.empty(capacity, dtype=np.int64)
+        message_ids[:self.size] = self.message_ids[:self.size]
+        self.vectors, self.rowids, self.message_ids = vectors, rowids, message_ids
+
+    def add(self, rowids: np.ndarray, message_ids: np.ndarray, vectors: np.ndarray):
+        self._reserve(len(rowids))
+        end = self.size + len(rowids)
+        self.vectors[self.size:end] = vectors
+        self.rowids[self.size:end] = rowids
+        self.message_ids[self.size:end] = message_ids
+        self.size = end
+
+    def remove(self, rowids: list[int]) -> int:
+        rows = np.flatnonzero(np.isin(self.rowids[:self.size], rowids))
+        # fill each hole with the current last row, highest hole first so the moved row is never one being removed
+        for row in rows[::-1]:
+            last = self.size - 1
+            if row != last:
+                self.vectors[row] = self.vectors[last]
+                self.rowids[row] = self.rowids[last]
+                self.message_ids[row] = self.message_ids[last]
+            self.size = last
+        return len(rows)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def top_matches(similarities: np.ndarray, rowids: np.ndarray, message_ids: np.ndarray, threshold: float, limit: int,
+                exclude_ids: list[int] = None) -> list[tuple[int, float]]:
+    """
+    Picks the (rowid, similarity) pairs at or above `threshold` out of a batch of scored rows, most similar first.
+    """
+    keep = similarities >= threshold
+    # a similarity of 1 is the same message
+    keep &= similarities < 1 - 1e-6
+    if exclude_ids:
+        keep &= ~np.isin(message_ids, exclude_ids)
+
+    candidates = np.flatnonzero(keep)
+    if limit and len(candidates) > limit:
+        top = np.argpartition(-similarities[candidates], limit - 1)[:limit]
+        candidates = candidates[top]
+    candidates = candidates[np.argsort(-similarities[candidates], kind="stable")]
+    return [(int(rowids[i]), float(similarities[i])) for i in candidates]
+
+
+class EmbeddingIndex:
+    """
+    In-memory cosine similarity index over message embeddings, partitioned by channel.
+    Vectors are normalized on insert so a query is a single matrix-vector product.
+
+    Rows are identified by their message_embeddings ROWID, searches return (rowid, similarity) pairs.
+    """
+    persistent = False
+
+    def __init__(self):
+        self._channels: dict[int, _ChannelMatrix] = {}
+
+    def is_loaded(self, channel_id: int, dim: int) -> bool:
+        matrix = self._channels.get(channel_id)
+        return matrix is not None and matrix.dim == dim
+
+    def open(self, channel_id: int, dim: int) -> int:
+        """
+        Prepares an empty partition for the channel and returns the last rowid it already holds,
+        the caller then streams in every newer row with add_batch.
+        """
+        self._channels[channel_id] = _ChannelMatrix(dim)
+        return 0
+
+    def add_batch(self, channel_id: int, rowids: np.ndarray, message_ids: np.ndarray, vectors: np.ndarray):
+        matrix = self._channels.get(channel_id)
+        # unloaded channels pick the vectors up from the database when they are first searched
+        if matrix is None or matrix.dim != vectors.shape[-1]:
+            return
+        matrix.add(rowids, message_ids, normalize(vectors))
+
+    def add(self, channel_id: int, rowid: int, message_id: int, vector: np.ndarray):
+        self.add_batch(channel_id, np.array([rowid]), np.array([message_id]), np.asarray(vector)[np.newaxis])
+
+    def remove(self, channel_id: int, rowids: list[int]) -> int:
+        matrix = self._channels.get(channel_id)
+        return matrix.remove(rowids) if matrix else 0
+
+    def drop(self, channel_id: int = None):
+        if channel_id is None:
+            self._channels.clear()
+        else:
+            self._channels.pop(channel_id, None)
+
+    def __len__(self):
+        return sum(m.size for m in self._channels.values())
+
+    def close(self):
+        pass
+
+    def search(self, channel_id: int, embedding: np.ndarray, threshold: float = 0.0, limit: int = 0,
+               exclude_ids: list[int] = None) -> list[tuple[int, float]]:
+        """
+        Returns (rowid, similarity) pairs of the channel's embeddings at or above `threshold`, most similar first.
+        `limit` caps the result to the top-k (0 for all of them), `exclude_ids` drops rows by message id.
+        """
+        matrix = self._channels.get(channel_id)
+        if matrix is None or matrix.size == 0 or matrix.dim != len(embedding):
+            return []
+
+        similarities = matrix.vectors[:matrix.size] @ normalize(embedding)
+        return top_matches(similarities, matrix.rowids[:matrix.size], matrix.message_ids[:matrix.size],
+                           threshold, limit, exclude_ids)
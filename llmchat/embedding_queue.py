@@ -0,0 +1,199 @@
+import asyncio
+import itertools
+import time
+from typing import Awaitable, Callable
+
+import numpy as np
+
+from llmchat.logger import logger
+from llmchat.persistence import EMBEDDING_DTYPE
+
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_MAX_DELAY = 1.0
+DEFAULT_CONCURRENCY = 2
+DEFAULT_RETRIES = 3
+RETRY_BACKOFF = 1.0
+
+
+class _Entry:
+    __slots__ = ("message", "channel_id", "version", "future", "queued_at")
+
+    def __init__(self, message: tuple[int, str, int], channel_id: int, version: int, future: asyncio.Future):
+        self.message = message
+        self.channel_id = channel_id
+        self.version = version
+        self.future = future
+        self.queued_at = time.monotonic()
+
+
+class EmbeddingQueue:
+    """
+    Collects the messages waiting for an embedding and requests them in batches: a batch goes out once `batch_size`
+    texts are waiting or the oldest one has waited `max_delay` seconds. At most `concurrency` requests are in flight,
+    failed ones are retried with exponential backoff and every batch is written back with a single insert.
+    """
+
+    def __init__(self, db, embed: Callable[[list[str]], Awaitable[list[list[float]]]], model: str,
+                 batch_size: int = DEFAULT_BATCH_SIZE, max_delay: float = DEFAULT_MAX_DELAY,
+                 concurrency: int = DEFAULT_CONCURRENCY, retries: int = DEFAULT_RETRIES,
+                 retry_on: tuple[type[Exception], ...] = (Exception,)):
+        self.db = db
+        self.embed = embed
+        self.model = model
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.retries = retries
+        self.retry_on = retry_on
+        # keyed by message id, rows without one (speech) get a key of their own
+        self._pending: dict[object, _Entry] = {}
+        # newest version of every message that is queued or in flight, an edit makes the older text stale
+        self._versions: dict[int, int] = {}
+        # the newest future of every message that is queued or in flight
+        self._futures: dict[int, asyncio.Future] = {}
+        # someone is waiting on a queued embedding, send without waiting out max_delay
+        self._expedite = False
+        self._unkeyed = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._in_flight: set[asyncio.Task] = set()
+        self._worker: asyncio.Task = None
+
+    def submit(self, message: tuple[int, str, int], channel_id: int = None) -> asyncio.Future:
+        """
+        Queues `message` and returns a future that resolves to its embedding once it's stored.
+        """
+        future = asyncio.get_running_loop().create_future()
+        _, content, message_id = message
+        if not content.strip():
+            future.set_result(None)
+            return future
+
+        key = ("speech", next(self._unkeyed)) if message_id == -1 else message_id
+        version = 0
+        if message_id != -1:
+            version = self._versions[message_id] = self._versions.get(message_id, 0) + 1
+        entry = self._pending.get(key)
+        if entry is not None:
+            # edited before it was sent, only the new text is embedded
+            entry.message, entry.channel_id, entry.version = message, channel_id, version
+            return entry.future
+
+        # nobody has to wait on the result, don't warn about failures that were already logged
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._pending[key] = _Entry(message, channel_id, version, future)
+        if message_id != -1:
+            self._futures[message_id] = future
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        self._wakeup.set()
+        return future
+
+    async def get_embedding(self, message_id: int, timeout: float) -> np.ndarray or None:
+        """
+        The stored embedding of `message_id`. One that's still queued is sent right away and waited for at most
+        `timeout` seconds, None if it didn't make it in time.
+        """
+        future = self._futures.get(message_id)
+        if future is None:
+            return await self.db.query_embedding(message_id)
+        self._expedite = True
+        self._wakeup.set()
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            logger.warn(f"Embedding of message {message_id} wasn't ready within {timeout}s")
+        except Exception:
+            # already logged by the batch that failed
+            pass
+        return None
+
+    def _oldest_wait(self) -> float:
+        return time.monotonic() - next(iter(self._pending.values())).queued_at
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            remaining = self.max_delay - self._oldest_wait()
+            if len(self._pending) < self.batch_size and remaining > 0 and not self._expedite:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # texts keep piling up while every slot is busy, the next batch just gets bigger
+            await self._slots.acquire()
+            self._dispatch()
+
+    def _dispatch(self):
+        self._expedite = False
+        batch = []
+        for key in list(itertools.islice(self._pending, self.batch_size)):
+            batch.append(self._pending.pop(key))
+        task = asyncio.create_task(self._send(batch))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def _request(self, texts: list[str]) -> list[list[float]]:
+        for attempt in range(self.retries + 1):
+            try:
+                return await self.embed(texts)
+            except self.retry_on as e:
+                if attempt == self.retries:
+                    raise
+                delay = RETRY_BACKOFF * 2 ** attempt
+                logger.warn(f"Embedding request failed ({e}), retrying in {delay}s...")
+                await asyncio.sleep(delay)
+
+    def _current(self, entry: _Entry) -> bool:
+        message_id = entry.message[2]
+        return message_id == -1 or self._versions.get(message_id) == entry.version
+
+    def _forget(self, entry: _Entry):
+        message_id = entry.message[2]
+        if message_id != -1 and self._current(entry):
+            del self._versions[message_id]
+            del self._futures[message_id]
+
+    async def _send(self, batch: list[_Entry]):
+        try:
+            # identical texts are only embedded once
+            texts = list(dict.fromkeys(e.message[1] for e in batch))
+            embeddings = {text: np.asarray(embedding, dtype=EMBEDDING_DTYPE)
+                          for text, embedding in zip(texts, await self._request(texts))}
+
+            current = [e for e in batch if self._current(e)]
+            if current:
+                await self.db.add_embeddings([(e.message, embeddings[e.message[1]], e.channel_id) for e in current], self.model)
+            logger.debug(f"Stored {len(current)} embeddings in one request of {len(texts)} texts")
+            for e in batch:
+                if not e.future.done():
+                    # a stale text's future was replaced, nobody asks for it anymore
+                    e.future.set_result(embeddings[e.message[1]] if e in current else None)
+            for e in current:
+                self._forget(e)
+        except Exception as ex:
+            logger.error(f"Failed to embed {len(batch)} messages: {ex}")
+            for e in batch:
+                self._forget(e)
+                if not e.future.done():
+                    e.future.set_exception(ex)
+        finally:
+            self._slots.release()
+
+    async def close(self):
+        """
+        Sends whatever is still queued and waits for every request in flight.
+        """
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        while self._pending:
+            await self._slots.acquire()
+            self._dispatch()
+        await asyncio.gather(*self._in_flight, return_exceptions=True)
@@ -0,0 +1,23 @@
+from discord import Client
+from llmchat.config import Config
+
+
+class EmbeddingSource:
+    # errors a failed batch is retried for
+    retry_on: tuple[type[Exception], ...] = ()
+
+    def __init__(self, client: Client, config: Config):
+        self.config = config
+        self.client = client
+
+    # Returns one vector per text, in the same order
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        return NotImplementedError()
+
+    async def close(self):
+        pass
+
+    # Stored with every embedding
+    @property
+    def model(self) -> str:
+        return "Unknown"
@@ -0,0 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
+
+from . import EmbeddingSource
+from discord import Client
+from llmchat.config import Config
+from llmchat.logger import logger
+from sentence_transformers import SentenceTransformer
+import torch
+
+
+class LocalEmbeddings(EmbeddingSource):
+    """
+    Runs a sentence-transformers model on the CPU. Batches are encoded one after another on a thread of their own,
+    so a batch costs about the same every time and the event loop never waits on it.
+    """
+
+    def __init__(self, client: Client, config: Config):
+        super(LocalEmbeddings, self).__init__(client, config)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embeddings")
+        self._model: SentenceTransformer = None
+
+    def _encode(self, texts: list[str]) -> list:
+        if self._model is None:
+            logger.info(f"Loading embedding model {self.model}...")
+            if self.config.memory_local_embedding_threads:
+                torch.set_num_threads(self.config.memory_local_embedding_threads)
+            self._model = SentenceTransformer(self.model, device="cpu")
+        return list(self._model.encode(texts, batch_size=len(texts), convert_to_numpy=True))
+
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        return await self.client.loop.run_in_executor(self._executor, self._encode, texts)
+
+    async def close(self):
+        # a batch still being encoded is waited for off the event loop
+        await self.client.loop.run_in_executor(None, functools.partial(self._executor.shutdown, wait=True))
+        self._model = None
+
+    @property
+    def model(self) -> str:
+        return self.config.memory_local_embedding_model
@@ -0,0 +1,28 @@
+from . import EmbeddingSource
+from llmchat.rate_limiter import ENDPOINT_EMBEDDINGS, PRIORITY_BACKGROUND
+import openai
+import tiktoken
+
+
+class OpenAIEmbeddings(EmbeddingSource):
+    retry_on = (openai.error.APIConnectionError, openai.error.APIError, openai.error.RateLimitError,
+                openai.error.ServiceUnavailableError, openai.error.Timeout, openai.error.TryAgain)
+    encoding: tiktoken.Encoding = None
+
+    def count_tokens(self, texts: list[str]) -> int:
+        if self.encoding is None:
+            # every OpenAI embedding model since ada-002 uses it
+            self.encoding = tiktoken.get_encoding("cl100k_base")
+        return sum(len(tokens) for tokens in self.encoding.encode_ordinary_batch(texts))
+
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        openai.aiosession.set(self.client.http_session)
+        # the key is passed along since the selected LLM might not be OpenAI
+        response = await self.client.openai_limits.run(ENDPOINT_EMBEDDINGS, self.count_tokens(texts), lambda: openai.Embedding.acreate(
+            api_base=self.config.openai_reverse_proxy_url, api_key=self.config.openai_key, input=texts, model=self.model),
+            PRIORITY_BACKGROUND)
+        return [d["embedding"] for d in sorted(response["data"], key=lambda d: d["index"])]
+
+    @property
+    def model(self) -> str:
+        return self.config.openai_embedding_model
@@ -0,0 +1,19 @@
+import asyncio
+
+from . import EmbeddingSource
+import aiohttp
+
+
+class OllamaEmbeddings(EmbeddingSource):
+    retry_on = (aiohttp.ClientError, asyncio.TimeoutError)
+
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        async with self.client.http_session.post(f"{self.config.ollama_base_url.rstrip('/')}/api/embed",
+                                                 json={"model": self.model, "input": texts}) as response:
+            if response.status != 200:
+                raise Exception(f"Error communicating with Ollama: {response.status} {await response.text()}")
+            return (await response.json())["embeddings"]
+
+    @property
+    def model(self) -> str:
+        return self.config.ollama_embedding_model
@@ -0,0 +1,23 @@
+import aiohttp
+
+from llmchat.config import Config
+
+
+def create_session(config: Config, trace_configs: list[aiohttp.TraceConfig] = None) -> aiohttp.ClientSession:
+    """
+    The client-wide session every outbound HTTP request goes through. Connections are pooled and kept alive between
+    requests and DNS lookups are cached, so back to back calls to the same API skip the TCP and TLS handshakes.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=config.http_connection_limit,
+        limit_per_host=config.http_connection_limit_per_host,
+        ttl_dns_cache=config.http_dns_cache_ttl,
+        keepalive_timeout=config.http_keepalive_timeout,
+    )
+    # no total timeout, streamed responses and model loads can legitimately take minutes
+    timeout = aiohttp.ClientTimeout(
+        total=None,
+        sock_connect=config.http_connect_timeout,
+        sock_read=config.http_read_timeout or None,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=trace_configs)
@@ -0,0 +1,130 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+import discord
+
+from llmchat.logger import logger
+
+DEFAULT_MAX_SIZE = 1024
+DEFAULT_TTL = 600.0
+# invalidations remembered for changed_since, anyone further behind starts over
+CHANGE_LOG_SIZE = 256
+
+
+class IdentityCache:
+    """
+    Resolves message authors to their discord user and stored identity for context building.
+    Users come from the gateway cache when possible and only fall back to a REST fetch, results are kept in a
+    size-bounded LRU with a TTL. Misses of one lookup are fetched concurrently, concurrent lookups of the same
+    user share one fetch.
+    """
+
+    def __init__(self, client: discord.Client, db, max_size: int = DEFAULT_MAX_SIZE, ttl: float = DEFAULT_TTL):
+        self.client = client
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        # user_id -> (expires_at, user, identity)
+        self._entries: OrderedDict[int, tuple[float, discord.abc.User, tuple[str, str] or None]] = OrderedDict()
+        self._pending: dict[int, asyncio.Future] = {}
+        # bumped on invalidation so a fetch that was already in flight doesn't cache what it read
+        self._generation = 0
+        # (generation, user_id) of the latest invalidations, None for all users
+        self._changes: deque[tuple[int, int or None]] = deque(maxlen=CHANGE_LOG_SIZE)
+
+    def _cached(self, user_id: int):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return entry
+
+    async def _load(self, user_id: int):
+        generation = self._generation
+        identity = await self.db.get_identity(user_id)
+        user = self.client.get_user(user_id)
+        if user is None:
+            try:
+                user = await self.client.fetch_user(user_id)
+            except discord.HTTPException as e:
+                logger.warn(f"Unable to fetch user {user_id}: {e}")
+                user = discord.Object(user_id)
+        entry = (time.monotonic() + self.ttl, user, identity)
+        changed = self.changed_since(generation)
+        if changed is None or user_id in changed:
+            return entry
+        self._entries[user_id] = entry
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return entry
+
+    async def _get_entry(self, user_id: int):
+        entry = self._cached(user_id)
+        if entry is not None:
+            return entry
+
+        pending = self._pending.get(user_id)
+        if pending is None:
+            pending = asyncio.ensure_future(self._load(user_id))
+            self._pending[user_id] = pending
+            pending.add_done_callback(lambda f: self._pending.pop(user_id) if self._pending.get(user_id) is f else None)
+        return await asyncio.shield(pending)
+
+    async def get_many(self, user_ids) -> dict[int, tuple[discord.abc.User, tuple[str, str] or None]]:
+        """
+        Returns {user_id: (user, identity)} for every id, fetching all misses at once.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        entries = await asyncio.gather(*(self._get_entry(user_id) for user_id in user_ids))
+        return {user_id: (user, identity) for user_id, (_, user, identity) in zip(user_ids, entries)}
+
+    async def get_names(self, user_ids) -> dict[int, str]:
+        return {user_id: identity[0] if identity else getattr(user, "display_name", str(user_id))
+                for user_id, (user, identity) in (await self.get_many(user_ids)).items()}
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def changed_since(self, generation: int) -> set[int] or None:
+        """
+        The users invalidated after `generation`, None if that's everyone or too long ago to tell.
+        """
+        if generation == self._generation:
+            return set()
+        if not self._changes or self._changes[0][0] > generation + 1:
+            return None
+        changed = set()
+        for change, user_id in self._changes:
+            if change > generation:
+                if user_id is None:
+                    return None
+                changed.add(user_id)
+        return changed
+
+    async def get_user(self, user_id: int) -> discord.abc.User:
+        return (await self._get_entry(user_id))[1]
+
+    async def get_identity(self, user_id: int) -> tuple[str, str] or None:
+        return (await self._get_entry(user_id))[2]
+
+    async def get_name(self, user_id: int) -> str:
+        return (await self.get_names([user_id]))[user_id]
+
+    async def set_identity(self, user_id: int, name: str, identity: str):
+        await self.db.set_identity(user_id, name, identity)
+        self.invalidate(user_id)
+
+    def invalidate(self, user_id: int = None):
+        self._generation += 1
+        self._changes.append((self._generation, user_id))
+        if user_id is None:
+            self._entries.clear()
+            self._pending.clear()
+        else:
+            self._entries.pop(user_id, None)
+            self._pending.pop(user_id, None)
@@ -0,0 +1,111 @@
+import asyncio
+import itertools
+import queue
+import threading
+import time
+from typing import Any, Callable
+
+from llmchat.logger import logger
+
+# lower runs first, requests of the same priority run in the order they came in
+PRIORITY_REPLY = 0
+PRIORITY_BACKGROUND = 1
+
+
+class _Request:
+    __slots__ = ("fn", "future", "loop", "cancelled", "queued_at")
+
+    def __init__(self, fn: Callable[[threading.Event], Any], loop: asyncio.AbstractEventLoop):
+        self.fn = fn
+        self.future = loop.create_future()
+        self.loop = loop
+        self.cancelled = threading.Event()
+        self.queued_at = time.monotonic()
+
+
+class InferenceWorker:
+    """
+    A thread of its own that owns a model which must not be used from several threads at once. Requests wait in
+    a priority queue and are run one at a time, each gets a threading.Event that is set once whoever awaits it
+    is cancelled, so a long generation can stop early instead of holding up the ones queued behind it.
+    Requests nobody waits for anymore are skipped.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._queue: queue.PriorityQueue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._closed = False
+        # metrics, only written by the worker thread
+        self.served = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self._thread = threading.Thread(target=self._work, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self) -> int:
+        """
+        How many requests are waiting, not counting the one running.
+        """
+        return self._queue.qsize()
+
+    @property
+    def average_wait(self) -> float:
+        return self.total_wait / self.served if self.served else 0.0
+
+    async def run(self, fn: Callable[[threading.Event], Any], priority: int = PRIORITY_REPLY) -> Any:
+        """
+        Runs fn(cancelled) on the worker thread once every request queued before it at the same or a higher
+        priority is done, and returns what it returns.
+        """
+        if self._closed:
+            raise Exception(f"{self.name} is closed")
+        request = _Request(fn, asyncio.get_running_loop())
+        self._queue.put((priority, next(self._order), request))
+        try:
+            return await request.future
+        finally:
+            # queued ones are skipped, a running one sees it set
+            request.cancelled.set()
+
+    def _resolve(self, future: asyncio.Future, result, error: BaseException):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _work(self):
+        while True:
+            _, _, request = self._queue.get()
+            if request is None:
+                return
+            if request.cancelled.is_set():
+                continue
+
+            wait = time.monotonic() - request.queued_at
+            depth = self._queue.qsize()
+            self.served += 1
+            self.total_wait += wait
+            self.max_depth = max(self.max_depth, depth + 1)
+            logger.debug(f"{self.name}: request waited {wait:.2f}s, {depth} more queued")
+
+            result, error = None, None
+            try:
+                result = request.fn(request.cancelled)
+            except BaseException as e:
+                error = e
+            request.loop.call_soon_threadsafe(self._resolve, request.future, result, error)
+
+    async def close(self):
+        """
+        Lets the requests that are still waiting for their result finish, then stops the thread.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        # sorts after every request
+        self._queue.put((float("inf"), -1, None))
+        await asyncio.get_running_loop().run_in_executor(None, self._thread.join)
@@ -1,27 +1,68 @@
-from discord import User, Client, SelectOption
+from discord import User, Client, SelectOption, abc
 from llmchat.config import Config
-from llmchat.persistence import PersistentData
+from llmchat.context_assembler import ContextAssembler
+from llmchat.logger import logger
+from llmchat.persistence import AsyncPersistentData
 from datetime import datetime
+from typing import AsyncIterator
+
+SUMMARY_PROMPT = (
+    "You keep notes on a conversation {bot_name} takes part in, so it can be picked up again later.{nl}"
+    "Update the notes with the messages below. Keep names, facts, decisions, promises and open questions, leave out small talk. "
+    "Answer with the notes only, in at most {words} words.{nl}{nl}"
+    "Notes so far:{nl}{summary}{nl}{nl}"
+    "Messages:{nl}{transcript}"
+)
 
 class LLMSource:
-    def __init__(self, client: Client, config: Config, db: PersistentData):
+    # how {date} is filled in
+    date_format = "%A, %B %d, %Y %H:%M"
+
+    def __init__(self, client: Client, config: Config, db: AsyncPersistentData):
         self.config = config
         self.db = db
         self.client = client
+        self.context = ContextAssembler(client, self.render_message, self.count_tokens)
 
-    async def generate_response(self, invoker: User = None) -> str:
+    async def generate_response(self, invoker: User = None, channel: abc.Messageable = None) -> str:
         return NotImplementedError()
 
+    async def stream_response(self, invoker: User = None, channel: abc.Messageable = None) -> AsyncIterator[str]:
+        """
+        Yields the response piece by piece as it's generated. Sources that can't stream yield it in one piece.
+        """
+        yield await self.generate_response(invoker, channel)
+
     async def list_models(self) -> list[SelectOption]:
         return NotImplementedError()
 
+    async def complete(self, prompt: str, max_tokens: int) -> str:
+        """
+        A plain completion of `prompt` outside of any conversation, used for background work like summaries.
+        """
+        return NotImplementedError()
+
+    async def summarize(self, summary: str, transcript: str, max_tokens: int) -> str:
+        """
+        `summary` of the conversation so far updated with the messages in `transcript`.
+        """
+        prompt = SUMMARY_PROMPT.format(bot_name=self.config.bot_name, nl="\n", summary=summary or "(none yet)",
+                                       transcript=transcript, words=max_tokens * 3 // 4)
+        return (await self.complete(prompt, max_tokens)).strip()
+
     def set_model(self, model_id: str) -> None:
         return NotImplementedError()
 
-    def get_initial(self, invoker: User = None) -> str:
+    async def change_model(self, model_id: str) -> None:
+        """
+        Switches to `model_id` once it's ready, the current model keeps replying until then.
+        """
+        self.set_model(model_id)
+
+    async def get_initial(self, invoker: User = None) -> str:
         user_identity = ("User", None)
         if invoker:
-            fetched_identity = self.db.get_identity(invoker.id)
+            fetched_identity = await self.client.identities.get_identity(invoker.id)
             if not fetched_identity:
                 user_identity = (invoker.display_name, f"{invoker.display_name} is a human that has not set their identity. Remind them to set it using /your_identity!")
             else:
@@ -29,6 +70,73 @@ class LLMSource:
 
         return self._insert_wildcards(self.config.bot_initial_prompt, user_identity)
 
+    async def recall(self, recent_messages: list[tuple[int, str, int]], channel: abc.Messageable = None) -> list[tuple[tuple[int, str, int], float]]:
+        """
+        Older messages related to the last of `recent_messages`, as (message, score) pairs, best first.
+        """
+        mode = self.config.memory_recall
+        if not recent_messages or mode not in ("embedding", "keyword", "hybrid"):
+            return []
+
+        last_message = recent_messages[-1]
+        embedding = None
+        if mode != "keyword" and self.client.embeddings:
+            # the message may have only just been queued for embedding, don't hold the reply up for long
+            embedding = await self.client.embeddings.get_embedding(last_message[2], self.config.memory_recall_deadline)
+            if embedding is None:
+                logger.warn(f"Unable to find embedding for message {last_message[2]}")
+
+        # messages already in the context window don't need recalling
+        kwargs = dict(
+            threshold=self.config.openai_similarity_threshold,
+            channel_id=channel.id if channel else None,
+            limit=self.config.openai_max_similar_messages,
+            exclude_ids=[m[2] for m in recent_messages],
+        )
+        if mode == "embedding":
+            return await self.db.get_most_similar(embedding, **kwargs) if embedding is not None else []
+        return await self.db.search_hybrid(last_message[1], embedding if mode == "hybrid" else None,
+                                           semantic_weight=self.config.memory_hybrid_weight, **kwargs)
+
+    def render_message(self, author_id: int, content: str, name: str = None):
+        """
+        How a history row appears in the context, None leaves it out. `name` is only set for users.
+        """
+        if author_id == -1:
+            return None
+        return f"{name or self.config.bot_name}: {content}\n"
+
+    def render_summary(self, summary: str):
+        return f"[Earlier in this conversation: {summary}]\n"
+
+    def count_tokens(self, entries: list) -> list[int]:
+        # a rough 4 characters per token for backends without a tokenizer at hand
+        return [len(e) // 4 + 1 if isinstance(e, str) else len(e["content"]) // 4 + 5 for e in entries]
+
+    async def assemble_history(self, channel: abc.Messageable = None, budget: int = 0,
+                               recent_messages: list[tuple[int, str, int]] = None) -> tuple[list, list, int]:
+        """
+        The recalled and recent messages rendered by render_message and packed newest first into `budget` tokens,
+        each in chronological order, and the tokens they take up. The recent ones start with the channel's summary.
+        """
+        channel_id = channel.id if channel else None
+        if recent_messages is None:
+            recent_messages = await self.db.get_recent_messages(self.config.llm_context_messages_count, channel_id)
+        matches = await self.recall(recent_messages, channel)
+        if matches:
+            logger.debug("Bot will be reminded of:\n\t" + '\n\t'.join([f"{message[1]} ({round(score * 100)}%)" for message, score in matches]))
+
+        # the summary of what fell out of the window goes right before it
+        summary = []
+        if self.client.summarizer and channel_id is not None:
+            text = await self.client.summarizer.get(channel_id)
+            summary = [self.render_summary(text)] if text else []
+        summary_tokens = sum(self.count_tokens(summary)) if summary else 0
+        if summary_tokens > budget:
+            summary, summary_tokens = [], 0
+        recalled, recent, used = await self.context.pack(channel_id, recent_messages, [m for m, _ in matches], budget - summary_tokens)
+        return recalled, summary + recent, used + summary_tokens
+
     def _insert_wildcards(self, text: str, user_info: tuple = None) -> str:
         user_name, user_identity = user_info or (None, None)
         wildcards = {
@@ -36,7 +144,7 @@ class LLMSource:
             "bot_identity": self.config.bot_identity,
             "user_name": user_name,
             "user_identity": user_identity,
-            "date": datetime.now().strftime("%A, %B %d, %Y %H:%M"),
+            "date": datetime.now().strftime(self.date_format),
             "nl": "\n",
         }
 
@@ -46,6 +154,12 @@ class LLMSource:
 
         return text
 
+    async def close(self):
+        """
+        Releases what the source holds on to (sessions, loaded models) when it's replaced or the bot shuts down.
+        """
+        pass
+
     @property
     def is_openai(self) -> bool:
         return False
@@ -55,4 +169,5 @@ class LLMSource:
         return "Unknown LLM"
 
     def on_config_reloaded(self):
-        pass
\ No newline at end of file
+        # the bot's name or the prompt format may have changed
+        self.context.clear()
\ No newline at end of file
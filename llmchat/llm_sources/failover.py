@@ -0,0 +1,208 @@
+from . import LLMSource
+from llmchat.config import Config
+from llmchat.persistence import AsyncPersistentData
+from llmchat.logger import logger
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable
+import asyncio
+import discord
+import time
+
+# response times kept per backend for its percentile
+LATENCY_SAMPLES = 100
+
+
+class Backend:
+    """
+    One of the wrapped sources, with its recent response times and circuit breaker.
+    """
+
+    def __init__(self, name: str, source: LLMSource, config: Config):
+        self.name = name
+        self.source = source
+        self.config = config
+        self.latencies: deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self.failures = 0
+        self.open_until = 0.0
+
+    @property
+    def deadline(self) -> float:
+        return self.config.failover_deadline(self.name)
+
+    @property
+    def hedge_delay(self) -> float:
+        """
+        How long it may take before a hedged request goes to the next backend, its usual worst response time.
+        """
+        if len(self.latencies) < self.config.failover_hedge_min_samples:
+            return self.config.failover_hedge_after
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.config.failover_hedge_percentile / 100))]
+
+    def admit(self) -> bool:
+        now = time.monotonic()
+        if now < self.open_until:
+            return False
+        if self.failures >= self.config.failover_breaker_failures:
+            # half open: this request tries it, the others keep skipping it until its outcome closes or reopens the breaker
+            self.open_until = now + self.config.failover_breaker_cooldown
+        return True
+
+    def outlasted(self, latency: float):
+        """
+        A request that was dropped after `latency` seconds without an answer, it would have taken at least that long.
+        Leaving it out would only keep the fast answers and pull the percentile down.
+        """
+        self.latencies.append(latency)
+
+    def succeeded(self, latency: float):
+        self.latencies.append(latency)
+        if self.failures >= self.config.failover_breaker_failures:
+            logger.info(f"LLM backend {self.name} is answering again")
+        self.failures = 0
+        self.open_until = 0.0
+
+    def failed(self, error: BaseException):
+        self.failures += 1
+        logger.warn(f"LLM backend {self.name} failed ({self.failures} in a row): {str(error) or type(error).__name__}")
+        if self.failures >= self.config.failover_breaker_failures:
+            self.open_until = time.monotonic() + self.config.failover_breaker_cooldown
+            logger.warn(f"LLM backend {self.name} is skipped for {self.config.failover_breaker_cooldown}s")
+
+
+class FailoverLLM(LLMSource):
+    """
+    Answers with several LLM sources, in the order of [Failover] backends. Every request goes to the first
+    backend whose circuit breaker is closed. If it fails or runs past its deadline the next one is asked, and if
+    it's merely slower than its usual p95 response time the next one is asked as well (a hedged request) and
+    whichever answers first is used. Backends that fail breaker_failures times in a row are skipped for
+    breaker_cooldown seconds.
+    """
+
+    def __init__(self, client: discord.Client, config: Config, db: AsyncPersistentData):
+        super(FailoverLLM, self).__init__(client, config, db)
+        self.backends: list[Backend] = []
+        for name in config.failover_backends:
+            source = client.llm_source(name)
+            if source is None or source is FailoverLLM:
+                raise Exception(f"Unknown failover LLM backend: {name}")
+            self.backends.append(Backend(name, source(client, config, db), config))
+        if not self.backends:
+            raise Exception("No LLM backends set under [Failover]!")
+        logger.info(f"Failover across: {', '.join(b.name for b in self.backends)}")
+
+    @property
+    def primary(self) -> LLMSource:
+        return self.backends[0].source
+
+    async def _race(self, request: Callable[[LLMSource], Awaitable]):
+        """
+        The result of the first backend that answers `request` in time, see the class description.
+        """
+        candidates = list(self.backends)
+        running: dict[asyncio.Task, tuple[Backend, float]] = {}
+        errors = []
+
+        def take() -> Backend or None:
+            while candidates:
+                backend = candidates.pop(0)
+                if backend.admit():
+                    return backend
+            return None
+
+        def start(backend: Backend):
+            running[asyncio.create_task(request(backend.source))] = (backend, time.monotonic())
+
+        # with every breaker open the primary is tried anyway
+        first = take() or self.backends[0]
+        start(first)
+        hedge_at = time.monotonic() + first.hedge_delay
+        try:
+            while running:
+                now = time.monotonic()
+                wakeups = [started + backend.deadline for backend, started in running.values()]
+                if candidates:
+                    wakeups.append(hedge_at)
+                done, _ = await asyncio.wait(running, timeout=max(0.0, min(wakeups) - now), return_when=asyncio.FIRST_COMPLETED)
+
+                now = time.monotonic()
+                for task in done:
+                    backend, started = running.pop(task)
+                    if not task.cancelled() and task.exception() is None:
+                        backend.succeeded(now - started)
+                        for loser, started in running.values():
+                            # beaten by this one, its response time is still counted
+                            loser.outlasted(now - started)
+                        return task.result()
+                    error = asyncio.CancelledError() if task.cancelled() else task.exception()
+                    backend.failed(error)
+                    errors.append(f"{backend.name}: {error}")
+
+                for task, (backend, started) in list(running.items()):
+                    if now - started >= backend.deadline:
+                        task.cancel()
+                        del running[task]
+                        backend.outlasted(now - started)
+                        backend.failed(asyncio.TimeoutError(f"no answer within {backend.deadline}s"))
+                        errors.append(f"{backend.name}: timed out after {backend.deadline}s")
+
+                if candidates and (not running or now >= hedge_at):
+                    backend = take()
+                    if backend is None:
+                        continue
+                    if running:
+                        logger.debug(f"Hedging with {backend.name}, nothing back after {now - min(s for _, s in running.values()):.1f}s")
+                    start(backend)
+                    hedge_at = now + backend.hedge_delay
+        finally:
+            # also when the request itself is cancelled (a newer message superseded the reply), which says nothing
+            # about how fast the backends are
+            for task in running:
+                task.cancel()
+        raise Exception("Every LLM backend failed! " + "; ".join(errors))
+
+    async def generate_response(self, invoker: discord.User = None, channel: discord.abc.Messageable = None) -> str:
+        return await self._race(lambda source: source.generate_response(invoker, channel))
+
+    async def stream_response(self, invoker: discord.User = None, channel: discord.abc.Messageable = None) -> AsyncIterator[str]:
+        # the race is for the first piece, nothing is shown before it so the losers can still be dropped
+        async def first_piece(source: LLMSource):
+            stream = source.stream_response(invoker, channel)
+            try:
+                return stream, await stream.__anext__()
+            except BaseException:
+                await stream.aclose()
+                raise
+
+        stream, piece = await self._race(first_piece)
+        try:
+            yield piece
+            async for piece in stream:
+                yield piece
+        finally:
+            await stream.aclose()
+
+    async def complete(self, prompt: str, max_tokens: int) -> str:
+        return await self._race(lambda source: source.complete(prompt, max_tokens))
+
+    async def list_models(self) -> list[discord.SelectOption]:
+        return await self.primary.list_models()
+
+    def set_model(self, model_id: str) -> None:
+        self.primary.set_model(model_id)
+
+    async def change_model(self, model_id: str) -> None:
+        await self.primary.change_model(model_id)
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.source.close()
+
+    def on_config_reloaded(self):
+        super(FailoverLLM, self).on_config_reloaded()
+        for backend in self.backends:
+            backend.source.on_config_reloaded()
+
+    @property
+    def current_model_name(self) -> str:
+        return " → ".join(b.source.current_model_name for b in self.backends)
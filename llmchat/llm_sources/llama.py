@@ -1,17 +1,40 @@
 from . import LLMSource
 from llmchat.config import Config
-from llmchat.persistence import PersistentData
+from llmchat.persistence import AsyncPersistentData
+from llmchat.inference_worker import InferenceWorker, PRIORITY_BACKGROUND
 from llmchat.logger import logger
+import asyncio
 import discord
+import gc
 import os
 from langchain.llms import LlamaCpp
+from llama_cpp import Llama, LlamaDiskCache, LlamaRAMCache
 import functools
+import threading
 import time
 
+# room left for the reply when max_tokens isn't set
+DEFAULT_MAX_TOKENS = 256
+
+
+def _row_key(row: tuple[int, str, int]) -> int or tuple[int, str, int]:
+    # speech rows all have a message id of -1, they can only be told apart by who said what
+    return row[2] if row[2] != -1 else row
+
 class LLaMA(LLMSource):
     model: LlamaCpp = None
-    def __init__(self, client: discord.Client, config: Config, db: PersistentData):
+    # the model's vocabulary alone, prompts are measured on the event loop while the worker thread uses the model
+    tokenizer: Llama = None
+    # a {date} down to the minute would change the start of every prompt once a minute
+    date_format = "%A, %B %d, %Y"
+
+    def __init__(self, client: discord.Client, config: Config, db: AsyncPersistentData):
         super(LLaMA, self).__init__(client, config, db)
+        # key of the row each channel's history window currently starts at
+        self._window_starts: dict[int, int or tuple[int, str, int]] = {}
+        # llama.cpp's context can only evaluate one prompt at a time, every use of the model goes through this thread
+        self.worker = InferenceWorker("llama-inference")
+        self._loading = asyncio.Lock()
         self.load_model()
 
     def load_model(self):
@@ -21,21 +44,59 @@ class LLaMA(LLMSource):
             )
             return
 
-        model_path = os.path.join(
-            self.config.llama_search_path, self.config.llama_model_name
-        )
-        if not os.path.exists(model_path):
-            logger.warn("LLaMA model", model_path, "doesn't exist!")
+        try:
+            self.model = self._load(self.config.llama_model_name)
+            self.tokenizer = self._load_tokenizer(self.config.llama_model_name)
+        except Exception as e:
+            logger.warn(str(e))
             return
+        # token counts are the new model's now
+        self.context.clear()
+
+    def _load(self, model_name: str) -> LlamaCpp:
+        model_path = os.path.join(self.config.llama_search_path, model_name)
+        if not os.path.exists(model_path):
+            raise Exception(f"LLaMA model {model_path} doesn't exist!")
 
-        self.model = LlamaCpp(
+        model = LlamaCpp(
             model_path=model_path,
-            n_ctx=2048,
-            max_tokens=self.config.llm_max_tokens or 256,
+            n_ctx=self.config.llama_n_ctx,
+            # None lets llama.cpp pick
+            n_threads=self.config.llama_n_threads or None,
+            n_batch=self.config.llama_n_batch,
+            use_mmap=self.config.llama_use_mmap,
+            use_mlock=self.config.llama_use_mlock,
+            max_tokens=self.config.llm_max_tokens or DEFAULT_MAX_TOKENS,
             temperature=self.config.llm_temperature,
             repeat_penalty=self.config.llm_frequency_penalty,  # ~1.1 is a good value
         )
         # f16_kv is half precision, n_ctx is context window
+        self._set_prompt_cache(model, model_name)
+        return model
+
+    def _load_tokenizer(self, model_name: str) -> Llama:
+        return Llama(model_path=os.path.join(self.config.llama_search_path, model_name), vocab_only=True, verbose=False)
+
+    @staticmethod
+    def _release(model: LlamaCpp):
+        # frees the weights and the context right away instead of whenever the last reference is collected
+        close = getattr(model.client, "close", None)
+        if close:
+            close()
+        gc.collect()
+
+    def _set_prompt_cache(self, model: LlamaCpp, model_name: str):
+        # llama.cpp looks up the longest cached prefix of each prompt and only evaluates the tokens after it
+        capacity = self.config.llama_prompt_cache_size << 20
+        if self.config.llama_prompt_cache == "ram":
+            cache = LlamaRAMCache(capacity_bytes=capacity)
+        elif self.config.llama_prompt_cache == "disk":
+            # saved states only fit the model that evaluated them
+            cache_dir = os.path.join(self.config.llama_prompt_cache_path, model_name)
+            cache = LlamaDiskCache(cache_dir=cache_dir, capacity_bytes=capacity)
+        else:
+            return
+        model.client.set_cache(cache)
 
     async def list_models(self) -> list[discord.SelectOption]:
         return [discord.SelectOption(label=f, value=f, default=self.config.llama_model_name == f) for f in os.listdir(self.config.llama_search_path)]
@@ -44,35 +105,68 @@ class LLaMA(LLMSource):
         self.config.llama_model_name = model_id
         self.load_model()
 
-    async def get_context(self, invoker: discord.User = None):
-        context = self.get_initial(invoker).strip() + "\n"
-
-        for i in self.db.get_recent_messages(self.config.llm_context_messages_count):
-            author_id, content, message_id = i
-            if author_id == -1:
-                continue
-            elif author_id == self.client.user.id:
-                context += f"{self.config.bot_name}: {content}"
-            else:
-                name = (await self.client.fetch_user(author_id)).display_name
-                identity = self.db.get_identity(author_id)
-                if identity is not None:
-                    name_, identity = identity
-                    name = name_
-
-                context += f"{name}: {content}"
-            context += "\n"
-
-        if self.config.bot_reminder:
-            context += f"Reminder: {self._insert_wildcards(self.config.bot_reminder, self.db.get_identity(invoker.id))}\n"
-
-        context += f"{self.config.bot_name}: "
-        return context
-
-    def _generate(self, context: str) -> str:
+    async def change_model(self, model_id: str) -> None:
+        async with self._loading:
+            # loaded on a thread of its own, the current model keeps replying in the meantime
+            model = await self.client.loop.run_in_executor(None, self._load, model_id)
+            tokenizer = await self.client.loop.run_in_executor(None, self._load_tokenizer, model_id)
+
+            def swap(cancelled: threading.Event) -> LlamaCpp:
+                old, self.model = self.model, model
+                return old
+
+            # between two requests, the ones queued after it get the new model
+            old = await self.worker.run(swap)
+            self.tokenizer = tokenizer
+            self.config.llama_model_name = model_id
+            self._window_starts.clear()
+            self.context.clear()
+            if old is not None:
+                await self.worker.run(lambda cancelled: self._release(old), PRIORITY_BACKGROUND)
+
+    def _window(self, channel_id: int, rows: list[tuple[int, str, int]]) -> list[tuple[int, str, int]]:
+        """
+        The newest rows that go into the prompt. The window's start only moves once it's context_step messages
+        behind, so consecutive prompts begin the same way and the cached evaluation can be reused.
+        """
+        count = self.config.llm_context_messages_count
+        start = self._window_starts.get(channel_id)
+        if start is not None:
+            keys = [_row_key(r) for r in rows]
+            if start in keys:
+                # the last match, an identical speech row further back must not stretch the window
+                index = len(keys) - 1 - keys[::-1].index(start)
+                if len(rows) - index <= count + self.config.llama_context_step:
+                    return rows[index:]
+        rows = rows[-count:]
+        if rows:
+            self._window_starts[channel_id] = _row_key(rows[0])
+        return rows
+
+    def count_tokens(self, entries: list[str]) -> list[int]:
+        return [len(self.tokenizer.tokenize(e.encode("utf-8"), add_bos=False)) for e in entries]
+
+    async def get_context(self, invoker: discord.User = None, channel: discord.abc.Messageable = None):
+        context = (await self.get_initial(invoker)).strip() + "\n"
+        reminder = f"Reminder: {self._insert_wildcards(self.config.bot_reminder, await self.client.identities.get_identity(invoker.id))}\n" if self.config.bot_reminder else ""
+        end = reminder + f"{self.config.bot_name}: "
+
+        channel_id = channel.id if channel else None
+        recent_messages = self._window(channel_id, await self.db.get_recent_messages(
+            self.config.llm_context_messages_count + self.config.llama_context_step, channel_id))
+        budget = self.config.llama_n_ctx - (self.config.llm_max_tokens or DEFAULT_MAX_TOKENS) - sum(self.count_tokens([context, end]))
+        similar_messages, recent_messages, _ = await self.assemble_history(channel, max(0, budget), recent_messages)
+        # recalled messages change from reply to reply, they go after the history so they don't break up the cached prefix
+        return context + "".join(recent_messages + similar_messages) + end
+
+    def _generate(self, context: str, cancelled: threading.Event) -> str:
         ret = ""
         start_time = time.time()
         for chunk in self.model.stream(context, stop=["\n"]):
+            if cancelled.is_set():
+                # nobody waits for it anymore, free the worker for the next request
+                logger.debug(f"Generation cancelled after {time.time() - start_time}s")
+                return ret
             ret += chunk["choices"][0]["text"]
             logger.debug(ret)
 
@@ -81,16 +175,35 @@ class LLaMA(LLMSource):
             raise Exception("LLM generated an empty message!")
         return ret
 
-    async def generate_response(self, invoker: discord.User = None) -> str:
+    async def generate_response(self, invoker: discord.User = None, channel: discord.abc.Messageable = None) -> str:
         if self.model is None:
             raise Exception("Model not yet loaded! Use /model to load one.")
 
-        context = await self.get_context(invoker)
+        context = await self.get_context(invoker, channel)
         logger.debug(context)
 
-        blocking = functools.partial(self._generate, context)
-        return await self.client.loop.run_in_executor(None, blocking)
+        return await self.worker.run(functools.partial(self._generate, context))
+
+    def _complete(self, prompt: str, max_tokens: int, cancelled: threading.Event) -> str:
+        text = ""
+        for chunk in self.model.client(prompt, max_tokens=max_tokens, temperature=0, stream=True):
+            if cancelled.is_set():
+                break
+            text += chunk["choices"][0]["text"]
+        return text
 
+    async def complete(self, prompt: str, max_tokens: int) -> str:
+        if self.model is None:
+            raise Exception("Model not yet loaded! Use /model to load one.")
+        # replies go first
+        return await self.worker.run(functools.partial(self._complete, prompt, max_tokens), PRIORITY_BACKGROUND)
+
+    async def close(self):
+        await self.worker.close()
+        if self.model is not None:
+            self._release(self.model)
+            self.model = None
+            self.tokenizer = None
 
     @property
     def current_model_name(self) -> str:
@@ -1,12 +1,13 @@
 from . import LLMSource
 from llmchat.config import Config
-from llmchat.persistence import PersistentData
+from llmchat.persistence import AsyncPersistentData
 from llmchat.logger import logger
+from llmchat.rate_limiter import ENDPOINT_COMPLETIONS, PRIORITY_BACKGROUND, PRIORITY_REPLY
+from llmchat.token_counter import TokenCounter
 import discord
 import openai
-from aiohttp import ClientSession
 import tiktoken
-from typing import Union
+from typing import AsyncIterator, Union
 
 GPT_3_MAX_TOKENS = 2048
 GPT_4_MAX_TOKENS = 8192
@@ -14,7 +15,9 @@ GPT_4_32K_MAX_TOKENS = 32768
 
 class OpenAI(LLMSource):
     encoding: tiktoken.Encoding = None
-    def __init__(self, client: discord.Client, config: Config, db: PersistentData):
+    tokens: TokenCounter = None
+    encoding_model: str = None
+    def __init__(self, client: discord.Client, config: Config, db: AsyncPersistentData):
         super(OpenAI, self).__init__(client, config, db)
         self.update_encoding()
         self.on_config_reloaded()
@@ -29,20 +32,20 @@ class OpenAI(LLMSource):
             )
 
     def on_config_reloaded(self):
+        super(OpenAI, self).on_config_reloaded()
         openai.api_key = self.config.openai_key
 
     async def list_models(self) -> list[discord.SelectOption]:
-        async with ClientSession() as c:
-            openai.aiosession.set(c)
-            # fix api requestor error
-            all_models = openai.Model.list(api_base=self.config.openai_reverse_proxy_url)
-            ret = [
-                m.id
-                for m in all_models.data
-                if not ("-search-" in m.id or "-similarity-" in m.id)
-            ]
-            ret.sort()
-            return [discord.SelectOption(label=m, value=m, default=self.config.openai_model == m) for m in ret]
+        openai.aiosession.set(self.client.http_session)
+        # fix api requestor error
+        all_models = await openai.Model.alist(api_base=self.config.openai_reverse_proxy_url)
+        ret = [
+            m.id
+            for m in all_models.data
+            if not ("-search-" in m.id or "-similarity-" in m.id)
+        ]
+        ret.sort()
+        return [discord.SelectOption(label=m, value=m, default=self.config.openai_model == m) for m in ret]
 
     def set_model(self, model_id: str) -> None:
         logger.info(f"OpenAI model set to {model_id}")
@@ -61,19 +64,48 @@ class OpenAI(LLMSource):
     def update_encoding(self):
         encoder_name = self.config.openai_model
 
-        if not self.encoding or self.encoding.name != encoder_name:
+        # encoding.name is the encoding's own name (e.g. cl100k_base), compare against the model it was picked for
+        if not self.encoding or self.encoding_model != encoder_name:
             logger.debug(f"Updating tokenizer encoding for {self.config.openai_model}")
             try:
-                self.encoding = tiktoken.encoding_for_model(encoder_name)
+                encoding = tiktoken.encoding_for_model(encoder_name)
             except KeyError as e:
                 logger.debug(f"Failed to get encoder for OpenAI model: {self.config.openai_model}. Using default (cl100k_base)")
-                self.encoding = tiktoken.get_encoding("cl100k_base")
+                encoding = tiktoken.get_encoding("cl100k_base")
+            self.encoding_model = encoder_name
+            # switching between completion and chat models also changes how messages are rendered
+            self.context.clear()
+            # counts stay valid across models sharing an encoding
+            if not self.encoding or self.encoding.name != encoding.name:
+                self.encoding = encoding
+                self.tokens = TokenCounter(encoding)
+
+    def render_message(self, author_id: int, content: str, name: str = None):
+        if not self.use_chat_completion:
+            return super(OpenAI, self).render_message(author_id, content, name)
+        role = "user"
+        if author_id == -1:
+            role = "system"
+        elif author_id == self.client.user.id:
+            role = "assistant"
+        return {"role": role, "content": content}
+
+    def render_summary(self, summary: str):
+        if not self.use_chat_completion:
+            return super(OpenAI, self).render_summary(summary)
+        return {"role": "system", "content": f"Earlier in this conversation: {summary}"}
+
+    def count_tokens(self, entries: list) -> list[int]:
+        if not entries or isinstance(entries[0], str):
+            return self.tokens.count_many(entries)
+        # every message follows <im_start>{role/name}\n{content}<im_end>\n
+        return [count + self.tokens.count(e["role"]) + 4 for count, e in zip(self.tokens.count_many([e["content"] for e in entries]), entries)]
 
     def get_token_count(self, content: Union[str, list[dict], dict]) -> int:
         if isinstance(content, str):
             # <= gpt3
             content: str = content
-            return len(self.encoding.encode(content))
+            return self.tokens.count(content)
         elif isinstance(content, dict):
             return self.get_token_count(content["content"]) + self.get_token_count(content["role"]) + 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
         elif isinstance(content, list):
@@ -87,195 +119,153 @@ class OpenAI(LLMSource):
             # wtf
             raise Exception(f"Can't get token count of unhandled type {type(content).__name__}")
 
+    async def _completion_request(self, invoker: discord.User = None, channel: discord.abc.Messageable = None) -> tuple[dict, int]:
+        """
+        Builds the context and fits the completion into what's left of the model's token budget. Returns the request
+        and the tokens it counts against the rate limit, its prompt and the most it may answer with.
+        """
+        if not self.use_chat_completion:
+            completion_tokens = 400 if self.config.llm_max_tokens == 0 else self.config.llm_max_tokens
+            prompt, token_count = await self.get_context_gpt3(invoker, channel, completion_tokens)
+
+            if token_count + completion_tokens > GPT_3_MAX_TOKENS:
+                completion_tokens = GPT_3_MAX_TOKENS - token_count
+                if completion_tokens < 0:
+                    raise Exception(f"Token limit exceeded! ({token_count} > {GPT_3_MAX_TOKENS}) Please make your initial context shorter or reduce the message context count!")
+
+            return dict(prompt=prompt, stop="\n", max_tokens=completion_tokens), token_count + completion_tokens
+        else:
+            completion_tokens = self.config.llm_max_tokens
+            messages, token_count = await self.get_context_gpt4(invoker, channel, completion_tokens)
+            model_max_tokens = GPT_4_MAX_TOKENS if "32k" not in self.config.openai_model else GPT_4_32K_MAX_TOKENS
+
+            if token_count + completion_tokens > model_max_tokens:
+                completion_tokens = model_max_tokens - token_count
+                if completion_tokens < 0:
+                    raise Exception(f"Token limit exceeded! ({token_count} > {model_max_tokens}) Please make your initial context shorter or reduce the message context count!")
+
+            return dict(messages=messages, max_tokens=None if completion_tokens == 0 else completion_tokens), token_count + completion_tokens
+
+    async def _create_completion(self, request: dict, tokens: int, stream: bool = False):
+        create = openai.ChatCompletion.acreate if self.use_chat_completion else openai.Completion.acreate
+        return await self.client.openai_limits.run(ENDPOINT_COMPLETIONS, tokens, lambda: create(
+            api_base=self.config.openai_reverse_proxy_url,
+            model=self.config.openai_model,
+            temperature=self.config.llm_temperature,
+            presence_penalty=self.config.llm_presence_penalty,
+            frequency_penalty=self.config.llm_frequency_penalty,
+            request_timeout=self.config.openai_request_timeout,
+            stream=stream,
+            **request,
+        ), PRIORITY_REPLY)
+
+    async def complete(self, prompt: str, max_tokens: int) -> str:
+        openai.aiosession.set(self.client.http_session)
+        kwargs = dict(api_base=self.config.openai_reverse_proxy_url, model=self.config.openai_model, temperature=0, max_tokens=max_tokens,
+                      request_timeout=self.config.openai_request_timeout)
+        # summaries and the like, replies go first
+        limits = self.client.openai_limits
+        if self.use_chat_completion:
+            messages = [{"role": "user", "content": prompt}]
+            # +2 for the assistant's reply being primed
+            tokens = self.count_tokens(messages)[0] + 2 + max_tokens
+            response = await limits.run(ENDPOINT_COMPLETIONS, tokens, lambda: openai.ChatCompletion.acreate(messages=messages, **kwargs),
+                                        PRIORITY_BACKGROUND)
+            return response.choices[0].message.content
+        tokens = self.tokens.count(prompt) + max_tokens
+        response = await limits.run(ENDPOINT_COMPLETIONS, tokens, lambda: openai.Completion.acreate(prompt=prompt, **kwargs),
+                                    PRIORITY_BACKGROUND)
+        return response.choices[0].text
+
     async def generate_response(
-        self, invoker: discord.User = None, _retry_count=0
+        self, invoker: discord.User = None, channel: discord.abc.Messageable = None, _retry_count=0
     ) -> str:
-        async with ClientSession() as s:
-            openai.aiosession.set(s)
+        openai.aiosession.set(self.client.http_session)
 
-            try:
-                if not self.use_chat_completion:
-                    completion_tokens = 400 if self.config.llm_max_tokens == 0 else self.config.llm_max_tokens
-                    prompt = await self.get_context_gpt3(invoker)
-                    token_count = self.get_token_count(prompt)
-
-                    if token_count + completion_tokens > GPT_3_MAX_TOKENS:
-                        completion_tokens = GPT_3_MAX_TOKENS - token_count
-                        if completion_tokens < 0:
-                            raise Exception(f"Token limit exceeded! ({token_count} > {GPT_3_MAX_TOKENS}) Please make your initial context shorter or reduce the message context count!")
-
-                    response = await openai.Completion.acreate(
-                        api_base=self.config.openai_reverse_proxy_url,
-                        model=self.config.openai_model,
-                        prompt=prompt,
-                        stop="\n",
-                        max_tokens=completion_tokens,
-                        temperature=self.config.llm_temperature,
-                        presence_penalty=self.config.llm_presence_penalty,
-                        frequency_penalty=self.config.llm_frequency_penalty,
-                    )
-                    logger.debug(f"{response.usage.total_tokens} tokens used")
-                    response = response.choices[0].text.strip()
-                else:
-                    completion_tokens = self.config.llm_max_tokens
-                    messages = self.get_context_gpt4(invoker)
-                    token_count = self.get_token_count(messages)
-                    model_max_tokens = GPT_4_MAX_TOKENS if "32k" not in self.config.openai_model else GPT_4_32K_MAX_TOKENS
-
-                    if token_count + completion_tokens > model_max_tokens:
-                        completion_tokens = model_max_tokens - token_count
-                        if completion_tokens < 0:
-                            raise Exception(f"Token limit exceeded! ({token_count} > {model_max_tokens}) Please make your initial context shorter or reduce the message context count!")
-
-                    response = await openai.ChatCompletion.acreate(
-                        api_base=self.config.openai_reverse_proxy_url,
-                        model=self.config.openai_model,
-                        max_tokens=None
-                        if completion_tokens == 0
-                        else completion_tokens,
-                        messages=messages,
-                        temperature=self.config.llm_temperature,
-                        presence_penalty=self.config.llm_presence_penalty,
-                        frequency_penalty=self.config.llm_frequency_penalty,
-                    )
-                    logger.debug(f"{response.usage.total_tokens} tokens used")
-                    response = response.choices[0].message.content.strip()
-
-                if not response:
-                    raise Exception("Response from OpenAI API was empty!")
-                return response
-            except openai.error.APIConnectionError as e:
-                # https://github.com/openai/openai-python/issues/371
-                if _retry_count == 3:
-                    raise e
-                logger.warn(f"Connection reset error, Retrying ({_retry_count})...")
-                return await self.generate_response(_retry_count=_retry_count + 1)
-
-    async def get_context_gpt3(self, invoker: discord.User = None) -> str:
+        try:
+            response = await self._create_completion(*await self._completion_request(invoker, channel))
+            logger.debug(f"{response.usage.total_tokens} tokens used")
+            if not self.use_chat_completion:
+                response = response.choices[0].text.strip()
+            else:
+                response = response.choices[0].message.content.strip()
+
+            if not response:
+                raise Exception("Response from OpenAI API was empty!")
+            return response
+        except openai.error.APIConnectionError as e:
+            # https://github.com/openai/openai-python/issues/371
+            if _retry_count == 3:
+                raise e
+            logger.warn(f"Connection reset error, Retrying ({_retry_count})...")
+            return await self.generate_response(invoker, channel, _retry_count=_retry_count + 1)
+
+    async def stream_response(
+        self, invoker: discord.User = None, channel: discord.abc.Messageable = None, _retry_count=0
+    ) -> AsyncIterator[str]:
+        openai.aiosession.set(self.client.http_session)
+
+        request, tokens = await self._completion_request(invoker, channel)
+        streamed = False
+        try:
+            async for chunk in await self._create_completion(request, tokens, stream=True):
+                choice = chunk.choices[0]
+                piece = choice.delta.get("content") if self.use_chat_completion else choice.get("text")
+                if piece:
+                    streamed = True
+                    yield piece
+        except openai.error.APIConnectionError as e:
+            # once text was shown a retry would repeat it, only a connection that failed up front is retried
+            if streamed or _retry_count == 3:
+                raise e
+            logger.warn(f"Connection reset error, Retrying ({_retry_count})...")
+            async for piece in self.stream_response(invoker, channel, _retry_count=_retry_count + 1):
+                yield piece
+            return
+
+        if not streamed:
+            raise Exception("Response from OpenAI API was empty!")
+
+    async def get_context_gpt3(self, invoker: discord.User = None, channel: discord.abc.Messageable = None,
+                               completion_tokens: int = 0) -> tuple[str, int]:
         self.update_encoding()
-        context = self.get_initial(invoker).strip() + "\n"
-        reminder = f"Reminder: {self._insert_wildcards(self.config.bot_reminder, self.db.get_identity(invoker.id))}\n" if self.config.bot_reminder else ""
+        context = (await self.get_initial(invoker)).strip() + "\n"
+        reminder = f"Reminder: {self._insert_wildcards(self.config.bot_reminder, await self.client.identities.get_identity(invoker.id))}\n" if self.config.bot_reminder else ""
         end = reminder + f"{self.config.bot_name}: "
 
-        min_token_count = self.get_token_count(context + end)
-        cur_token_count = min_token_count
-
-        if cur_token_count > GPT_3_MAX_TOKENS:
-            raise Exception(f"Please shorten your reminder / initial prompt. Max token count exceeded: {cur_token_count} > {GPT_3_MAX_TOKENS}")
-
-        all_messages = self.db.get_recent_messages()
-        recent_messages = all_messages[-self.config.llm_context_messages_count:]
-        ooc_messages = all_messages[:-self.config.llm_context_messages_count]  # everything but the messages in the context limit
-
-        similar_messages = []
-        if self.config.openai_use_embeddings and ooc_messages:
-            similar_matches = self.similar_messages(recent_messages[-1], ooc_messages)
-            if similar_matches:
-                logger.debug("Bot will be reminded of:\n\t" + '\n\t'.join([f"{message[1]} ({round(similarity * 100)}% similar)" for message, similarity in similar_matches]))
-                # sort by message_id
-                messages, similarities = list(zip(*similar_matches))
-                similar_messages = list(messages)
-                similar_messages.sort(key=lambda m: m[2])
-
-        for i in similar_messages+recent_messages:
-            fmt_message = ""
-            author_id, content, message_id = i
-            if author_id == -1:
-                continue
-            elif author_id == self.client.user.id:
-                fmt_message += f"{self.config.bot_name}: {content}"
-            else:
-                name = (await self.client.fetch_user(author_id)).display_name
-                identity = self.db.get_identity(author_id)
-                if identity is not None:
-                    name_, identity = identity
-                    name = name_
-
-                fmt_message += f"{name}: {content}"
-            fmt_message += "\n"
-            token_count = self.get_token_count(fmt_message)
-            if cur_token_count + token_count > GPT_3_MAX_TOKENS:
-                logger.warn(f"Maximum token count reached ({cur_token_count} + {token_count} > {GPT_3_MAX_TOKENS}). Context will be shorter than expected.")
-                break
-            else:
-                context += fmt_message
-                cur_token_count += token_count
+        token_count = self.tokens.count(context + end)
+        if token_count > GPT_3_MAX_TOKENS:
+            raise Exception(f"Please shorten your reminder / initial prompt. Max token count exceeded: {token_count} > {GPT_3_MAX_TOKENS}")
+
+        similar_messages, recent_messages, history_tokens = await self.assemble_history(
+            channel, max(0, GPT_3_MAX_TOKENS - completion_tokens - token_count))
+        context += "".join(similar_messages + recent_messages) + end
+        token_count += history_tokens
 
-        context += end
-        logger.debug(f"Calculated prompt token count: {cur_token_count}")
+        logger.debug(f"Calculated prompt token count: {token_count}")
         logger.debug(f"Context: {context}")
-        return context
-
-    def similar_messages(self, last_message, messages_pool):
-        similar_matches = []
-        similarity_threshold = self.config.openai_similarity_threshold  # messages with a similarity rating equal to or above this number will be included in the reminder.
-        # get embedding for last message
-        last_message_embedding = self.db.query_embedding(last_message[2])
-        if last_message_embedding:
-            similar_matches = self.db.get_most_similar(last_message_embedding, threshold=similarity_threshold, messages_pool=messages_pool)[:self.config.openai_max_similar_messages]
-        else:
-            logger.warn("Unable to find embedding for message " + last_message[2])
-        return similar_matches
+        return context, token_count
 
-    def get_context_gpt4(self, invoker: discord.User = None) -> list[dict]:
+    async def get_context_gpt4(self, invoker: discord.User = None, channel: discord.abc.Messageable = None,
+                               completion_tokens: int = 0) -> tuple[list[dict], int]:
         self.update_encoding()
-        initial = self.get_initial(invoker)
-        reminder = f"Reminder: {self._insert_wildcards(self.config.bot_reminder, self.db.get_identity(invoker.id))}" if self.config.bot_reminder else ""
-
-        min_token_count = self.get_token_count(initial) + 4 + (self.get_token_count(reminder) + 4 if reminder else 0)
+        initial = {"role": "system", "content": await self.get_initial(invoker)}
+        reminder = [{"role": "system", "content": f"Reminder: {self._insert_wildcards(self.config.bot_reminder, await self.client.identities.get_identity(invoker.id))}"}] if self.config.bot_reminder else []
         max_token_count = GPT_4_MAX_TOKENS if "32k" not in self.config.openai_model else GPT_4_32K_MAX_TOKENS
-        cur_token_count = min_token_count
-
-        if cur_token_count > max_token_count:
-            raise Exception(f"Please shorten your reminder / initial prompt. Max token count exceeded: {cur_token_count} > {max_token_count}")
-
-        ret = []
-
-        def format_message(message):
-            author_id, content, mid = message
-            role = "user"
-            if author_id == -1:
-                role = "system"
-            elif author_id == self.client.user.id:
-                role = "assistant"
-
-            return {"role": role, "content": content}
-
-        all_messages = self.db.get_recent_messages()
-        recent_messages = all_messages[-self.config.llm_context_messages_count:]
-        ooc_messages = all_messages[:-self.config.llm_context_messages_count]  # everything but the messages in the context limit
-
-        similar_messages = []
-        if self.config.openai_use_embeddings and ooc_messages:
-            similar_matches = self.similar_messages(recent_messages[-1], ooc_messages)
-            if similar_matches:
-                logger.debug("Bot will be reminded of:\n\t"+'\n\t'.join([f"{message[1]} ({round(similarity * 100)}% similar)" for message, similarity in similar_matches]))
-                # sort by message_id
-                messages, similarities = list(zip(*similar_matches))
-                similar_messages = list(messages)
-                similar_messages.sort(key=lambda m: m[2])
-
-        ret.append({"role": "system", "content": initial})
-
-        fmt_messages = list(map(format_message, similar_messages+recent_messages))
-
-        for m in fmt_messages:
-            token_count = self.get_token_count(m)
-            if cur_token_count + token_count > max_token_count:
-                logger.warn(f"Maximum token count reached ({cur_token_count} + {token_count} > {max_token_count}). Context will be shorter than expected.")
-                break
-            else:
-                ret.append(m)
-                cur_token_count += token_count
 
-        if reminder:
-            ret.append({"role": "system", "content": reminder})
+        # +2 for the assistant's reply being primed
+        token_count = sum(self.count_tokens([initial] + reminder)) + 2
+        if token_count > max_token_count:
+            raise Exception(f"Please shorten your reminder / initial prompt. Max token count exceeded: {token_count} > {max_token_count}")
 
-        cur_token_count += 2
+        similar_messages, recent_messages, history_tokens = await self.assemble_history(
+            channel, max(0, max_token_count - completion_tokens - token_count))
+        messages = [initial] + similar_messages + recent_messages + reminder
+        token_count += history_tokens
 
-        logger.debug(f"Calculated prompt token count: {cur_token_count}")
-        logger.debug(str(ret))
-        return ret
+        logger.debug(f"Calculated prompt token count: {token_count}")
+        logger.debug(str(messages))
+        return messages, token_count
 
     @property
     def current_model_name(self) -> str:
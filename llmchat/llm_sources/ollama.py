@@ -1,22 +1,25 @@
 from . import LLMSource
 from llmchat.config import Config
-from llmchat.persistence import PersistentData
+from llmchat.persistence import AsyncPersistentData
 from llmchat.logger import logger
+from typing import AsyncIterator
+import aiohttp
 import discord
-import requests
-import functools
+import json
 import time
 
+# what ollama falls back to when num_ctx isn't set
+DEFAULT_NUM_CTX = 2048
+DEFAULT_MAX_TOKENS = 256
+
 class OllamaLLM(LLMSource):
-    def __init__(self, client: discord.Client, config: Config, db: PersistentData):
+    def __init__(self, client: discord.Client, config: Config, db: AsyncPersistentData):
         """
         Initializes the OllamaLLM class using config settings.
         """
         super(OllamaLLM, self).__init__(client, config, db)
-        self.base_url = config.ollama_base_url
+        self.base_url = config.ollama_base_url.rstrip("/")
         self.model = config.ollama_model
-        self.temperature = config.llm_temperature
-        self.max_tokens = config.llm_max_tokens
 
         logger.info(f"Ollama initialized with model: {self.model}")
 
@@ -24,13 +27,12 @@ class OllamaLLM(LLMSource):
         """
         Fetch available models from Ollama and return as selectable Discord options.
         """
-        url = f"{self.base_url}/api/tags"
         try:
-            response = requests.get(url)
-            response.raise_for_status()
-            models = response.json().get("models", [])
-            return [discord.SelectOption(label=model["name"], value=model["name"]) for model in models]
-        except requests.RequestException as e:
+            async with self.client.http_session.get(f"{self.base_url}/api/tags") as response:
+                response.raise_for_status()
+                models = (await response.json()).get("models", [])
+            return [discord.SelectOption(label=model["name"], value=model["name"], default=model["name"] == self.model) for model in models]
+        except aiohttp.ClientError as e:
             logger.error(f"Error fetching Ollama models: {e}")
             return []
 
@@ -41,67 +43,122 @@ class OllamaLLM(LLMSource):
         self.model = model_id
         logger.info(f"Switched Ollama model to: {self.model}")
 
-    async def get_context(self, invoker: discord.User = None) -> str:
+    async def _load(self, model: str, keep_alive) -> None:
+        # a request without a prompt only loads the model, or unloads it with a keep_alive of 0
+        payload = {"model": model, "keep_alive": keep_alive}
+        try:
+            async with self.client.http_session.post(f"{self.base_url}/api/generate", json=payload) as response:
+                if response.status != 200:
+                    raise Exception(f"Error loading Ollama model {model}: {response.status} {await response.text()}")
+        except aiohttp.ClientError as e:
+            raise Exception(f"Error communicating with Ollama: {e}") from e
+
+    async def change_model(self, model_id: str) -> None:
+        # ollama keeps serving the current model while the new one loads
+        await self._load(model_id, self._keep_alive())
+        old, self.model = self.model, model_id
+        logger.info(f"Switched Ollama model to: {self.model}")
+        if old and old != model_id:
+            await self._load(old, 0)
+
+    def render_message(self, author_id: int, content: str, name: str = None) -> dict:
+        if author_id == -1:
+            return {"role": "system", "content": content}
+        elif author_id == self.client.user.id:
+            return {"role": "assistant", "content": content}
+        return {"role": "user", "content": f"{name}: {content}"}
+
+    def render_summary(self, summary: str) -> dict:
+        return {"role": "system", "content": f"Earlier in this conversation: {summary}"}
+
+    async def get_context(self, invoker: discord.User = None, channel: discord.abc.Messageable = None) -> list[dict]:
         """
-        Builds the conversation context for the LLM by retrieving recent messages.
+        Builds the conversation for the LLM as /api/chat messages from the recent and recalled messages.
         """
-        context = self.get_initial(invoker).strip() + "\n"
-
-        for author_id, content, _ in self.db.get_recent_messages(self.config.llm_context_messages_count):
-            if author_id == -1:
-                continue
-            elif author_id == self.client.user.id:
-                context += f"{self.config.bot_name}: {content}"
-            else:
-                name = (await self.client.fetch_user(author_id)).mention
-                identity = self.db.get_identity(author_id)
-                if identity:
-                    name = identity[0]
-
-                context += f"{name} {content}"
-            context += "\n"
+        initial = {"role": "system", "content": (await self.get_initial(invoker)).strip()}
+        budget = (self.config.ollama_num_ctx or DEFAULT_NUM_CTX) - (self.config.llm_max_tokens or DEFAULT_MAX_TOKENS) - sum(self.count_tokens([initial]))
+        similar_messages, recent_messages, _ = await self.assemble_history(channel, max(0, budget))
         # Commented out for RAG Testing
         #if self.config.bot_reminder:
-        #    context += f"Reminder: {self._insert_wildcards(self.config.bot_reminder, self.db.get_identity(invoker.id))}\n"
+        #    messages.append({"role": "system", "content": f"Reminder: {self._insert_wildcards(self.config.bot_reminder, await self.client.identities.get_identity(invoker.id))}"})
+
+        return [initial] + similar_messages + recent_messages
 
-        return context
+    def _options(self, temperature: float = None, max_tokens: int = None) -> dict:
+        options = {"temperature": self.config.llm_temperature if temperature is None else temperature}
+        if max_tokens or self.config.llm_max_tokens:
+            options["num_predict"] = max_tokens or self.config.llm_max_tokens
+        if self.config.ollama_num_ctx:
+            options["num_ctx"] = self.config.ollama_num_ctx
+        if self.config.ollama_num_thread:
+            options["num_thread"] = self.config.ollama_num_thread
+        return options
 
-    def _generate(self, context: str) -> str:
+    def _keep_alive(self):
+        # plain numbers are seconds (-1 for forever), ollama only accepts them unquoted
+        keep_alive = self.config.ollama_keep_alive
+        return int(keep_alive) if keep_alive.lstrip("-").isdigit() else keep_alive
+
+    async def complete(self, prompt: str, max_tokens: int) -> str:
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": False,
+            "keep_alive": self._keep_alive(),
+            "options": self._options(temperature=0, max_tokens=max_tokens),
+        }
+        try:
+            async with self.client.http_session.post(f"{self.base_url}/api/generate", json=payload) as response:
+                if response.status != 200:
+                    raise Exception(f"Error communicating with Ollama: {response.status} {await response.text()}")
+                return (await response.json()).get("response", "")
+        except aiohttp.ClientError as e:
+            raise Exception(f"Error communicating with Ollama: {e}") from e
+
+    async def stream_response(self, invoker: discord.User = None, channel: discord.abc.Messageable = None) -> AsyncIterator[str]:
         """
-        Sends a request to the Ollama LLM and retrieves the response.
+        Streams the response from /api/chat piece by piece.
         """
-        url = f"{self.base_url}/api/generate"
+        messages = await self.get_context(invoker, channel)
+        logger.debug(f"Generated context: {messages}")
         payload = {
             "model": self.model,
-            "prompt": context, 
-            "temperature": self.temperature,
-            "max_tokens": self.max_tokens,
-            "stream": False
+            "messages": messages,
+            "stream": True,
+            # keeps the model loaded between replies instead of reloading it after ollama's idle timeout
+            "keep_alive": self._keep_alive(),
+            "options": self._options(),
         }
 
+        start_time = time.time()
         try:
-            start_time = time.time()
-            response = requests.post(url, json=payload)
-            response.raise_for_status()
-            result = response.json().get("response", "")
-            logger.debug(f"Generation took {time.time() - start_time}s")
-
-            if not result:
-                raise Exception("Ollama generated an empty response!")
-            return result
-        except requests.RequestException as e:
-            logger.error(f"Error communicating with Ollama: {e}")
-            return "Error communicating with the AI."
-
-    async def generate_response(self, invoker: discord.User = None) -> str:
+            async with self.client.http_session.post(f"{self.base_url}/api/chat", json=payload) as response:
+                if response.status != 200:
+                    raise Exception(f"Error communicating with Ollama: {response.status} {await response.text()}")
+                # newline delimited json, one object per chunk and a final one with done set
+                async for line in response.content:
+                    if not line.strip():
+                        continue
+                    chunk = json.loads(line)
+                    if "error" in chunk:
+                        raise Exception(f"Ollama error: {chunk['error']}")
+                    piece = chunk.get("message", {}).get("content")
+                    if piece:
+                        yield piece
+                    if chunk.get("done"):
+                        logger.debug(f"Generation took {time.time() - start_time}s ({chunk.get('eval_count')} tokens)")
+                        break
+        except aiohttp.ClientError as e:
+            raise Exception(f"Error communicating with Ollama: {e}") from e
+
+    async def generate_response(self, invoker: discord.User = None, channel: discord.abc.Messageable = None) -> str:
         """
         Generates a response using Ollama LLM.
         """
-        context = await self.get_context(invoker)
-        logger.debug(f"Generated context: {context}")
-
-        blocking = functools.partial(self._generate, context)
-        return await self.client.loop.run_in_executor(None, blocking)
+        result = "".join([piece async for piece in self.stream_response(invoker, channel)]).strip()
+        if not result:
+            raise Exception("Ollama generated an empty response!")
+        return result
 
     @property
     def current_model_name(self) -> str:
@@ -1,15 +1,283 @@
+import asyncio
+import functools
+import os
+import re
 import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
 import discord
-from scipy import spatial
+import numpy as np
+from llmchat.archive import MessageArchive, SEGMENT_ROWS
+from llmchat.embedding_index import EmbeddingIndex
+from llmchat.logger import logger
+from llmchat.recent_messages import RecentMessages, DEFAULT_CAPACITY
+
+# discord snowflakes carry their creation time in milliseconds since this epoch
+DISCORD_EPOCH = 1420070400000
+# embeddings are stored as raw little-endian float32 blobs
+EMBEDDING_DTYPE = np.dtype("<f4")
+DEFAULT_EMBEDDING_MODEL = "text-embedding-ada-002"
+# pages handed back to the filesystem per incremental vacuum step
+VACUUM_STEP_PAGES = 1024
+# keyword recall searches for the rarest few words of a message, and ignores words found in more than
+# COMMON_TERM_FRACTION of all messages (but at least COMMON_TERM_MIN_DOCS), those match most of the history
+MAX_KEYWORD_TERMS = 4
+COMMON_TERM_FRACTION = 0.02
+COMMON_TERM_MIN_DOCS = 50
+
+
+def _migrate_channel_partitioning(cursor: sqlite3.Cursor):
+    cursor.execute("ALTER TABLE message_history ADD COLUMN guild_id INTEGER")
+    cursor.execute("ALTER TABLE message_history ADD COLUMN channel_id INTEGER")
+    cursor.execute("ALTER TABLE message_history ADD COLUMN created_at REAL")
+    # rows written before partitioning have no channel, recover what we can of their timestamps from the snowflake
+    cursor.execute(
+        "UPDATE message_history SET created_at = ((message_id >> 22) + ?) / 1000.0 WHERE message_id > 0",
+        (DISCORD_EPOCH,),
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS message_history_channel_idx ON message_history (channel_id, created_at)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS message_history_message_id_idx ON message_history (message_id)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS message_embeddings_message_id_idx ON message_embeddings (message_id)"
+    )
+
+
+def _migrate_binary_embeddings(cursor: sqlite3.Cursor):
+    cursor.execute("ALTER TABLE message_embeddings RENAME TO message_embeddings_text")
+    cursor.execute("DROP INDEX IF EXISTS message_embeddings_message_id_idx")
+    cursor.execute(
+        """
+    CREATE TABLE message_embeddings (
+        author_id INTEGER,
+        content TEXT,
+        message_id INTEGER,
+        channel_id INTEGER,
+        model TEXT,
+        dim INTEGER,
+        embedding BLOB
+    )
+    """
+    )
+
+    # the text rows can't be converted in SQL, so stream them through numpy in batches
+    reader = cursor.connection.cursor()
+    reader.execute(
+        """
+    SELECT author_id, content, message_id, embedding_str,
+        (SELECT channel_id FROM message_history h WHERE h.message_id = e.message_id AND e.message_id != -1 LIMIT 1)
+    FROM message_embeddings_text e
+    """
+    )
+    converted = 0
+    while rows := reader.fetchmany(500):
+        batch = []
+        for author_id, content, message_id, embedding_str, channel_id in rows:
+            embedding = np.array(embedding_str.split(","), dtype=EMBEDDING_DTYPE)
+            batch.append((author_id, content, message_id, channel_id, DEFAULT_EMBEDDING_MODEL, len(embedding), embedding.tobytes()))
+        cursor.executemany("INSERT INTO message_embeddings VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+        converted += len(batch)
+    logger.info(f"Converted {converted} embeddings to float32 blobs")
+
+    cursor.execute("DROP TABLE message_embeddings_text")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS message_embeddings_message_id_idx ON message_embeddings (message_id)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS message_embeddings_channel_idx ON message_embeddings (channel_id)"
+    )
+
+
+def _migrate_fulltext_index(cursor: sqlite3.Cursor):
+    # external content table, the text itself stays in message_history and the triggers keep the index in step
+    cursor.execute(
+        "CREATE VIRTUAL TABLE message_history_fts USING fts5(content, content='message_history', content_rowid='rowid', "
+        "tokenize='unicode61 remove_diacritics 0')"
+    )
+    # per term document counts, used to pick the distinctive words of a query
+    cursor.execute("CREATE VIRTUAL TABLE message_history_fts_vocab USING fts5vocab(message_history_fts, 'row')")
+    cursor.execute(
+        """
+    CREATE TRIGGER message_history_fts_insert AFTER INSERT ON message_history BEGIN
+        INSERT INTO message_history_fts (rowid, content) VALUES (new.rowid, new.content);
+    END
+    """
+    )
+    cursor.execute(
+        """
+    CREATE TRIGGER message_history_fts_delete AFTER DELETE ON message_history BEGIN
+        INSERT INTO message_history_fts (message_history_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+    END
+    """
+    )
+    cursor.execute(
+        """
+    CREATE TRIGGER message_history_fts_update AFTER UPDATE OF content ON message_history BEGIN
+        INSERT INTO message_history_fts (message_history_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+        INSERT INTO message_history_fts (rowid, content) VALUES (new.rowid, new.content);
+    END
+    """
+    )
+    cursor.execute("INSERT INTO message_history_fts (message_history_fts) VALUES ('rebuild')")
+
+
+def _migrate_channel_summaries(cursor: sqlite3.Cursor):
+    # one running summary per channel, (created_at, row_id) is the newest message folded into it
+    cursor.execute(
+        """
+    CREATE TABLE channel_summaries (
+        channel_id INTEGER PRIMARY KEY,
+        summary TEXT,
+        created_at REAL,
+        row_id INTEGER
+    )
+    """
+    )
+
+
+def _migrate_embedding_ids(cursor: sqlite3.Cursor):
+    # without an INTEGER PRIMARY KEY SQLite hands the ROWID of a deleted newest row to the next insert, an edited
+    # message's new embedding would take over its old one's place (and tombstone) in the indexes. existing ROWIDs
+    # are kept, so an index built on them stays valid
+    cursor.execute("ALTER TABLE message_embeddings RENAME TO message_embeddings_old")
+    cursor.execute("DROP INDEX IF EXISTS message_embeddings_message_id_idx")
+    cursor.execute("DROP INDEX IF EXISTS message_embeddings_channel_idx")
+    cursor.execute(
+        """
+    CREATE TABLE message_embeddings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        author_id INTEGER,
+        content TEXT,
+        message_id INTEGER,
+        channel_id INTEGER,
+        model TEXT,
+        dim INTEGER,
+        embedding BLOB
+    )
+    """
+    )
+    cursor.execute(
+        "INSERT INTO message_embeddings (id, author_id, content, message_id, channel_id, model, dim, embedding) "
+        "SELECT ROWID, author_id, content, message_id, channel_id, model, dim, embedding FROM message_embeddings_old"
+    )
+    cursor.execute("DROP TABLE message_embeddings_old")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS message_embeddings_message_id_idx ON message_embeddings (message_id)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS message_embeddings_channel_idx ON message_embeddings (channel_id)"
+    )
+
+
+def _migrate_history_count(cursor: sqlite3.Cursor):
+    # message_history has no INTEGER PRIMARY KEY, its ROWIDs are reused and renumbered and can't stand in for a count
+    cursor.execute("CREATE TABLE message_history_count (count INTEGER NOT NULL)")
+    cursor.execute("INSERT INTO message_history_count SELECT COUNT(*) FROM message_history")
+    cursor.execute(
+        """
+    CREATE TRIGGER message_history_count_insert AFTER INSERT ON message_history BEGIN
+        UPDATE message_history_count SET count = count + 1;
+    END
+    """
+    )
+    cursor.execute(
+        """
+    CREATE TRIGGER message_history_count_delete AFTER DELETE ON message_history BEGIN
+        UPDATE message_history_count SET count = count - 1;
+    END
+    """
+    )
+
+
+def _fts_query(terms: list[str]) -> str:
+    # quoted so nothing in them is read as query syntax
+    return " OR ".join(f'"{term}"' for term in terms)
+
+
+# MIGRATIONS[n] upgrades a database from user_version n to n + 1
+MIGRATIONS = [
+    _migrate_channel_partitioning,
+    _migrate_binary_embeddings,
+    _migrate_fulltext_index,
+    _migrate_channel_summaries,
+    _migrate_embedding_ids,
+    _migrate_history_count,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
 
 
 class PersistentData:
-    def __init__(self, client: discord.Client, db_path: str = "persistent.db"):
+    def __init__(self, client: discord.Client, db_path: str = "persistent.db", embedding_index: EmbeddingIndex = None,
+                 write_batch_size: int = 1, write_flush_interval: float = 0.0, archive_path: str = None,
+                 archive_index: EmbeddingIndex = None):
         self.client = client
         self.db_path = db_path
         self.connection = sqlite3.connect(db_path, check_same_thread=False)
         self.cursor = self.connection.cursor()
+        # only sticks on a new database, and only before anything is written, existing ones go through enable_incremental_vacuum
+        self.cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.cursor.execute("PRAGMA journal_mode = WAL")
+        # in WAL mode NORMAL only syncs on checkpoints, a power loss can lose the last commits but never corrupts
+        self.cursor.execute("PRAGMA synchronous = NORMAL")
+        self.cursor.execute("PRAGMA temp_store = MEMORY")
+        self.cursor.execute("PRAGMA cache_size = -16000")  # KiB
+
+        # group commit: writes are committed once write_batch_size of them are pending or the oldest one is
+        # write_flush_interval seconds old. history rows are held back and inserted together with executemany.
+        self.write_batch_size = max(1, write_batch_size)
+        self.write_flush_interval = write_flush_interval
+        self._history_buffer: list[tuple] = []
+        self._pending_writes = 0
+        self._first_pending_at = 0.0
+        # any object with EmbeddingIndex's interface, e.g. the disk-backed ann_index.IVFIndex
+        self.embedding_index = embedding_index if embedding_index is not None else EmbeddingIndex()
+        self.enable_incremental_vacuum()
         self.create_table()
+        self.migrate()
+        # rows dropped by the retention policy end up here, defaults to persistent-archive.db next to the database
+        if archive_path is None:
+            archive_path = ":memory:" if db_path == ":memory:" else os.path.splitext(db_path)[0] + "-archive.db"
+        self.archive = MessageArchive(archive_path, archive_index)
+
+    @property
+    def schema_version(self) -> int:
+        self.cursor.execute("PRAGMA user_version")
+        return self.cursor.fetchone()[0]
+
+    def migrate(self):
+        version = self.schema_version
+        if version > SCHEMA_VERSION:
+            raise Exception(f"{self.db_path} was created by a newer version (schema {version} > {SCHEMA_VERSION})!")
+        self.flush()
+
+        while version < SCHEMA_VERSION:
+            logger.info(f"Migrating {self.db_path} to schema version {version + 1}")
+            try:
+                # explicit BEGIN so schema changes roll back along with the data
+                self.cursor.execute("BEGIN")
+                MIGRATIONS[version](self.cursor)
+                # PRAGMA doesn't accept bound parameters
+                self.cursor.execute(f"PRAGMA user_version = {version + 1}")
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+            version += 1
+
+    def enable_incremental_vacuum(self):
+        self.cursor.execute("PRAGMA auto_vacuum")
+        if self.cursor.fetchone()[0] == 2:
+            return
+        # switching an existing database over takes one full VACUUM, afterwards free pages can be released in steps
+        logger.info(f"Enabling incremental vacuum on {self.db_path}, this can take a while once")
+        self.flush()
+        self.cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.cursor.execute("VACUUM")
+        # VACUUM renumbers the ROWIDs of tables without an INTEGER PRIMARY KEY, an on-disk index has to be rebuilt
+        self.embedding_index.drop()
 
     def create_table(self):
         self.cursor.execute(
@@ -42,43 +310,183 @@ class PersistentData:
         )
         self.connection.commit()
 
+    def _flush_history(self):
+        if self._history_buffer:
+            self.cursor.executemany(
+                "INSERT INTO message_history (author_id, content, message_id, guild_id, channel_id, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                self._history_buffer,
+            )
+            self._history_buffer.clear()
+
+    def _wrote(self):
+        if not self._pending_writes:
+            self._first_pending_at = time.monotonic()
+        self._pending_writes += 1
+        if self._pending_writes >= self.write_batch_size or self.flush_due:
+            self.flush()
+
+    @property
+    def flush_due(self) -> bool:
+        return self._pending_writes > 0 and time.monotonic() - self._first_pending_at >= self.write_flush_interval
+
+    def flush(self):
+        self._flush_history()
+        self.connection.commit()
+        self._pending_writes = 0
+
     def clear(self):
+        self._history_buffer.clear()
         self.cursor.execute("DELETE FROM message_history")
         self.cursor.execute("DELETE FROM message_embeddings")
-        self.connection.commit()
+        self.cursor.execute("DELETE FROM channel_summaries")
+        self.flush()
+        self.embedding_index.drop()
+        self.archive.drop()
         self.create_table()
 
-    def append(self, message: discord.Message, override_content: str = None):
-        self.cursor.execute(
-            "INSERT INTO message_history VALUES (?, ?, ?)",
-            (message.author.id, message.content if override_content is None else override_content, message.id),
-        )
-        self.connection.commit()
+    def clear_channel(self, channel_id: int):
+        self._flush_history()
+        self.cursor.execute("DELETE FROM message_embeddings WHERE channel_id = ?", (channel_id,))
+        self.cursor.execute("DELETE FROM message_history WHERE channel_id = ?", (channel_id,))
+        self.cursor.execute("DELETE FROM channel_summaries WHERE channel_id = ?", (channel_id,))
+        self._wrote()
+        self.embedding_index.drop(channel_id)
+        self.archive.drop(channel_id)
 
-    def speech(self, author: discord.User, content: str):
-        self.cursor.execute(
-            "INSERT INTO message_history VALUES (?, ?, ?)", (author.id, content, -1)
+    def _retention_cutoff(self, channel_id: int, max_age_days: float, max_rows: int, now: float):
+        """
+        Returns the (created_at, ROWID) of the newest row of the channel that is past its retention, or None.
+        """
+        cutoffs = []
+        if max_age_days:
+            self.cursor.execute(
+                "SELECT created_at, ROWID FROM message_history WHERE channel_id IS ? AND created_at < ? ORDER BY created_at DESC, ROWID DESC LIMIT 1",
+                (channel_id, now - max_age_days * 86400),
+            )
+            cutoffs.append(self.cursor.fetchone())
+        if max_rows:
+            self.cursor.execute(
+                "SELECT created_at, ROWID FROM message_history WHERE channel_id IS ? ORDER BY created_at DESC, ROWID DESC LIMIT 1 OFFSET ?",
+                (channel_id, max_rows),
+            )
+            cutoffs.append(self.cursor.fetchone())
+        cutoffs = [c for c in cutoffs if c is not None]
+        return max(cutoffs) if cutoffs else None
+
+    def apply_retention(self, policies: dict, now: float = None) -> int:
+        """
+        Moves at most one segment of expired history per channel into the archive, along with the embeddings of the
+        archived messages. `policies` maps a channel or guild id (None for the default) to
+        (max_age_days, max_rows), where 0 means unlimited. Returns how many rows were archived, call it again until 0.
+        """
+        now = now or time.time()
+        self.flush()
+        # DISTINCT over the leading column of the (channel_id, created_at) index, no table scan
+        self.cursor.execute("SELECT DISTINCT channel_id FROM message_history")
+        archived = 0
+        for channel_id, in self.cursor.fetchall():
+            self.cursor.execute("SELECT guild_id FROM message_history WHERE channel_id IS ? LIMIT 1", (channel_id,))
+            guild_id = self.cursor.fetchone()[0]
+            max_age_days, max_rows = policies.get(channel_id) or policies.get(guild_id) or policies.get(None) or (0, 0)
+            cutoff = self._retention_cutoff(channel_id, max_age_days, max_rows, now)
+            if cutoff is None:
+                continue
+
+            self.cursor.execute(
+                "SELECT ROWID, author_id, content, message_id, created_at FROM message_history WHERE channel_id IS ? AND (created_at < ? OR (created_at = ? AND ROWID <= ?)) "
+                "ORDER BY created_at, ROWID LIMIT ?",
+                (channel_id, cutoff[0], cutoff[0], cutoff[1], SEGMENT_ROWS),
+            )
+            rows = self.cursor.fetchall()
+            message_ids = [r[3] for r in rows if r[3] != -1]
+
+            # matched by message, an edited message is embedded again under a newer id than rows that are still hot
+            embeddings = []
+            if message_ids:
+                self.cursor.execute(
+                    f"SELECT id, author_id, content, message_id, model, dim, embedding FROM message_embeddings WHERE channel_id IS ? AND message_id IN ({','.join('?' * len(message_ids))})",
+                    (channel_id, *message_ids),
+                )
+                embeddings += self.cursor.fetchall()
+            # speech has no message id, its embeddings are the ones with the same author and text
+            speech = {(r[1], r[2]) for r in rows if r[3] == -1}
+            if speech:
+                self.cursor.execute(
+                    f"SELECT id, author_id, content, message_id, model, dim, embedding FROM message_embeddings WHERE channel_id IS ? AND message_id = -1 "
+                    f"AND (author_id, content) IN (VALUES {','.join(['(?, ?)'] * len(speech))})",
+                    (channel_id, *(value for pair in speech for value in pair)),
+                )
+                embeddings += self.cursor.fetchall()
+            embeddings.sort(key=lambda e: e[0])
+
+            # archive first and commit, a crash in between leaves a duplicate in the archive rather than losing rows
+            self.archive.add_history(channel_id, guild_id, [r[1:] for r in rows])
+            for model, dim in {(e[4], e[5]) for e in embeddings}:
+                group = [e for e in embeddings if e[4] == model and e[5] == dim]
+                vectors = np.frombuffer(b"".join(e[6] for e in group), dtype=EMBEDDING_DTYPE).reshape(len(group), dim)
+                self.archive.add_embeddings(channel_id, model, [e[1:4] for e in group], vectors)
+            self.archive.commit()
+
+            rowids = [r[0] for r in rows]
+            self.cursor.execute(f"DELETE FROM message_history WHERE ROWID IN ({','.join('?' * len(rowids))})", rowids)
+            if embeddings:
+                embedding_ids = [e[0] for e in embeddings]
+                self.cursor.execute(f"DELETE FROM message_embeddings WHERE id IN ({','.join('?' * len(embedding_ids))})", embedding_ids)
+            self.flush()
+            self.embedding_index.remove(channel_id, [e[0] for e in embeddings])
+            archived += len(rows)
+            logger.debug(f"Archived {len(rows)} messages and {len(embeddings)} embeddings of channel {channel_id}")
+        return archived
+
+    def vacuum_step(self, pages: int = VACUUM_STEP_PAGES) -> int:
+        """
+        Releases up to `pages` free pages back to the filesystem, returns how many are left.
+        """
+        self.flush()
+        self.cursor.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        self.cursor.execute("PRAGMA freelist_count")
+        remaining = self.cursor.fetchone()[0]
+        if not remaining:
+            # in WAL mode the file only shrinks once the vacuumed pages are checkpointed
+            self.cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        return remaining
+
+    def _insert_history(self, author_id: int, content: str, message_id: int, channel=None):
+        guild = getattr(channel, "guild", None)
+        self._history_buffer.append(
+            (author_id, content, message_id, guild.id if guild else None, channel.id if channel else None, time.time())
         )
-        self.connection.commit()
+        self._wrote()
 
-    def system(self, content: str, message_id: int):
-        self.cursor.execute(
-            "INSERT INTO message_history VALUES (?, ?, ?)", (-1, content, message_id)
+    def append(self, message: discord.Message, override_content: str = None):
+        self._insert_history(
+            message.author.id, message.content if override_content is None else override_content, message.id, message.channel
         )
-        self.connection.commit()
+
+    def speech(self, author: discord.User, content: str, channel: discord.abc.Connectable = None):
+        self._insert_history(author.id, content, -1, channel)
+
+    def system(self, content: str, message_id: int, channel: discord.abc.Messageable = None):
+        self._insert_history(-1, content, message_id, channel)
 
     def remove(self, message_id: int):
+        self._flush_history()
         self.cursor.execute(
             "DELETE FROM message_history WHERE message_id = ?", (message_id,)
         )
         self.remove_embedding(message_id)
-        self.connection.commit()
 
     def remove_embedding(self, message_id: int):
+        self.cursor.execute(
+            "SELECT ROWID, channel_id FROM message_embeddings WHERE message_id = ?", (message_id,)
+        )
+        removed = self.cursor.fetchall()
         self.cursor.execute(
             "DELETE FROM message_embeddings WHERE message_id = ?", (message_id,)
         )
-        self.connection.commit()
+        self._wrote()
+        for channel_id in {c for _, c in removed}:
+            self.embedding_index.remove(channel_id, [r for r, c in removed if c == channel_id])
 
 
     def set_identity(self, user_id: int, name: str, identity: str):
@@ -86,7 +494,7 @@ class PersistentData:
             "INSERT OR REPLACE INTO user_identities (user_id, name, identity) VALUES (?, ?, ?)",
             (user_id, name, identity),
         )
-        self.connection.commit()
+        self._wrote()
 
     def get_identity(self, user_id: int):
         self.cursor.execute(
@@ -97,35 +505,78 @@ class PersistentData:
 
     @property
     def last(self):
+        self._flush_history()
         self.cursor.execute(
-            "SELECT * FROM message_history ORDER BY ROWID DESC LIMIT 1"
+            "SELECT author_id, content, message_id FROM message_history ORDER BY ROWID DESC LIMIT 1"
         )
         row = self.cursor.fetchone()
         return row
 
-    def get_recent_messages(self, count: int = 0):
-        if count == 0:
+    def get_last(self, channel_id: int):
+        rows = self.get_recent_messages(1, channel_id)
+        return rows[0] if rows else None
+
+    def get_recent_messages(self, count: int = 0, channel_id: int = None, offset: int = 0):
+        """
+        Returns up to `count` messages (0 for all of them) in chronological order, skipping the `offset` newest ones.
+        Passing a channel_id only reads that channel's partition through the (channel_id, created_at) index.
+        """
+        self._flush_history()
+        if channel_id is None:
             self.cursor.execute(
-                "SELECT author_id, content, message_id FROM message_history ORDER BY ROWID DESC"
+                "SELECT author_id, content, message_id FROM message_history ORDER BY ROWID DESC LIMIT ? OFFSET ?",
+                (count or -1, offset),
             )
         else:
             self.cursor.execute(
-                "SELECT author_id, content, message_id FROM message_history ORDER BY ROWID DESC LIMIT ?",
-                (count,),
+                "SELECT author_id, content, message_id FROM message_history WHERE channel_id = ? ORDER BY created_at DESC, ROWID DESC LIMIT ? OFFSET ?",
+                (channel_id, count or -1, offset),
             )
         rows = self.cursor.fetchall()
         rows.reverse()
         return rows
 
+    def get_summary(self, channel_id: int) -> str or None:
+        self.cursor.execute("SELECT summary FROM channel_summaries WHERE channel_id = ?", (channel_id,))
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+
+    def get_unsummarized(self, channel_id: int, keep: int, limit: int) -> list[tuple[int, str, int, float, int]]:
+        """
+        The newest `limit` messages of the channel that are older than its newest `keep` and not yet folded into
+        its summary, in chronological order, as (author_id, content, message_id, created_at, ROWID).
+        """
+        self._flush_history()
+        self.cursor.execute("SELECT created_at, row_id FROM channel_summaries WHERE channel_id = ?", (channel_id,))
+        created_at, row_id = self.cursor.fetchone() or (0.0, 0)
+        # only the rows after the summary are walked, the newest `keep` of them are still in the context window
+        self.cursor.execute(
+            "SELECT author_id, content, message_id, created_at, ROWID FROM message_history WHERE channel_id = ? AND (created_at, ROWID) > (?, ?) "
+            "ORDER BY created_at DESC, ROWID DESC LIMIT ? OFFSET ?",
+            (channel_id, created_at, row_id, limit, keep),
+        )
+        rows = self.cursor.fetchall()
+        rows.reverse()
+        return rows
+
+    def set_summary(self, channel_id: int, summary: str, created_at: float, row_id: int):
+        self.cursor.execute(
+            "INSERT OR REPLACE INTO channel_summaries (channel_id, summary, created_at, row_id) VALUES (?, ?, ?, ?)",
+            (channel_id, summary, created_at, row_id),
+        )
+        self._wrote()
+
     def edit(self, message_id: int, new_content: str):
+        self._flush_history()
         self.cursor.execute(
             "UPDATE message_history SET content = ? WHERE message_id = ?",
             (new_content, message_id)
         )
-        self.connection.commit()
+        self._wrote()
 
     def query(self, author=None, content=None, message_id=None):
-        query = "SELECT * FROM message_history"
+        self._flush_history()
+        query = "SELECT author_id, content, message_id FROM message_history"
         conditions = []
         values = []
 
@@ -148,41 +599,287 @@ class PersistentData:
         rows = self.cursor.fetchall()
         return rows
 
-    def add_discord_message_embedding(self, message: discord.Message, embedding: list[float]):
-        return self.add_embedding((message.author.id, message.content, message.id), embedding)
+    def add_discord_message_embedding(self, message: discord.Message, embedding: list[float], model: str = DEFAULT_EMBEDDING_MODEL):
+        return self.add_embedding((message.author.id, message.content, message.id), embedding, model, message.channel.id)
 
-    def add_embedding(self, message: tuple[int, str, int], embedding: list[float]):
+    def add_embedding(self, message: tuple[int, str, int], embedding: list[float], model: str = DEFAULT_EMBEDDING_MODEL, channel_id: int = None):
         author_id, content, message_id = message
-        embedding_str = ','.join(str(e) for e in embedding)
+        embedding = np.asarray(embedding, dtype=EMBEDDING_DTYPE)
         self.cursor.execute(
-            "INSERT INTO message_embeddings VALUES (?, ?, ?, ?)",
-            (author_id, embedding_str, content, message_id),
+            "INSERT INTO message_embeddings (author_id, content, message_id, channel_id, model, dim, embedding) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (author_id, content, message_id, channel_id, model, len(embedding), embedding.tobytes()),
         )
-        self.connection.commit()
+        rowid = self.cursor.lastrowid
+        if self.embedding_index.persistent:
+            # an on-disk index must never get ahead of the database, or a lost commit would let SQLite reuse its rowids
+            self.flush()
+        else:
+            self._wrote()
+        self.embedding_index.add(channel_id, rowid, message_id, embedding)
+
+    def add_embeddings(self, entries: list[tuple[tuple[int, str, int], list[float], int]], model: str = DEFAULT_EMBEDDING_MODEL):
+        """
+        Inserts (message, embedding, channel_id) entries in one transaction and hands them to the index per channel.
+        """
+        added: dict[tuple[int, int], list] = {}
+        for (author_id, content, message_id), embedding, channel_id in entries:
+            embedding = np.asarray(embedding, dtype=EMBEDDING_DTYPE)
+            self.cursor.execute(
+                "INSERT INTO message_embeddings (author_id, content, message_id, channel_id, model, dim, embedding) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (author_id, content, message_id, channel_id, model, len(embedding), embedding.tobytes()),
+            )
+            added.setdefault((channel_id, len(embedding)), []).append((self.cursor.lastrowid, message_id, embedding))
+        if self.embedding_index.persistent:
+            self.flush()
+        else:
+            self._wrote()
+        for (channel_id, _), rows in added.items():
+            self.embedding_index.add_batch(channel_id, np.array([r[0] for r in rows]), np.array([r[1] for r in rows]),
+                                           np.stack([r[2] for r in rows]))
 
-    def query_embedding(self, message_id: int) -> list[float] or None:
+    def query_embedding(self, message_id: int) -> np.ndarray or None:
         self.cursor.execute(
-            "SELECT embedding_str FROM message_embeddings WHERE message_id = ?",
+            "SELECT embedding FROM message_embeddings WHERE message_id = ?",
             (message_id,),
         )
         row = self.cursor.fetchone()
         if row is not None:
-            embedding_str = row[0]
-            embedding = [float(e) for e in embedding_str.split(',')]
-            return embedding
+            # read-only view over the blob, no parsing or copying
+            return np.frombuffer(row[0], dtype=EMBEDDING_DTYPE)
         else:
             return None
 
-    def get_most_similar(self, embedding: list[float], threshold=0.0, messages_pool: list[tuple[int, str, int]] = None):
-        all_embeddings = []
-        for m in messages_pool or self.get_recent_messages():
-            author_id, content, mid = m
-            message_embedding = self.query_embedding(mid)
-            if message_embedding:
-                similarity = 1 - spatial.distance.cosine(embedding, message_embedding)
-                if similarity != 1 and similarity >= threshold:  # if the similarity is 1 it's the same message
-                    all_embeddings.append((m, similarity))
-
-        # sort based on similarity
-        all_embeddings.sort(key=lambda x: x[1], reverse=True)
-        return all_embeddings
+    def load_embedding_index(self, channel_id: int, dim: int):
+        # the index tells us how far it got, persistent indexes only need the rows written since
+        after = self.embedding_index.open(channel_id, dim)
+        cursor = self.connection.cursor()
+        cursor.execute(
+            "SELECT ROWID, message_id, embedding FROM message_embeddings WHERE channel_id IS ? AND dim = ? AND ROWID > ? ORDER BY ROWID",
+            (channel_id, dim, after),
+        )
+        loaded = 0
+        while rows := cursor.fetchmany(4096):
+            vectors = np.frombuffer(b"".join(r[2] for r in rows), dtype=EMBEDDING_DTYPE).reshape(len(rows), dim)
+            self.embedding_index.add_batch(channel_id, np.array([r[0] for r in rows]), np.array([r[1] for r in rows]), vectors)
+            loaded += len(rows)
+        logger.debug(f"Loaded {loaded} embeddings for channel {channel_id}")
+
+    def get_most_similar(self, embedding: np.ndarray, threshold=0.0, channel_id: int = None, limit: int = 0,
+                         exclude_ids: list[int] = None) -> list[tuple[tuple[int, str, int], float]]:
+        # (re)load the channel on first use, or when it was loaded for another embedding model
+        if not self.embedding_index.is_loaded(channel_id, len(embedding)):
+            self.load_embedding_index(channel_id, len(embedding))
+        matches = self.embedding_index.search(channel_id, embedding, threshold, limit, exclude_ids)
+        similar = []
+        if matches:
+            rowids = [r for r, _ in matches]
+            self.cursor.execute(
+                f"SELECT ROWID, author_id, content, message_id FROM message_embeddings WHERE ROWID IN ({','.join('?' * len(rowids))})",
+                rowids,
+            )
+            messages = {row[0]: row[1:] for row in self.cursor.fetchall()}
+            # rows deleted behind the index's back simply drop out
+            similar = [(messages[r], similarity) for r, similarity in matches if r in messages]
+
+        similar += self.archive.search(channel_id, embedding, threshold, limit, exclude_ids)
+        similar.sort(key=lambda m: m[1], reverse=True)
+        return similar[:limit] if limit else similar
+
+    def search_text(self, text: str, channel_id: int = None, limit: int = 0,
+                    exclude_ids: list[int] = None) -> list[tuple[tuple[int, str, int], float]]:
+        """
+        Keyword search over the channel's history for the rarest words of `text`, returns (message, BM25 score) pairs best first.
+        Higher scores are better, unlike SQLite's bm25() which is negative.
+        """
+        terms = list(dict.fromkeys(re.findall(r"\w+", text.lower())))
+        if not terms:
+            return []
+        self._flush_history()
+        self.cursor.execute(
+            f"SELECT term, doc FROM message_history_fts_vocab WHERE term IN ({','.join('?' * len(terms))})", terms
+        )
+        frequencies = dict(self.cursor.fetchall())
+        # kept by triggers, counting the rows would read the whole table
+        self.cursor.execute("SELECT count FROM message_history_count")
+        common = max(COMMON_TERM_MIN_DOCS, self.cursor.fetchone()[0] * COMMON_TERM_FRACTION)
+        terms = sorted((t for t, f in frequencies.items() if f <= common), key=frequencies.get)[:MAX_KEYWORD_TERMS]
+        if not terms:
+            return []
+        query = _fts_query(terms)
+        exclude_ids = list(exclude_ids or [])
+        self.cursor.execute(
+            f"""
+    SELECT h.author_id, h.content, h.message_id, -bm25(message_history_fts) AS score
+    FROM message_history_fts JOIN message_history h ON h.ROWID = message_history_fts.rowid
+    WHERE message_history_fts MATCH ? AND h.channel_id IS ? AND h.author_id != -1
+        AND h.message_id NOT IN ({','.join('?' * len(exclude_ids))})
+    ORDER BY score DESC LIMIT ?
+    """,
+            (query, channel_id, *exclude_ids, limit or -1),
+        )
+        return [(row[:3], row[3]) for row in self.cursor.fetchall()]
+
+    def search_hybrid(self, text: str, embedding: np.ndarray = None, threshold=0.0, channel_id: int = None,
+                      limit: int = 0, exclude_ids: list[int] = None, semantic_weight: float = 0.5) -> list[tuple[tuple[int, str, int], float]]:
+        """
+        Fuses keyword and embedding recall. BM25 scores are scaled to [0, 1] by the best one and blended with the
+        cosine similarity as `semantic_weight * cosine + (1 - semantic_weight) * bm25`. Without an embedding this is
+        plain keyword search. `threshold` only applies to the cosine side.
+        """
+        # over-fetch both sides so a message ranked mid-field by both can still make the cut
+        candidates = limit * 4 if limit else 0
+        lexical = self.search_text(text, channel_id, candidates, exclude_ids)
+        semantic = []
+        if embedding is not None:
+            semantic = self.get_most_similar(embedding, threshold, channel_id, candidates, exclude_ids)
+
+        scores: dict[tuple[int, str, int], float] = {}
+        best = lexical[0][1] if lexical and lexical[0][1] > 0 else 1.0
+        for message, score in lexical:
+            scores[tuple(message)] = (1 - semantic_weight) * score / best
+        for message, similarity in semantic:
+            scores[tuple(message)] = scores.get(tuple(message), 0.0) + semantic_weight * similarity
+
+        fused = sorted(scores.items(), key=lambda m: m[1], reverse=True)
+        return fused[:limit] if limit else fused
+
+    def close(self):
+        self.flush()
+        self.embedding_index.close()
+        self.archive.close()
+        self.connection.close()
+
+
+class AsyncPersistentData:
+    """
+    Asyncio facade over PersistentData. The connection, its cursor and the embedding index are owned by a single
+    dedicated thread and every call is queued to it, so the event loop never blocks on SQLite and calls can't
+    interleave on the cursor. Create it with `await AsyncPersistentData.open(...)`.
+
+    The newest rows of each channel are also kept on the loop's side, context windows are served from there.
+    """
+
+    def __init__(self, db: PersistentData, executor: ThreadPoolExecutor, recent_messages_capacity: int = DEFAULT_CAPACITY):
+        self._db = db
+        self._executor = executor
+        self.recent = RecentMessages(recent_messages_capacity)
+
+    @classmethod
+    async def open(cls, client: discord.Client, *args, recent_messages_capacity: int = DEFAULT_CAPACITY, **kwargs) -> "AsyncPersistentData":
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistent-db")
+        # the connection is made (and migrated) on the thread that will use it
+        db = await asyncio.get_running_loop().run_in_executor(executor, functools.partial(PersistentData, client, *args, **kwargs))
+        return cls(db, executor, recent_messages_capacity)
+
+    async def _run(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    def _push_recent(self, channel, row: tuple[int, str, int]):
+        if channel is not None:
+            self.recent.push(channel.id, row)
+
+    async def append(self, message: discord.Message, override_content: str = None):
+        self._push_recent(message.channel, (message.author.id, message.content if override_content is None else override_content, message.id))
+        return await self._run(self._db.append, message, override_content)
+
+    async def speech(self, author: discord.User, content: str, channel: discord.abc.Connectable = None):
+        self._push_recent(channel, (author.id, content, -1))
+        return await self._run(self._db.speech, author, content, channel)
+
+    async def system(self, content: str, message_id: int, channel: discord.abc.Messageable = None):
+        self._push_recent(channel, (-1, content, message_id))
+        return await self._run(self._db.system, content, message_id, channel)
+
+    async def edit(self, message_id: int, new_content: str):
+        self.recent.edit(message_id, new_content)
+        return await self._run(self._db.edit, message_id, new_content)
+
+    async def remove(self, message_id: int):
+        self.recent.remove(message_id)
+        return await self._run(self._db.remove, message_id)
+
+    async def clear(self):
+        self.recent.drop()
+        return await self._run(self._db.clear)
+
+    async def clear_channel(self, channel_id: int):
+        self.recent.drop(channel_id)
+        return await self._run(self._db.clear_channel, channel_id)
+
+    async def get_last(self, channel_id: int):
+        rows = await self.get_recent_messages(1, channel_id)
+        return rows[0] if rows else None
+
+    async def get_recent_messages(self, count: int = 0, channel_id: int = None, offset: int = 0):
+        if channel_id is None or offset or not count or count > self.recent.capacity:
+            return await self._run(self._db.get_recent_messages, count, channel_id, offset)
+
+        rows = self.recent.get(channel_id, count)
+        if rows is None:
+            generation = self.recent.generation(channel_id)
+            window = await self._run(self._db.get_recent_messages, self.recent.capacity, channel_id)
+            self.recent.hydrate(channel_id, window, generation)
+            rows = window[-count:]
+        return rows
+
+    async def get_summary(self, channel_id: int) -> str or None:
+        return await self._run(self._db.get_summary, channel_id)
+
+    async def get_unsummarized(self, channel_id: int, keep: int, limit: int) -> list[tuple[int, str, int, float, int]]:
+        return await self._run(self._db.get_unsummarized, channel_id, keep, limit)
+
+    async def set_summary(self, channel_id: int, summary: str, created_at: float, row_id: int):
+        return await self._run(self._db.set_summary, channel_id, summary, created_at, row_id)
+
+    async def query(self, author=None, content=None, message_id=None):
+        return await self._run(self._db.query, author, content, message_id)
+
+    async def set_identity(self, user_id: int, name: str, identity: str):
+        return await self._run(self._db.set_identity, user_id, name, identity)
+
+    async def get_identity(self, user_id: int):
+        return await self._run(self._db.get_identity, user_id)
+
+    async def add_embedding(self, message: tuple[int, str, int], embedding: list[float], model: str = DEFAULT_EMBEDDING_MODEL, channel_id: int = None):
+        return await self._run(self._db.add_embedding, message, embedding, model, channel_id)
+
+    async def add_embeddings(self, entries: list[tuple[tuple[int, str, int], list[float], int]], model: str = DEFAULT_EMBEDDING_MODEL):
+        return await self._run(self._db.add_embeddings, entries, model)
+
+    async def remove_embedding(self, message_id: int):
+        return await self._run(self._db.remove_embedding, message_id)
+
+    async def query_embedding(self, message_id: int) -> np.ndarray or None:
+        return await self._run(self._db.query_embedding, message_id)
+
+    async def get_most_similar(self, embedding: np.ndarray, threshold=0.0, channel_id: int = None, limit: int = 0,
+                               exclude_ids: list[int] = None) -> list[tuple[tuple[int, str, int], float]]:
+        return await self._run(self._db.get_most_similar, embedding, threshold, channel_id, limit, exclude_ids)
+
+    async def search_text(self, text: str, channel_id: int = None, limit: int = 0,
+                          exclude_ids: list[int] = None) -> list[tuple[tuple[int, str, int], float]]:
+        return await self._run(self._db.search_text, text, channel_id, limit, exclude_ids)
+
+    async def search_hybrid(self, text: str, embedding: np.ndarray = None, threshold=0.0, channel_id: int = None, limit: int = 0,
+                            exclude_ids: list[int] = None, semantic_weight: float = 0.5) -> list[tuple[tuple[int, str, int], float]]:
+        return await self._run(self._db.search_hybrid, text, embedding, threshold, channel_id, limit, exclude_ids, semantic_weight)
+
+    async def apply_retention(self, policies: dict, now: float = None) -> int:
+        archived = await self._run(self._db.apply_retention, policies, now)
+        if archived:
+            # a row limit below the window's capacity can archive rows that are still in it
+            self.recent.drop()
+        return archived
+
+    async def vacuum_step(self, pages: int = VACUUM_STEP_PAGES) -> int:
+        return await self._run(self._db.vacuum_step, pages)
+
+    async def flush(self, only_if_due: bool = False):
+        def _flush():
+            if not only_if_due or self._db.flush_due:
+                self._db.flush()
+        return await self._run(_flush)
+
+    async def close(self):
+        await self._run(self._db.close)
+        self._executor.shutdown(wait=True)
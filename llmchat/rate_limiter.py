@@ -0,0 +1,220 @@
+import asyncio
+import bisect
+import itertools
+import re
+import time
+from typing import Awaitable, Callable
+from urllib.parse import urlparse
+
+import aiohttp
+import openai
+
+from llmchat.logger import logger
+
+# lower goes first, requests of the same priority go in the order they came in
+PRIORITY_REPLY = 0
+PRIORITY_BACKGROUND = 1
+# share of each limit background requests leave untouched, so a reply arriving right after a batch isn't held up by it
+BACKGROUND_RESERVE = 0.1
+# how long everything waits after a 429 that didn't say for how long
+DEFAULT_BACKOFF = 1.0
+
+ENDPOINT_COMPLETIONS = "completions"
+ENDPOINT_EMBEDDINGS = "embeddings"
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset(value: str) -> float or None:
+    """
+    Seconds in one of OpenAI's reset headers, e.g. 20ms, 1s or 6m0s.
+    """
+    if not value:
+        return None
+    parts = _DURATION.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _UNITS[unit] for amount, unit in parts)
+
+
+class _Bucket:
+    """
+    A per minute limit, refilled continuously. Without a limit (none configured or reported yet) nothing waits.
+    """
+    __slots__ = ("limit", "level", "updated")
+
+    def __init__(self, limit: int):
+        self.limit = limit or None
+        self.level = float(limit or 0)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        if self.limit:
+            self.level = min(self.limit, self.level + (now - self.updated) * self.limit / 60)
+        self.updated = now
+
+    def wait(self, amount: float, reserve: float = 0.0) -> float:
+        if not self.limit:
+            return 0.0
+        # a request bigger than the whole limit would never fit, it goes once the bucket is full
+        needed = min(amount + reserve * self.limit, self.limit)
+        return max(0.0, (needed - self.level) * 60 / self.limit)
+
+    def take(self, amount: float):
+        if self.limit:
+            self.level -= amount
+
+    def sync(self, limit: str, remaining: str):
+        try:
+            limit, remaining = int(limit), int(remaining)
+        except (TypeError, ValueError):
+            return
+        if limit <= 0:
+            return
+        if self.limit is None:
+            self.level = remaining
+        self.limit = limit
+        self.refill(time.monotonic())
+        # what we reserved for requests still in flight may not be counted yet, never go above what the server says
+        self.level = min(self.level, remaining)
+
+
+class _Budget:
+    __slots__ = ("requests", "tokens", "paused_until")
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests = _Bucket(requests_per_minute)
+        self.tokens = _Bucket(tokens_per_minute)
+        self.paused_until = 0.0
+
+
+class RateLimiter:
+    """
+    Keeps the OpenAI requests of the whole bot within the account's requests and tokens per minute. Each kind of
+    request (completions and embeddings, they're limited separately) has a token bucket for both, their sizes
+    start out as `requests_per_minute` and `tokens_per_minute` under [OpenAI] and follow the x-ratelimit headers
+    of every response after that. Requests wait in line until their prompt (plus the tokens they may answer with)
+    fits, replies ahead of background work like embeddings and summaries, and a request that got a 429 anyway
+    waits for the limit to reset and is sent again instead of failing.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._budgets: dict[str, _Budget] = {}
+        self._waiting: list[tuple[int, int, str]] = []
+        self._order = itertools.count()
+        self._changed = asyncio.Event()
+        # metrics
+        self.admitted = 0
+        self.throttled = 0
+        self.rate_limited = 0
+        self.trace_config = aiohttp.TraceConfig()
+        self.trace_config.on_request_end.append(self._on_request_end)
+
+    def _budget(self, endpoint: str) -> _Budget:
+        budget = self._budgets.get(endpoint)
+        if budget is None:
+            budget = self._budgets[endpoint] = _Budget(self.config.openai_requests_per_minute,
+                                                       self.config.openai_tokens_per_minute)
+        return budget
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _delay(self, budget: _Budget, tokens: int, priority: int) -> float:
+        now = time.monotonic()
+        if now < budget.paused_until:
+            return budget.paused_until - now
+        budget.requests.refill(now)
+        budget.tokens.refill(now)
+        reserve = BACKGROUND_RESERVE if priority > PRIORITY_REPLY else 0.0
+        return max(budget.requests.wait(1, reserve), budget.tokens.wait(tokens, reserve))
+
+    async def acquire(self, endpoint: str, tokens: int, priority: int = PRIORITY_REPLY):
+        """
+        Waits until a request of `tokens` tokens to `endpoint` is within its limits and every request queued before
+        it at the same or a higher priority went out, then counts it against the limits.
+        """
+        budget = self._budget(endpoint)
+        waiter = (priority, next(self._order), endpoint)
+        bisect.insort(self._waiting, waiter)
+        waited = False
+        try:
+            while True:
+                changed = self._changed
+                # only the first one in line of its kind may go, the ones behind it just wait their turn
+                first = next(w for w in self._waiting if w[2] == endpoint)
+                delay = None
+                if first is waiter:
+                    delay = self._delay(budget, tokens, priority)
+                    if delay <= 0:
+                        break
+                waited = True
+                try:
+                    await asyncio.wait_for(changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            budget.requests.take(1)
+            budget.tokens.take(tokens)
+            self.admitted += 1
+            if waited:
+                self.throttled += 1
+        finally:
+            self._waiting.remove(waiter)
+            self._notify()
+
+    async def run(self, endpoint: str, tokens: int, request: Callable[[], Awaitable], priority: int = PRIORITY_REPLY):
+        """
+        Sends request() once it's within the limits, and again after every 429 up to `rate_limit_retries` times.
+        """
+        for attempt in range(self.config.openai_rate_limit_retries + 1):
+            await self.acquire(endpoint, tokens, priority)
+            try:
+                return await request()
+            except openai.error.RateLimitError as e:
+                # running out of credit is reported as a 429 as well, waiting doesn't help with that
+                if e.code == "insufficient_quota" or attempt == self.config.openai_rate_limit_retries:
+                    raise
+                logger.warn(f"OpenAI rate limit hit, retrying once it resets ({attempt + 1})...")
+
+    def _is_openai(self, url) -> bool:
+        hosts = {"api.openai.com"}
+        if self.config.openai_reverse_proxy_url:
+            hosts.add(urlparse(self.config.openai_reverse_proxy_url).hostname)
+        return url.host in hosts
+
+    async def _on_request_end(self, session, context, params: aiohttp.TraceRequestEndParams):
+        if not self._is_openai(params.url):
+            return
+        path = params.url.path.rstrip("/")
+        if path.endswith("/embeddings"):
+            budget = self._budget(ENDPOINT_EMBEDDINGS)
+        elif path.endswith("/completions"):
+            budget = self._budget(ENDPOINT_COMPLETIONS)
+        else:
+            return
+
+        headers = params.response.headers
+        budget.requests.sync(headers.get("x-ratelimit-limit-requests"), headers.get("x-ratelimit-remaining-requests"))
+        budget.tokens.sync(headers.get("x-ratelimit-limit-tokens"), headers.get("x-ratelimit-remaining-tokens"))
+
+        if params.response.status == 429:
+            self.rate_limited += 1
+            delay = parse_reset(headers.get("retry-after"))
+            if delay is None:
+                kind = "requests" if budget.requests.limit and budget.requests.level < 1 else "tokens"
+                delay = parse_reset(headers.get(f"x-ratelimit-reset-{kind}"))
+            if delay is None:
+                delay = DEFAULT_BACKOFF
+            budget.paused_until = max(budget.paused_until, time.monotonic() + delay)
+            logger.debug(f"OpenAI {params.url.path} is rate limited for {delay:.2f}s")
+        self._notify()
@@ -0,0 +1,65 @@
+from collections import deque
+
+DEFAULT_CAPACITY = 256
+
+
+class RecentMessages:
+    """
+    The newest `capacity` history rows of each channel, kept in memory so context windows don't go through SQLite.
+    A channel is filled from the database the first time it's read and then kept in sync with every write.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._channels: dict[int, deque] = {}
+        # bumped on every change of a channel, a hydration that raced with a write is thrown away
+        self._generations: dict[int, int] = {}
+
+    def get(self, channel_id: int, count: int) -> list[tuple[int, str, int]] or None:
+        """
+        Returns the newest `count` rows in chronological order, or None when they have to come from the database.
+        """
+        window = self._channels.get(channel_id)
+        if window is None or not count or count > self.capacity:
+            return None
+        return list(window)[-count:]
+
+    def generation(self, channel_id: int) -> int:
+        return self._generations.get(channel_id, 0)
+
+    def hydrate(self, channel_id: int, rows: list[tuple[int, str, int]], generation: int):
+        if generation == self.generation(channel_id):
+            self._channels[channel_id] = deque(rows, maxlen=self.capacity)
+
+    def _changed(self, channel_id: int):
+        self._generations[channel_id] = self.generation(channel_id) + 1
+
+    def push(self, channel_id: int, row: tuple[int, str, int]):
+        self._changed(channel_id)
+        window = self._channels.get(channel_id)
+        if window is not None:
+            window.append(row)
+
+    def edit(self, message_id: int, content: str):
+        for channel_id, window in self._channels.items():
+            for i, (author_id, _, row_message_id) in enumerate(window):
+                if row_message_id == message_id:
+                    window[i] = (author_id, content, message_id)
+                    self._changed(channel_id)
+
+    def remove(self, message_id: int):
+        for channel_id, window in self._channels.items():
+            if any(row[2] == message_id for row in window):
+                # the window is one row short now, refill it from the database on the next read
+                del self._channels[channel_id]
+                self._changed(channel_id)
+                return
+
+    def drop(self, channel_id: int = None):
+        if channel_id is None:
+            for channel_id in self._channels:
+                self._changed(channel_id)
+            self._channels.clear()
+        else:
+            self._channels.pop(channel_id, None)
+            self._changed(channel_id)
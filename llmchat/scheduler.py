@@ -0,0 +1,169 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+import discord
+
+from llmchat.logger import logger
+
+
+class Turn:
+    """
+    The messages of one channel that are answered by a single reply.
+    """
+    __slots__ = ("messages", "first_at", "ready_at", "delivering", "task")
+
+    def __init__(self):
+        self.messages: list[discord.Message] = []
+        self.first_at = time.monotonic()
+        self.ready_at = self.first_at
+        # once the reply is being shown it's no longer cancelled for newer messages
+        self.delivering = False
+        self.task: asyncio.Task = None
+
+    def deliver(self):
+        self.delivering = True
+
+
+class _Channel:
+    __slots__ = ("next", "running", "wakeup", "driver")
+
+    def __init__(self):
+        # messages collected for the next reply, and the reply being generated
+        self.next: Turn = None
+        self.running: Turn = None
+        self.wakeup = asyncio.Event()
+        self.driver: asyncio.Task = None
+
+
+class GenerationScheduler:
+    """
+    Decides when the bot replies. Messages that arrive in a burst are answered together by one reply once the channel
+    has been quiet for `reply_debounce` seconds (but no later than `reply_max_delay` after the first of them), and a
+    reply that is still being generated when a new message arrives is cancelled and generated again with it, as long
+    as nothing of it was shown yet. At most `max_concurrent_replies` replies are generated at once, channels waiting
+    for their turn are queued up to `reply_queue_size` and the `reply_drop_policy` decides which turn is dropped
+    when the queue is full.
+    """
+
+    def __init__(self, config, respond: Callable[[list[discord.Message], Turn], Awaitable[None]]):
+        self.config = config
+        # respond(messages, turn) generates and sends the reply, calling turn.deliver() before showing any of it
+        self.respond = respond
+        self._channels: dict[int, _Channel] = {}
+        self._active = 0
+        self._queue: deque[tuple[int, asyncio.Future]] = deque()
+
+    def submit(self, message: discord.Message):
+        """
+        Schedules a reply to `message`, together with the other messages of its channel that are still waiting for one.
+        """
+        channel = self._channels.get(message.channel.id)
+        if channel is None:
+            channel = self._channels[message.channel.id] = _Channel()
+
+        now = time.monotonic()
+        if channel.next is None:
+            channel.next = Turn()
+        turn = channel.next
+        running = channel.running
+        if running is not None and not running.delivering and running.task is not None and not running.task.done():
+            # its reply would ignore this message, start over with everything it was answering
+            logger.debug(f"Reply in channel {message.channel.id} superseded by a newer message")
+            running.task.cancel()
+            turn.messages[:0] = running.messages
+            turn.first_at = min(turn.first_at, running.first_at)
+            running.messages = []
+        turn.messages.append(message)
+        turn.ready_at = min(now + self.config.llm_reply_debounce, turn.first_at + self.config.llm_reply_max_delay)
+
+        channel.wakeup.set()
+        if channel.driver is None or channel.driver.done():
+            channel.driver = asyncio.create_task(self._drive(message.channel.id, channel))
+
+    async def _wait_until_ready(self, channel: _Channel):
+        # every new message moves ready_at back
+        while (delay := channel.next.ready_at - time.monotonic()) > 0:
+            channel.wakeup.clear()
+            try:
+                await asyncio.wait_for(channel.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _acquire(self, channel_id: int) -> bool:
+        """
+        Waits for a free generation slot, False if the turn was dropped from the full queue.
+        """
+        limit = self.config.llm_max_concurrent_replies
+        if not limit or self._active < limit:
+            self._active += 1
+            return True
+
+        size = self.config.llm_reply_queue_size
+        if size and len(self._queue) >= size:
+            if self.config.llm_reply_drop_policy == "newest":
+                return False
+            _, dropped = self._queue.popleft()
+            dropped.set_result(False)
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((channel_id, future))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                # the slot was handed over already
+                if future.result():
+                    self._release()
+            else:
+                self._queue.remove((channel_id, future))
+            raise
+
+    def _release(self):
+        while self._queue:
+            _, future = self._queue.popleft()
+            if not future.done():
+                # the slot goes straight to the next turn
+                future.set_result(True)
+                return
+        self._active -= 1
+
+    async def _drive(self, channel_id: int, channel: _Channel):
+        while channel.next is not None:
+            await self._wait_until_ready(channel)
+            if not await self._acquire(channel_id):
+                logger.warn(f"Too many replies queued, dropped the reply to {len(channel.next.messages)} messages in channel {channel_id}")
+                channel.next = None
+                break
+            turn, channel.next = channel.next, None
+            if not turn.messages:
+                self._release()
+                continue
+            turn.task = asyncio.create_task(self._run(turn))
+            channel.running = turn
+            # messages arriving while the reply is shown wait for it, and get a reply of their own after it
+            try:
+                await asyncio.wait([turn.task])
+            finally:
+                channel.running = None
+                self._release()
+
+    async def _run(self, turn: Turn):
+        try:
+            await self.respond(turn.messages, turn)
+        except asyncio.CancelledError:
+            if turn.delivering:
+                raise
+            # superseded, its messages moved on to the next turn
+        except Exception as e:
+            logger.error(f"Failed to reply to {len(turn.messages)} messages: {e}")
+
+    async def close(self):
+        tasks = []
+        for channel in self._channels.values():
+            for task in (channel.driver, channel.running.task if channel.running else None):
+                if task is not None and not task.done():
+                    task.cancel()
+                    tasks.append(task)
+        self._channels.clear()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,11 +1,11 @@
 from discord import User, Client
 from llmchat.config import Config
-from llmchat.persistence import PersistentData
+from llmchat.persistence import AsyncPersistentData
 from speech_recognition import AudioData
 from typing import Union
 
 class SRSource:
-    def __init__(self, client: Client, config: Config, db: PersistentData):
+    def __init__(self, client: Client, config: Config, db: AsyncPersistentData):
         self.config = config
         self.db = db
         self.client = client
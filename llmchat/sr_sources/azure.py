@@ -1,13 +1,13 @@
 from . import SRSource
 from discord import User, Client
 from llmchat.config import Config
-from llmchat.persistence import PersistentData
+from llmchat.persistence import AsyncPersistentData
 import speech_recognition as sr
 from llmchat.logger import logger
 
 
 class Azure(SRSource):
-    def __init__(self, client: Client, config: Config, db: PersistentData):
+    def __init__(self, client: Client, config: Config, db: AsyncPersistentData):
         super(Azure, self).__init__(client, config, db)
         self.recognizer = sr.Recognizer()
 
@@ -1,7 +1,7 @@
 from . import SRSource
 from discord import User, Client
 from llmchat.config import Config
-from llmchat.persistence import PersistentData
+from llmchat.persistence import AsyncPersistentData
 from speech_recognition import AudioData
 from transformers import WhisperForConditionalGeneration, WhisperProcessor, WhisperTokenizerFast
 import torch
@@ -9,7 +9,7 @@ from llmchat.logger import logger
 import numpy as np
 
 class Whisper(SRSource):
-    def __init__(self, client: Client, config: Config, db: PersistentData):
+    def __init__(self, client: Client, config: Config, db: AsyncPersistentData):
         super(Whisper, self).__init__(client, config, db)
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         logger.info(f"Loading whisper model on {self.device}")
@@ -0,0 +1,114 @@
+import asyncio
+import time
+from typing import Callable, Union
+
+import discord
+
+from llmchat.logger import logger
+
+CHAR_LIMIT = 2000
+# discord allows about 5 edits per 5 seconds per channel
+EDIT_INTERVAL = 1.0
+
+
+class MessageStreamer:
+    """
+    Shows a response while it's being generated: the first piece is sent as soon as it arrives and the message is
+    then edited at most every `edit_interval` seconds, rolling over into a new message past CHAR_LIMIT characters.
+    Edits run in the background and are skipped while one is still in flight, so they never hold up the stream.
+    """
+
+    def __init__(self, destination: Union[discord.abc.Messageable, discord.Webhook], edit_interval: float = EDIT_INTERVAL,
+                 before_send: Callable[[], None] = None):
+        self.destination = destination
+        self.edit_interval = edit_interval
+        # called right before the first message is sent
+        self.before_send = before_send
+        self.text = ""
+        self.messages: list[discord.Message] = []
+        # where the current message's text starts in self.text
+        self._offset = 0
+        self._shown = ""
+        self._last_edit = 0.0
+        self._edit: asyncio.Task = None
+
+    async def _send(self, content: str):
+        kwargs = {}
+        # replies chain the parts together, webhooks (interaction followups) can't reply
+        if self.messages and isinstance(self.destination, discord.abc.Messageable):
+            kwargs["reference"] = self.messages[-1]
+        elif not self.messages and self.before_send:
+            self.before_send()
+        self.messages.append(await self.destination.send(content=content, **kwargs))
+        self._shown = content
+        self._last_edit = time.monotonic()
+
+    async def _show(self, content: str):
+        if content and content != self._shown:
+            self._shown = content
+            self._last_edit = time.monotonic()
+            await self.messages[-1].edit(content=content)
+
+    async def _show_in_background(self, content: str):
+        try:
+            await self._show(content)
+        except discord.HTTPException as e:
+            # the next edit or finish() will catch up
+            logger.warn(f"Failed to update streamed message: {e}")
+
+    def _split_point(self, text: str) -> int:
+        # prefer breaking a full message at a line or word boundary in its second half
+        for separator in ("\n", " "):
+            cut = text.rfind(separator, CHAR_LIMIT // 2, CHAR_LIMIT)
+            if cut != -1:
+                return cut + 1
+        return CHAR_LIMIT
+
+    async def _roll_over(self):
+        while len(self.text) - self._offset > CHAR_LIMIT:
+            await self._settle()
+            current = self.text[self._offset:]
+            cut = self._split_point(current)
+            await self._show(current[:cut].rstrip())
+            self._offset += cut
+            rest = self.text[self._offset:].lstrip()
+            self._offset = len(self.text) - len(rest)
+            await self._send(rest[:CHAR_LIMIT] or "…")
+
+    async def _settle(self):
+        if self._edit:
+            await self._edit
+            self._edit = None
+
+    async def feed(self, piece: str):
+        self.text += piece
+        if not self.messages:
+            if not self.text.strip():
+                return
+            self.text = self.text.lstrip()
+            await self._send(self.text[:CHAR_LIMIT])
+        await self._roll_over()
+
+        if time.monotonic() - self._last_edit >= self.edit_interval and (not self._edit or self._edit.done()):
+            self._edit = asyncio.create_task(self._show_in_background(self.text[self._offset:]))
+
+    async def finish(self) -> tuple[str, list[discord.Message]]:
+        """
+        Shows the complete text and returns it along with every message it was sent as.
+        """
+        await self._settle()
+        self.text = self.text.strip()
+        if not self.messages:
+            raise Exception("Response was empty!")
+        await self._show(self.text[self._offset:])
+        return self.text, self.messages
+
+    async def discard(self):
+        if self._edit:
+            self._edit.cancel()
+        for message in self.messages:
+            try:
+                await message.delete()
+            except discord.HTTPException as e:
+                logger.warn(f"Failed to delete partial response: {e}")
+        self.messages.clear()
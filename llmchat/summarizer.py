@@ -0,0 +1,120 @@
+import asyncio
+
+import discord
+
+from llmchat.logger import logger
+
+# how many batches of a long backlog are folded in, older messages are left to recall
+MAX_BACKLOG_BATCHES = 5
+# keeps a batch's transcript well within a small model's context window
+MAX_BATCH_CHARS = 6000
+MAX_MESSAGE_CHARS = 1000
+
+
+class ChannelSummarizer:
+    """
+    Keeps a running summary of each channel's conversation. Once a channel has been quiet for `summary_idle`
+    seconds, the messages that fell out of its context window since are folded into its summary by the current
+    LLM, `summary_batch` at a time, and the summary is stored in the database. Replies get the summary as context,
+    so the window can stay small without the conversation losing track of what came before it.
+    """
+
+    def __init__(self, client: discord.Client):
+        self.client = client
+        self.config = client.config
+        # channel id -> summary (None for none yet), read from the database once
+        self._summaries: dict[int, str] = {}
+        self._timers: dict[int, asyncio.TimerHandle] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+        # bumped on every message, a summary pass stops once its channel is busy again
+        self._activity: dict[int, int] = {}
+
+    async def get(self, channel_id: int) -> str or None:
+        if channel_id not in self._summaries:
+            self._summaries[channel_id] = await self.client.db.get_summary(channel_id)
+        return self._summaries[channel_id]
+
+    def forget(self, channel_id: int = None):
+        """
+        Drops the cached summary of `channel_id`, or of every channel, after their history was cleared.
+        """
+        if channel_id is None:
+            self._summaries.clear()
+        else:
+            self._summaries.pop(channel_id, None)
+
+    def touch(self, channel_id: int):
+        """
+        Notes activity in a channel, its summary is brought up to date once it has been quiet for a while.
+        """
+        self._activity[channel_id] = self._activity.get(channel_id, 0) + 1
+        timer = self._timers.pop(channel_id, None)
+        if timer:
+            timer.cancel()
+        self._timers[channel_id] = asyncio.get_running_loop().call_later(self.config.memory_summary_idle, self._start, channel_id)
+
+    def _start(self, channel_id: int):
+        del self._timers[channel_id]
+        if channel_id in self._tasks:
+            return
+        task = asyncio.create_task(self._update(channel_id))
+        self._tasks[channel_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(channel_id, None))
+
+    def _batches(self, rows: list[tuple]) -> list[list[tuple]]:
+        # only full batches, the rest waits for the next quiet moment
+        batch_size = max(1, self.config.memory_summary_batch)
+        batches, batch, chars = [], [], 0
+        for row in rows:
+            length = min(len(row[1]), MAX_MESSAGE_CHARS)
+            if batch and chars + length > MAX_BATCH_CHARS:
+                batches.append(batch)
+                batch, chars = [], 0
+            batch.append(row)
+            chars += length
+            if len(batch) == batch_size:
+                batches.append(batch)
+                batch, chars = [], 0
+        return batches
+
+    async def _transcript(self, rows: list[tuple]) -> str:
+        names = await self.client.identities.get_names(r[0] for r in rows if r[0] not in (-1, self.client.user.id))
+        lines = []
+        for author_id, content, *_ in rows:
+            if author_id == -1:
+                continue
+            name = self.config.bot_name if author_id == self.client.user.id else names.get(author_id)
+            if len(content) > MAX_MESSAGE_CHARS:
+                content = content[:MAX_MESSAGE_CHARS] + "…"
+            lines.append(f"{name}: {content}")
+        return "\n".join(lines)
+
+    async def _update(self, channel_id: int):
+        activity = self._activity.get(channel_id)
+        try:
+            rows = await self.client.db.get_unsummarized(channel_id, self.config.llm_context_messages_count,
+                                                         self.config.memory_summary_batch * MAX_BACKLOG_BATCHES)
+            summary = await self.get(channel_id)
+            for batch in self._batches(rows):
+                if self._activity.get(channel_id) != activity or not self.client.llm:
+                    return
+                transcript = await self._transcript(batch)
+                if transcript:
+                    summary = await self.client.llm.summarize(summary, transcript, self.config.memory_summary_max_tokens)
+                    if not summary:
+                        raise Exception("the LLM returned an empty summary")
+                _, _, _, created_at, row_id = batch[-1]
+                await self.client.db.set_summary(channel_id, summary, created_at, row_id)
+                self._summaries[channel_id] = summary
+                logger.debug(f"Folded {len(batch)} messages into the summary of channel {channel_id}")
+        except Exception as e:
+            # the next quiet moment tries again
+            logger.warn(f"Failed to update the summary of channel {channel_id}: {e}")
+
+    async def close(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
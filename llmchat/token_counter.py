@@ -0,0 +1,50 @@
+from collections import OrderedDict
+
+import tiktoken
+
+DEFAULT_MAX_SIZE = 16384
+
+
+class TokenCounter:
+    """
+    Memoized token counts for one tiktoken encoding. Counts are keyed by the text itself, so an edited message
+    is simply a new key and the old count ages out of the LRU.
+    """
+
+    def __init__(self, encoding: tiktoken.Encoding, max_size: int = DEFAULT_MAX_SIZE):
+        self.encoding = encoding
+        self.max_size = max_size
+        self._counts: OrderedDict[str, int] = OrderedDict()
+
+    def _store(self, text: str, count: int):
+        self._counts[text] = count
+        if len(self._counts) > self.max_size:
+            self._counts.popitem(last=False)
+
+    def count(self, text: str) -> int:
+        count = self._counts.get(text)
+        if count is None:
+            count = len(self.encoding.encode(text))
+            self._store(text, count)
+        else:
+            self._counts.move_to_end(text)
+        return count
+
+    def count_many(self, texts: list[str]) -> list[int]:
+        """
+        Counts a whole context window at once, the texts that aren't cached yet are encoded in one batch.
+        """
+        counts = {}
+        for text in dict.fromkeys(texts):
+            count = self._counts.get(text)
+            if count is not None:
+                self._counts.move_to_end(text)
+                counts[text] = count
+        misses = [t for t in dict.fromkeys(texts) if t not in counts]
+        if misses:
+            # encode_batch hands the texts to a thread pool, not worth it for the one new message of a turn
+            encoded = self.encoding.encode_batch(misses) if len(misses) > 1 else [self.encoding.encode(misses[0])]
+            for text, tokens in zip(misses, encoded):
+                counts[text] = len(tokens)
+                self._store(text, len(tokens))
+        return [counts[t] for t in texts]
@@ -1,10 +1,10 @@
 from discord import User, Client, SelectOption, Embed
 from llmchat.config import Config
-from llmchat.persistence import PersistentData
+from llmchat.persistence import AsyncPersistentData
 import io
 
 class TTSSource:
-    def __init__(self, client: Client, config: Config, db: PersistentData):
+    def __init__(self, client: Client, config: Config, db: AsyncPersistentData):
         self.config = config
         self.db = db
         self.client = client
@@ -13,7 +13,7 @@ class TTSSource:
     async def generate_speech(self, content: str) -> io.BytesIO:
         return NotImplementedError()
 
-    def list_voices(self) -> list[SelectOption]:
+    async def list_voices(self) -> list[SelectOption]:
         return NotImplementedError()
 
     def set_voice(self, voice_id: str) -> None:
@@ -7,7 +7,7 @@ from . import TTSSource
 import azure.cognitiveservices.speech as speechsdk
 from discord import User, Client, SelectOption
 from llmchat.config import Config
-from llmchat.persistence import PersistentData
+from llmchat.persistence import AsyncPersistentData
 from llmchat.logger import logger
 import io
 
@@ -15,7 +15,7 @@ import io
 class Azure(TTSSource):
     synthesizer: speechsdk.speech.SpeechSynthesizer
 
-    def __init__(self, client: Client, config: Config, db: PersistentData):
+    def __init__(self, client: Client, config: Config, db: AsyncPersistentData):
         super(Azure, self).__init__(client, config, db)
         logger.info("Logging into Azure...")
         self.speech_config = speechsdk.SpeechConfig(
@@ -37,7 +37,7 @@ class Azure(TTSSource):
     def set_voice(self, voice_id: str):
         self.config.azure_voice = voice_id
 
-    def list_voices(self) -> list[SelectOption]:
-        res: speechsdk.speech.SynthesisVoicesResult = self.synthesizer.get_voices_async("en-US").get()
+    async def list_voices(self) -> list[SelectOption]:
+        res: speechsdk.speech.SynthesisVoicesResult = await self.client.loop.run_in_executor(None, lambda: self.synthesizer.get_voices_async("en-US").get())
         return [SelectOption(label=v.local_name, value=v.short_name, default=self.config.azure_voice == v.short_name,
                              emoji=discord.PartialEmoji(name="♂️" if v.gender == azure.cognitiveservices.speech.SynthesisVoiceGender.Male else "♀️")) for v in res.voices]
@@ -5,7 +5,7 @@ from . import TTSSource
 import io
 from discord import User, Client
 from llmchat.config import Config
-from llmchat.persistence import PersistentData
+from llmchat.persistence import AsyncPersistentData
 from llmchat.logger import logger
 from bark import SAMPLE_RATE, generate_audio, preload_models
 from bark.generation import models
@@ -30,9 +30,10 @@ bark.generation.REMOTE_MODEL_PATHS = {
 
 
 class Bark(TTSSource):
-    def __init__(self, client: Client, config: Config, db: PersistentData):
+    def __init__(self, client: Client, config: Config, db: AsyncPersistentData):
         super(Bark, self).__init__(client, config, db)
-        self.client.loop.run_in_executor(None, lambda: preload_models())
+        # sources are constructed off the event loop
+        preload_models()
 
     async def generate_speech(self, content: str) -> io.BufferedIOBase:
         data = await self.client.loop.run_in_executor(None, lambda: generate_audio(content))
@@ -40,7 +41,7 @@ class Bark(TTSSource):
         write_wav(buf, SAMPLE_RATE, data)
         return buf
 
-    def list_voices(self) -> list[discord.SelectOption]:
+    async def list_voices(self) -> list[discord.SelectOption]:
         return []
 
     def __del__(self):
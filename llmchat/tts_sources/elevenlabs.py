@@ -26,8 +26,9 @@ class ElevenLabs(TTSSource):
             return "Unknown"
         return self.config.elevenlabs_voice
 
-    def list_voices(self) -> list[SelectOption]:
-        self.voice_cache = voices(self.config.elevenlabs_key)
+    async def list_voices(self) -> list[SelectOption]:
+        # the elevenlabs package makes its own blocking requests, keep them off the event loop
+        self.voice_cache = await self.client.loop.run_in_executor(None, lambda: voices(self.config.elevenlabs_key))
         return [SelectOption(label=v.name, value=v.voice_id, default=self.config.elevenlabs_voice == v.voice_id,
                              emoji=discord.PartialEmoji(name="⚙️") if v.category != "premade" else None) for v in self.voice_cache]
 
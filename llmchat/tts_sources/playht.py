@@ -3,16 +3,15 @@ import discord
 from . import TTSSource
 from discord import User, Client
 from llmchat.config import Config
-from llmchat.persistence import PersistentData
+from llmchat.persistence import AsyncPersistentData
 from llmchat.logger import logger
 import io
-import requests
 import json
 
 PLAYHT_API = "https://play.ht/api/v2"
 
 class PlayHt(TTSSource):
-    def __init__(self, client: Client, config: Config, db: PersistentData):
+    def __init__(self, client: Client, config: Config, db: AsyncPersistentData):
         super(PlayHt, self).__init__(client, config, db)
         self._voice_list_cache = []
 
@@ -24,57 +23,52 @@ class PlayHt(TTSSource):
         }
 
     async def generate_speech(self, content: str) -> io.BufferedIOBase:
-        r = requests.post(f"{PLAYHT_API}/tts", data=json.dumps({
+        audio_url = None
+        async with self.client.http_session.post(f"{PLAYHT_API}/tts", json={
              "text": content,
              "voice": self.config.playht_voice_id
-        }), headers=self.auth_headers | {
+        }, headers=self.auth_headers | {
             "Accept": "text/event-stream",
-            "Content-Type": "application/json"
-        }, stream=True)
-        r.raise_for_status()
+        }) as r:
+            r.raise_for_status()
+            async for data in r.content:
+                data: str = data.decode("utf-8").strip()
+                if not data.startswith("data: {"):
+                    continue
 
-        def generate_audio() -> str:
-            for data in r.iter_lines():
-                if data:
-                    data: str = data.decode("utf-8")
-                    if not data.startswith("data: {"):
-                        continue
-                    
-                    data = json.loads(data[5:])
-                    if "error_message" in data:
-                        raise Exception(f"Play.ht: {data['error_message']}")
-                    
-                    logger.debug(f"Play.ht progress: [{data['stage']}] {round(data['progress'] * 100)}%")
-                    if "url" in data:
-                        return data['url']
-            return None
+                data = json.loads(data[5:])
+                if "error_message" in data:
+                    raise Exception(f"Play.ht: {data['error_message']}")
+
+                logger.debug(f"Play.ht progress: [{data['stage']}] {round(data['progress'] * 100)}%")
+                if "url" in data:
+                    audio_url = data['url']
+                    break
 
-        audio_url = await self.client.loop.run_in_executor(None, generate_audio)
         if not audio_url:
             raise Exception("audio_url was None!")
-        
+
         logger.debug(f"Downloading {audio_url}")
-        data = await self.client.loop.run_in_executor(None, lambda: requests.get(audio_url))
-        return io.BytesIO(data.content)
+        async with self.client.http_session.get(audio_url) as r:
+            r.raise_for_status()
+            return io.BytesIO(await r.read())
 
-    def _get_all_voices(self):
-        r = requests.get(f"{PLAYHT_API}/cloned-voices",
-            headers=self.auth_headers | {
+    async def _get_voices(self, path: str) -> list:
+        async with self.client.http_session.get(f"{PLAYHT_API}/{path}", headers=self.auth_headers | {
                 "Accept": "application/json"
-            })
-        cloned_voices = r.json()
+            }) as r:
+            return await r.json(content_type=None)
+
+    async def _get_all_voices(self):
+        cloned_voices = await self._get_voices("cloned-voices")
         if 'error_message' in cloned_voices:
             cloned_voices = []
 
-        r = requests.get(f"{PLAYHT_API}/voices",
-            headers=self.auth_headers | {
-                "Accept": "application/json"
-            })
-        premade_voices = r.json()
+        premade_voices = await self._get_voices("voices")
         return cloned_voices + premade_voices
-    
-    def list_voices(self) -> list[discord.SelectOption]:
-        self._voice_list_cache = self._get_all_voices()
+
+    async def list_voices(self) -> list[discord.SelectOption]:
+        self._voice_list_cache = await self._get_all_voices()
         return [discord.SelectOption(value=v["id"], label=v["name"], default=self.config.playht_voice_id == v["id"],
                                      emoji=discord.PartialEmoji(name="♂️" if v["gender"] == "male" else "♀️") if "gender" in v else None,
                                      ) for i,v in enumerate(self._voice_list_cache)]
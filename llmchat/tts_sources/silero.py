@@ -5,7 +5,7 @@ import discord
 from . import TTSSource
 from discord import User, Client
 from llmchat.config import Config
-from llmchat.persistence import PersistentData
+from llmchat.persistence import AsyncPersistentData
 from llmchat.logger import logger
 import torch
 import torchaudio
@@ -13,7 +13,7 @@ import io
 
 
 class SileroTTS(TTSSource):
-    def __init__(self, client: Client, config: Config, db: PersistentData):
+    def __init__(self, client: Client, config: Config, db: AsyncPersistentData):
         super(SileroTTS, self).__init__(client, config, db)
         device = torch.device('cpu') if not torch.cuda.is_available() else torch.device('cuda')
         if not os.path.isdir("models/torch/"):
@@ -34,7 +34,7 @@ class SileroTTS(TTSSource):
     def current_voice_name(self) -> str:
         return self.config.silero_voice
 
-    def list_voices(self) -> list[discord.SelectOption]:
+    async def list_voices(self) -> list[discord.SelectOption]:
         return [discord.SelectOption(label=v, value=v) for v in [f"en_{n}" for n in range(0, 118)]] # 117 voices
 
     def set_voice(self, voice_id: str) -> None:
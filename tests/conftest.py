@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# same as main.py, the sources are imported as top level packages from llmchat/
+sys.path.insert(0, os.path.join(ROOT, "llmchat"))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def db(tmp_path):
+    from llmchat.persistence import PersistentData
+    data = PersistentData(None, str(tmp_path / "persistent.db"))
+    yield data
+    data.close()
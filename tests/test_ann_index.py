@@ -0,0 +1,96 @@
+import numpy as np
+
+from llmchat.ann_index import IVFIndex
+from llmchat.persistence import PersistentData
+
+
+def _vectors(count: int, dim: int = 16, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((count, dim)).astype(np.float32)
+
+
+def _ann_database(tmp_path) -> PersistentData:
+    return PersistentData(None, str(tmp_path / "persistent.db"), embedding_index=IVFIndex(str(tmp_path / "ann")))
+
+
+def test_editing_the_newest_message_keeps_it_searchable(tmp_path):
+    db = _ann_database(tmp_path)
+    vectors = _vectors(3)
+    for i, vector in enumerate(vectors):
+        db.add_embedding((1, f"m{i}", 100 + i), vector, channel_id=5)
+    query = vectors[2] + 0.01
+    assert db.get_most_similar(query, 0.0, 5, 1)[0][0] == (1, "m2", 102)
+
+    # what on_raw_message_edit does: the old embedding goes, the edited text is embedded again
+    db.remove_embedding(102)
+    db.add_embedding((1, "m2 edited", 102), vectors[2], channel_id=5)
+    assert db.get_most_similar(query, 0.0, 5, 1)[0][0] == (1, "m2 edited", 102)
+
+    # and still after the tombstone was compacted away
+    db.embedding_index.compact(5)
+    assert db.get_most_similar(query, 0.0, 5, 1)[0][0] == (1, "m2 edited", 102)
+    db.close()
+
+
+
+def _clustered(count: int, dim: int = 16, clusters: int = 32, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim))
+    return (centers[rng.integers(clusters, size=count)] + 0.3 * rng.standard_normal((count, dim))).astype(np.float32)
+
+
+def _filled(tmp_path, vectors: np.ndarray) -> IVFIndex:
+    index = IVFIndex(str(tmp_path / "ann"), compact_threshold=10 ** 9)
+    index.open(5, vectors.shape[1])
+    index.add_batch(5, np.arange(1, len(vectors) + 1), np.arange(1001, len(vectors) + 1001), vectors)
+    return index
+
+
+def test_unclustered_search_is_exact(tmp_path):
+    vectors = _clustered(500)
+    index = _filled(tmp_path, vectors)
+    query = vectors[42] + 0.01
+    brute = np.argsort(-(vectors / np.linalg.norm(vectors, axis=1, keepdims=True)) @ (query / np.linalg.norm(query)))[:5] + 1
+    assert [r for r, _ in index.search(5, query, limit=5)] == list(brute)
+
+
+def test_tombstoned_rows_stay_gone_through_compaction(tmp_path):
+    vectors = _clustered(500)
+    index = _filled(tmp_path, vectors)
+    index.remove(5, [43, 44])
+    assert 43 not in [r for r, _ in index.search(5, vectors[42] + 0.01, limit=10)]
+    assert len(index) == 498
+
+    index.compact(5)
+    assert len(index) == 498
+    assert 43 not in [r for r, _ in index.search(5, vectors[42] + 0.01, limit=10)]
+
+
+def test_clustered_search_finds_the_nearest_rows(tmp_path):
+    vectors = _clustered(4096)
+    index = _filled(tmp_path, vectors)
+    # that many new rows start a compaction in the background, close waits for it
+    index.close()
+    partition = index._partitions[5]
+    assert partition.centroids is not None and partition.base_count == 4096
+
+    # rows added after clustering go to the delta and are found as well
+    extra = _clustered(10, seed=1)
+    index.add_batch(5, np.arange(5000, 5010), np.arange(6000, 6010), extra)
+    assert index.search(5, extra[3] + 0.01, limit=1)[0][0] == 5003
+
+    hits = sum(index.search(5, vectors[i] + 0.01, limit=1)[0][0] == i + 1 for i in range(0, 4096, 64))
+    assert hits >= 60
+
+
+def test_reopened_index_only_needs_newer_rows(tmp_path):
+    vectors = _clustered(100)
+    index = _filled(tmp_path, vectors)
+    index.remove(5, [7])
+    index.close()
+
+    reopened = IVFIndex(str(tmp_path / "ann"))
+    assert reopened.open(5, 16) == 100
+    assert len(reopened) == 99
+    assert reopened.search(5, vectors[9] + 0.01, limit=1)[0][0] == 10
+    # another model's dimension starts the channel over
+    assert reopened.open(5, 8) == 0
@@ -0,0 +1,126 @@
+import asyncio
+from types import SimpleNamespace
+
+from llmchat.context_assembler import ContextAssembler
+
+BOT = 999
+
+
+class Identities:
+    def __init__(self):
+        self.generation = 0
+        self.changed = []
+
+    def rename(self, user_id: int):
+        self.generation += 1
+        self.changed.append(user_id)
+
+    def changed_since(self, generation: int) -> set[int]:
+        return set(self.changed[generation:])
+
+    async def get_names(self, ids):
+        return {i: f"user{i}" for i in ids}
+
+
+class Renderer:
+    def __init__(self):
+        self.rendered = []
+
+    def __call__(self, author_id: int, content: str, name: str):
+        self.rendered.append(content)
+        if content.startswith("(hidden)"):
+            return None
+        return f"{name or 'bot'}: {content}"
+
+
+def _assembler():
+    client = SimpleNamespace(user=SimpleNamespace(id=BOT), identities=Identities())
+    render = Renderer()
+    # one token per character keeps the budgets easy to follow
+    return ContextAssembler(client, render, lambda entries: [len(e) for e in entries]), render, client
+
+
+def _rows(count: int, start: int = 0) -> list[tuple[int, str, int]]:
+    return [(1, f"message {i:03d}", 100 + i) for i in range(start, start + count)]
+
+
+def test_packs_newest_first():
+    assembler, _, _ = _assembler()
+    rows = _rows(10)
+    entry = len("user1: message 000")
+    recalled, recent, used = asyncio.run(assembler.pack(5, rows, [], entry * 3 + 1))
+    assert recalled == []
+    assert recent == ["user1: message 007", "user1: message 008", "user1: message 009"]
+    assert used == entry * 3
+
+
+def test_recalled_rows_fill_what_is_left():
+    assembler, _, _ = _assembler()
+    rows = _rows(3, start=10)
+    entry = len("user1: message 000")
+    recalled_rows = [(1, "message 002", 102), (1, "message 001", 101), (1, "message 000", 100)]
+    recalled, recent, used = asyncio.run(assembler.pack(5, rows, recalled_rows, entry * 5))
+    assert len(recent) == 3
+    # best first while they fit, then put back in chronological order
+    assert recalled == ["user1: message 001", "user1: message 002"]
+    assert used == entry * 5
+
+
+def test_hidden_rows_take_no_room():
+    assembler, _, _ = _assembler()
+    rows = [(1, "(hidden) system note", 100)] + _rows(2, start=1)
+    _, recent, used = asyncio.run(assembler.pack(5, rows, [], 1000))
+    assert recent == ["user1: message 001", "user1: message 002"]
+    assert used == 2 * len("user1: message 000")
+
+
+def test_only_new_rows_are_rendered():
+    assembler, render, _ = _assembler()
+
+    async def run():
+        rows = _rows(20)
+        await assembler.pack(5, rows, [], 1000)
+        render.rendered.clear()
+        # the window slides by two rows
+        return await assembler.pack(5, rows[2:] + _rows(2, start=20), [], 1000)
+
+    _, recent, _ = asyncio.run(run())
+    assert render.rendered == ["message 020", "message 021"]
+    assert recent[0] == "user1: message 002" and recent[-1] == "user1: message 021"
+
+
+def test_edits_and_renames_render_again():
+    assembler, render, client = _assembler()
+
+    async def run():
+        rows = _rows(5)
+        await assembler.pack(5, rows, [], 1000)
+        edited = rows[:2] + [(1, "edited", 102)] + rows[3:]
+        render.rendered.clear()
+        _, recent, _ = await assembler.pack(5, edited, [], 1000)
+        after_edit = list(render.rendered)
+
+        render.rendered.clear()
+        client.identities.rename(1)
+        await assembler.pack(5, edited, [], 1000)
+        return recent, after_edit, list(render.rendered)
+
+    recent, after_edit, after_rename = asyncio.run(run())
+    assert recent[2] == "user1: edited"
+    assert len(after_edit) == 5
+    assert len(after_rename) == 5
+
+
+def test_renames_only_render_the_windows_of_that_user():
+    assembler, render, client = _assembler()
+
+    async def run():
+        await assembler.pack(5, _rows(3), [], 1000)
+        await assembler.pack(6, [(2, "someone else", 200)], [], 1000)
+        render.rendered.clear()
+        client.identities.rename(2)
+        await assembler.pack(5, _rows(3), [], 1000)
+        await assembler.pack(6, [(2, "someone else", 200)], [], 1000)
+        return list(render.rendered)
+
+    assert asyncio.run(run()) == ["someone else"]
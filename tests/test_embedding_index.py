@@ -0,0 +1,64 @@
+import numpy as np
+
+from llmchat.embedding_index import EmbeddingIndex
+
+
+def _vectors(count: int, dim: int = 8, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((count, dim)).astype(np.float32)
+
+
+def _near(vector: np.ndarray) -> np.ndarray:
+    # an exact match is the message itself and never recalled
+    return vector + 0.01
+
+
+def test_search_ranks_by_cosine_similarity():
+    index = EmbeddingIndex()
+    vectors = _vectors(20)
+    index.open(5, 8)
+    index.add_batch(5, np.arange(1, 21), np.arange(101, 121), vectors * 3)
+
+    matches = index.search(5, _near(vectors[7]), limit=3)
+    assert matches[0][0] == 8
+    assert matches[0][1] > 0.99
+    assert len(matches) == 3
+    assert [s for _, s in matches] == sorted((s for _, s in matches), reverse=True)
+
+
+def test_threshold_exclusion_and_channels():
+    index = EmbeddingIndex()
+    vectors = _vectors(10)
+    index.open(5, 8)
+    index.add_batch(5, np.arange(1, 11), np.arange(101, 111), vectors)
+
+    assert [r for r, _ in index.search(5, _near(vectors[0]), threshold=0.99)] == [1]
+    assert 1 not in [r for r, _ in index.search(5, _near(vectors[0]), exclude_ids=[101])]
+    # other channels and other dimensions see nothing
+    assert index.search(6, vectors[0]) == []
+    assert index.search(5, np.ones(4, dtype=np.float32)) == []
+
+
+def test_remove_keeps_the_other_rows():
+    index = EmbeddingIndex()
+    vectors = _vectors(300)
+    index.open(5, 8)
+    index.add_batch(5, np.arange(1, 301), np.arange(1001, 1301), vectors)
+
+    assert index.remove(5, [1, 150, 300]) == 3
+    assert len(index) == 297
+    for row in (0, 149, 299):
+        assert row + 1 not in [r for r, _ in index.search(5, _near(vectors[row]))]
+    assert index.search(5, _near(vectors[10]), limit=1)[0][0] == 11
+
+
+def test_database_recall_follows_adds_and_removals(db):
+    vectors = _vectors(3)
+    for i, vector in enumerate(vectors):
+        db.add_embedding((1, f"m{i}", 100 + i), vector, channel_id=5)
+
+    query = _near(vectors[1])
+    assert db.get_most_similar(query, 0.0, 5, 1)[0][0] == (1, "m1", 101)
+    db.remove_embedding(101)
+    assert (1, "m1", 101) not in [m for m, _ in db.get_most_similar(query, 0.0, 5)]
+    db.add_embedding((1, "m3", 103), vectors[1], channel_id=5)
+    assert db.get_most_similar(query, 0.0, 5, 1)[0][0] == (1, "m3", 103)
@@ -0,0 +1,106 @@
+import asyncio
+
+import numpy as np
+
+from llmchat.embedding_queue import EmbeddingQueue
+
+
+class FakeDB:
+    def __init__(self):
+        self.stored = []
+
+    async def add_embeddings(self, rows, model):
+        self.stored.extend((message, channel_id) for message, _, channel_id in rows)
+
+    async def query_embedding(self, message_id):
+        return None
+
+
+class FakeEmbed:
+    def __init__(self):
+        self.requests = []
+        self.release = None
+
+    async def __call__(self, texts):
+        self.requests.append(texts)
+        if self.release is not None:
+            await self.release.wait()
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+def test_batches_and_deduplicates():
+    async def run():
+        db, embed = FakeDB(), FakeEmbed()
+        queue = EmbeddingQueue(db, embed, "model", max_delay=0.01)
+        futures = [queue.submit((1, text, 100 + i), 5) for i, text in enumerate(["hi", "hello", "hi"])]
+        results = await asyncio.gather(*futures)
+        await queue.close()
+        return db, embed, results
+
+    db, embed, results = asyncio.run(run())
+    assert embed.requests == [["hi", "hello"]]
+    assert [m[2] for m, _ in db.stored] == [100, 101, 102]
+    np.testing.assert_array_equal(results[2], [2.0, 1.0])
+
+
+def test_edit_before_sending_only_embeds_the_new_text():
+    async def run():
+        db, embed = FakeDB(), FakeEmbed()
+        queue = EmbeddingQueue(db, embed, "model", max_delay=0.01)
+        first = queue.submit((1, "before", 100), 5)
+        second = queue.submit((1, "after the edit", 100), 5)
+        result = await first
+        await queue.close()
+        return db, embed, first is second, result
+
+    db, embed, same, result = asyncio.run(run())
+    assert same
+    assert embed.requests == [["after the edit"]]
+    assert db.stored == [((1, "after the edit", 100), 5)]
+    np.testing.assert_array_equal(result, [14.0, 1.0])
+
+
+def test_stale_version_in_flight_is_not_stored():
+    async def run():
+        db, embed = FakeDB(), FakeEmbed()
+        embed.release = asyncio.Event()
+        queue = EmbeddingQueue(db, embed, "model", max_delay=0.01)
+        stale = queue.submit((1, "before", 100), 5)
+        while not embed.requests:
+            await asyncio.sleep(0.001)
+        # edited while the old text is being embedded
+        current = queue.submit((1, "after the edit", 100), 5)
+        embed.release.set()
+        results = await asyncio.gather(stale, current)
+        await queue.close()
+        return db, embed, results
+
+    db, embed, (stale, current) = asyncio.run(run())
+    assert embed.requests == [["before"], ["after the edit"]]
+    assert db.stored == [((1, "after the edit", 100), 5)]
+    assert stale is None
+    np.testing.assert_array_equal(current, [14.0, 1.0])
+
+
+def test_speech_rows_are_never_coalesced():
+    async def run():
+        db, embed = FakeDB(), FakeEmbed()
+        queue = EmbeddingQueue(db, embed, "model", max_delay=0.01)
+        await asyncio.gather(queue.submit((1, "one", -1), 5), queue.submit((1, "two", -1), 5))
+        await queue.close()
+        return db
+
+    assert [m[1] for m, _ in asyncio.run(run()).stored] == ["one", "two"]
+
+
+def test_get_embedding_sends_right_away():
+    async def run():
+        db, embed = FakeDB(), FakeEmbed()
+        queue = EmbeddingQueue(db, embed, "model", max_delay=60)
+        queue.submit((1, "waiting", 100), 5)
+        await asyncio.sleep(0)
+        result = await queue.get_embedding(100, timeout=1)
+        await queue.close()
+        return result
+
+    np.testing.assert_array_equal(asyncio.run(run()), [7.0, 1.0])
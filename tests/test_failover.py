@@ -0,0 +1,88 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from llm_sources.failover import Backend, FailoverLLM
+
+
+def _config(deadline: float = 5.0, hedge_after: float = 0.02):
+    return SimpleNamespace(failover_deadline=lambda name: deadline, failover_hedge_after=hedge_after,
+                           failover_hedge_percentile=95, failover_hedge_min_samples=3,
+                           failover_breaker_failures=3, failover_breaker_cooldown=30)
+
+
+class Source:
+    def __init__(self, delay: float, answer: str = None, error: Exception = None):
+        self.delay = delay
+        self.answer = answer
+        self.error = error
+
+    async def complete(self, prompt: str, max_tokens: int) -> str:
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.answer
+
+    async def generate_response(self, invoker=None, channel=None) -> str:
+        return await self.complete("", 0)
+
+
+def _failover(config, *sources) -> FailoverLLM:
+    llm = FailoverLLM.__new__(FailoverLLM)
+    llm.backends = [Backend(f"backend{i}", source, config) for i, source in enumerate(sources)]
+    return llm
+
+
+def test_hedged_request_counts_the_loser():
+    config = _config()
+    llm = _failover(config, Source(1.0, "slow"), Source(0.0, "fast"))
+    assert asyncio.run(llm.complete("hi", 10)) == "fast"
+
+    slow, fast = llm.backends
+    assert len(fast.latencies) == 1
+    # cancelled once the hedge answered, it still took at least the hedge delay
+    assert len(slow.latencies) == 1 and slow.latencies[0] >= config.failover_hedge_after
+    assert slow.failures == 0
+
+
+def test_hedge_delay_does_not_drift_down():
+    config = _config(hedge_after=0.01)
+    llm = _failover(config, Source(0.05, "slow"), Source(0.0, "fast"))
+    primary = llm.backends[0]
+    for _ in range(5):
+        asyncio.run(llm.complete("hi", 10))
+    # every answer came from the hedge, the primary's slow requests are counted anyway
+    assert len(primary.latencies) == 5
+    assert primary.hedge_delay >= 0.01
+
+
+def test_deadline_is_recorded_and_fails_over():
+    config = _config(deadline=0.02, hedge_after=10)
+    llm = _failover(config, Source(1.0, "never"), Source(0.0, "backup"))
+    assert asyncio.run(llm.complete("hi", 10)) == "backup"
+    primary = llm.backends[0]
+    assert primary.failures == 1 and primary.latencies[0] >= 0.02
+
+
+def test_cancelled_request_records_nothing():
+    config = _config(hedge_after=0.02)
+    llm = _failover(config, Source(1.0, "slow"), Source(1.0, "slow too"))
+
+    async def run():
+        # superseded by a newer message while both backends are still working on it
+        reply = asyncio.create_task(llm.generate_response())
+        await asyncio.sleep(0.05)
+        reply.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await reply
+
+    asyncio.run(run())
+    assert [len(b.latencies) for b in llm.backends] == [0, 0]
+    assert [b.failures for b in llm.backends] == [0, 0]
+
+
+def test_every_backend_failing_raises():
+    llm = _failover(_config(), Source(0.0, error=ValueError("down")), Source(0.0, error=ValueError("down too")))
+    with pytest.raises(Exception, match="Every LLM backend failed"):
+        asyncio.run(llm.complete("hi", 10))
@@ -0,0 +1,74 @@
+import asyncio
+import sqlite3
+from types import SimpleNamespace
+
+from llmchat.persistence import AsyncPersistentData, PersistentData
+
+CHANNEL = SimpleNamespace(id=5, guild=SimpleNamespace(id=1))
+
+
+def _batched(path: str) -> PersistentData:
+    return PersistentData(None, path, write_batch_size=100, write_flush_interval=60)
+
+
+def _committed(path: str) -> list[int]:
+    # what another connection sees, i.e. what made it to disk
+    connection = sqlite3.connect(path)
+    try:
+        return [r[0] for r in connection.execute("SELECT message_id FROM message_history ORDER BY ROWID")]
+    finally:
+        connection.close()
+
+
+def test_buffered_rows_are_read_before_commit(tmp_path):
+    path = str(tmp_path / "persistent.db")
+    db = _batched(path)
+    for i in range(3):
+        db._insert_history(1, f"m{i}", 100 + i, CHANNEL)
+    assert db._pending_writes == 3 and _committed(path) == []
+
+    assert [r[2] for r in db.get_recent_messages(10, CHANNEL.id)] == [100, 101, 102]
+    assert db.get_last(CHANNEL.id) == (1, "m2", 102)
+    db.edit(101, "m1 edited")
+    assert db.query(message_id=101) == [(1, "m1 edited", 101)]
+
+    db.flush()
+    assert _committed(path) == [100, 101, 102]
+    db.close()
+
+
+def test_batch_size_commits(tmp_path):
+    path = str(tmp_path / "persistent.db")
+    db = PersistentData(None, path, write_batch_size=3, write_flush_interval=60)
+    for i in range(4):
+        db._insert_history(1, f"m{i}", 100 + i, CHANNEL)
+    assert _committed(path) == [100, 101, 102]
+    db.close()
+
+
+def test_close_writes_what_is_pending(tmp_path):
+    path = str(tmp_path / "persistent.db")
+    db = _batched(path)
+    db._insert_history(1, "last words", 100, CHANNEL)
+    db.close()
+
+    db = PersistentData(None, path)
+    assert db.get_recent_messages(1, CHANNEL.id) == [(1, "last words", 100)]
+    db.close()
+
+
+def test_facade_flushes_when_due(tmp_path):
+    path = str(tmp_path / "persistent.db")
+
+    async def run():
+        data = await AsyncPersistentData.open(None, path, write_batch_size=100, write_flush_interval=0.02)
+        await data.append(SimpleNamespace(id=100, author=SimpleNamespace(id=1), content="hello", channel=CHANNEL))
+        await data.flush(only_if_due=True)
+        before = _committed(path)
+        await asyncio.sleep(0.03)
+        await data.flush(only_if_due=True)
+        after = _committed(path)
+        await data.close()
+        return before, after
+
+    assert asyncio.run(run()) == ([], [100])
@@ -0,0 +1,113 @@
+import asyncio
+from types import SimpleNamespace
+
+from llmchat.identity_cache import IdentityCache
+
+
+class FakeClient:
+    def __init__(self):
+        self.lookups = []
+
+    def get_user(self, user_id: int):
+        self.lookups.append(user_id)
+        return SimpleNamespace(id=user_id, display_name=f"user{user_id}")
+
+
+class FakeDB:
+    def __init__(self):
+        self.identities = {}
+        self.reads = []
+
+    async def get_identity(self, user_id: int):
+        self.reads.append(user_id)
+        await asyncio.sleep(0.01)
+        return self.identities.get(user_id)
+
+    async def set_identity(self, user_id: int, name: str, identity: str):
+        self.identities[user_id] = (name, identity)
+
+
+def _cache(**kwargs) -> IdentityCache:
+    return IdentityCache(FakeClient(), FakeDB(), **kwargs)
+
+
+def test_names_prefer_the_stored_identity():
+    async def run():
+        cache = _cache()
+        await cache.set_identity(2, "Zorblax", "a cat")
+        return await cache.get_names([1, 2])
+
+    assert asyncio.run(run()) == {1: "user1", 2: "Zorblax"}
+
+
+def test_concurrent_misses_share_one_fetch():
+    async def run():
+        cache = _cache()
+        await asyncio.gather(cache.get_name(1), cache.get_identity(1), cache.get_names([1, 1, 2]))
+        return cache
+
+    cache = asyncio.run(run())
+    assert sorted(cache.db.reads) == [1, 2]
+    assert cache._pending == {}
+
+
+def test_entries_expire():
+    async def run():
+        cache = _cache(ttl=0.05)
+        await cache.get_name(1)
+        await cache.get_name(1)
+        await asyncio.sleep(0.06)
+        await cache.get_name(1)
+        return cache
+
+    assert asyncio.run(run()).db.reads == [1, 1]
+
+
+def test_least_recently_used_is_evicted():
+    async def run():
+        cache = _cache(max_size=2)
+        await cache.get_names([1, 2])
+        # 1 was used last, 2 goes when 3 comes in
+        await cache.get_name(1)
+        await cache.get_name(3)
+        reads = len(cache.db.reads)
+        await cache.get_names([1, 3])
+        cached = len(cache.db.reads) == reads
+        await cache.get_name(2)
+        return cache, cached
+
+    cache, cached = asyncio.run(run())
+    assert cached
+    assert list(cache._entries) == [3, 2]
+
+
+def test_invalidation_is_per_user():
+    async def run():
+        cache = _cache()
+        await cache.get_names([1, 2])
+        start = cache.generation
+        cache.invalidate(2)
+        changed = cache.changed_since(start)
+        await cache.get_names([1, 2])
+        cache.invalidate()
+        return cache, changed, cache.changed_since(start)
+
+    cache, changed, after_reset = asyncio.run(run())
+    assert changed == {2}
+    assert cache.db.reads == [1, 2, 2]
+    assert after_reset is None
+    assert cache.changed_since(cache.generation) == set()
+
+
+def test_fetch_in_flight_during_invalidation_is_not_cached():
+    async def run():
+        cache = _cache()
+        loading = asyncio.create_task(cache.get_names([1, 2]))
+        # both are being read when 2 changes
+        await asyncio.sleep(0.005)
+        cache.invalidate(2)
+        await loading
+        return cache
+
+    # 1 wasn't invalidated, what was read for it still holds
+    assert list(asyncio.run(run())._entries) == [1]
@@ -0,0 +1,119 @@
+import asyncio
+import threading
+
+from llmchat.inference_worker import PRIORITY_BACKGROUND, PRIORITY_REPLY, InferenceWorker
+
+
+async def _busy(worker: InferenceWorker) -> tuple[asyncio.Task, threading.Event]:
+    # holds the worker until the returned event is set, so the next requests pile up in the queue
+    release, started = threading.Event(), threading.Event()
+
+    def block(cancelled):
+        started.set()
+        release.wait(5)
+
+    task = asyncio.create_task(worker.run(block))
+    while not started.is_set():
+        await asyncio.sleep(0.001)
+    return task, release
+
+
+def test_runs_by_priority_then_in_order():
+    async def run():
+        worker = InferenceWorker("test-worker")
+        blocker, release = await _busy(worker)
+        order = []
+
+        def job(name):
+            return lambda cancelled: order.append(name) or name
+
+        requests = [worker.run(job("background 1"), PRIORITY_BACKGROUND), worker.run(job("reply 1"), PRIORITY_REPLY),
+                    worker.run(job("background 2"), PRIORITY_BACKGROUND), worker.run(job("reply 2"), PRIORITY_REPLY)]
+        tasks = [asyncio.create_task(r) for r in requests]
+        await asyncio.sleep(0.01)
+        release.set()
+        results = await asyncio.gather(blocker, *tasks)
+        await worker.close()
+        return order, results[1:], worker
+
+    order, results, worker = asyncio.run(run())
+    assert order == ["reply 1", "reply 2", "background 1", "background 2"]
+    assert results == ["background 1", "reply 1", "background 2", "reply 2"]
+    assert worker.served == 5 and worker.max_depth == 4
+
+
+def test_errors_reach_the_caller():
+    async def run():
+        worker = InferenceWorker("test-worker")
+
+        def fail(cancelled):
+            raise ValueError("broken model")
+
+        try:
+            await worker.run(fail)
+        except ValueError as e:
+            return str(e)
+        finally:
+            await worker.close()
+
+    assert asyncio.run(run()) == "broken model"
+
+
+def test_cancelled_while_queued_is_skipped():
+    async def run():
+        worker = InferenceWorker("test-worker")
+        blocker, release = await _busy(worker)
+        ran = []
+        skipped = asyncio.create_task(worker.run(lambda cancelled: ran.append("skipped")))
+        kept = asyncio.create_task(worker.run(lambda cancelled: ran.append("kept")))
+        await asyncio.sleep(0.01)
+        skipped.cancel()
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(blocker, kept)
+        await worker.close()
+        return ran, skipped.cancelled()
+
+    assert asyncio.run(run()) == (["kept"], True)
+
+
+def test_cancelling_stops_a_running_request():
+    async def run():
+        worker = InferenceWorker("test-worker")
+        started, stopped = threading.Event(), threading.Event()
+
+        def generate(cancelled):
+            started.set()
+            # a generation checks between tokens
+            while not cancelled.wait(0.005):
+                pass
+            stopped.set()
+
+        task = asyncio.create_task(worker.run(generate))
+        while not started.is_set():
+            await asyncio.sleep(0.001)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # the worker is free for the next one
+        result = await asyncio.wait_for(worker.run(lambda cancelled: "next"), 1)
+        await worker.close()
+        return stopped.is_set(), result
+
+    assert asyncio.run(run()) == (True, "next")
+
+
+def test_close_finishes_the_queue_and_joins():
+    async def run():
+        worker = InferenceWorker("test-worker")
+        blocker, release = await _busy(worker)
+        queued = asyncio.create_task(worker.run(lambda cancelled: "queued", PRIORITY_BACKGROUND))
+        await asyncio.sleep(0.01)
+        release.set()
+        await worker.close()
+        try:
+            await worker.run(lambda cancelled: None)
+        except Exception as e:
+            closed = str(e)
+        return await queued, worker._thread.is_alive(), closed
+
+    assert asyncio.run(run()) == ("queued", False, "test-worker is closed")
@@ -0,0 +1,59 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+CHANNEL = SimpleNamespace(id=5, guild=SimpleNamespace(id=1))
+OTHER = SimpleNamespace(id=6, guild=SimpleNamespace(id=1))
+
+
+def _chatter(db, count: int = 60):
+    for i in range(count):
+        db._insert_history(1, f"the weather is nice today {i}", 100 + i, CHANNEL)
+    db._insert_history(2, "my cat is called Zorblax", 500, CHANNEL)
+    db._insert_history(2, "Zorblax lives in another channel", 600, OTHER)
+
+
+def test_finds_the_rare_word(db):
+    _chatter(db)
+    assert [m for m, _ in db.search_text("what was the name, zorblax?", CHANNEL.id, 5)] == [(2, "my cat is called Zorblax", 500)]
+    assert db.search_text("zorblax", CHANNEL.id, 5, exclude_ids=[500]) == []
+
+
+def test_ignores_words_most_messages_have(db):
+    _chatter(db)
+    assert db.search_text("the weather is nice", CHANNEL.id, 5) == []
+
+
+def test_edits_and_deletions_reach_the_index(db):
+    _chatter(db)
+    db.edit(500, "my cat is called Mittens")
+    assert db.search_text("zorblax", CHANNEL.id) == []
+    assert [m[2] for m, _ in db.search_text("mittens", CHANNEL.id)] == [500]
+    db.remove(500)
+    assert db.search_text("mittens", CHANNEL.id) == []
+
+
+def test_hybrid_blends_both_sides(db):
+    _chatter(db)
+    vectors = np.random.default_rng(0).standard_normal((2, 8)).astype(np.float32)
+    db.add_embedding((1, "the weather is nice today 3", 103), vectors[0], channel_id=CHANNEL.id)
+    db.add_embedding((2, "my cat is called Zorblax", 500), vectors[1], channel_id=CHANNEL.id)
+
+    fused = db.search_hybrid("zorblax", vectors[0] + 0.01, 0.0, CHANNEL.id, 5)
+    assert {m[2] for m, _ in fused} == {103, 500}
+    # without an embedding it's keyword recall
+    assert [m[2] for m, _ in db.search_hybrid("zorblax", None, 0.0, CHANNEL.id, 5)] == [500]
+
+
+def test_message_count_follows_the_history(db):
+    _chatter(db, 10)
+    db.flush()
+    count = lambda: db.cursor.execute("SELECT count FROM message_history_count").fetchone()[0]
+    assert count() == 12
+    db.remove(500)
+    db.clear_channel(OTHER.id)
+    assert count() == 10
+    # the newest row's ROWID is handed out again, the count doesn't care
+    db._insert_history(1, "again", 700, CHANNEL)
+    db.flush()
+    assert count() == 11
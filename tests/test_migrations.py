@@ -0,0 +1,73 @@
+import sqlite3
+
+import numpy as np
+
+from llmchat.persistence import DISCORD_EPOCH, EMBEDDING_DTYPE, MIGRATIONS, SCHEMA_VERSION, PersistentData
+
+
+def _old_database(path: str):
+    # the schema persistent-base.db ships with, from before any migration
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE message_history (author_id INTEGER, content TEXT, message_id INTEGER)")
+    connection.execute("CREATE TABLE user_identities (user_id INTEGER UNIQUE, identity TEXT, name TEXT)")
+    connection.execute("CREATE TABLE message_embeddings (author_id INTEGER, embedding_str TEXT, content TEXT, message_id INTEGER)")
+    message_id = (1000 << 22) | 1
+    connection.execute("INSERT INTO message_history VALUES (?, ?, ?)", (7, "hello there", message_id))
+    connection.execute("INSERT INTO message_embeddings VALUES (?, ?, ?, ?)", (7, "0.5,0.25,-1.0", "hello there", message_id))
+    connection.commit()
+    connection.close()
+    return message_id
+
+
+def test_new_database_is_at_the_current_schema(db):
+    assert db.schema_version == SCHEMA_VERSION
+
+
+def test_migrates_an_old_database(tmp_path):
+    path = str(tmp_path / "persistent.db")
+    message_id = _old_database(path)
+
+    db = PersistentData(None, path)
+    try:
+        assert db.schema_version == SCHEMA_VERSION
+        created_at, = db.cursor.execute("SELECT created_at FROM message_history").fetchone()
+        assert created_at == (1000 + DISCORD_EPOCH) / 1000.0
+
+        embedding = db.query_embedding(message_id)
+        assert embedding.dtype == EMBEDDING_DTYPE
+        np.testing.assert_array_equal(embedding, [0.5, 0.25, -1.0])
+        # the old message is found by keyword as well
+        assert [m for m, _ in db.search_text("hello", None)] == [(7, "hello there", message_id)]
+    finally:
+        db.close()
+
+    # reopening doesn't migrate again
+    db = PersistentData(None, path)
+    assert db.schema_version == SCHEMA_VERSION
+    db.close()
+
+
+def test_embedding_ids_survive_the_migration(tmp_path):
+    path = str(tmp_path / "persistent.db")
+    _old_database(path)
+    connection = sqlite3.connect(path)
+    # up to the schema before embeddings got their own id, with a gap in the ROWIDs like a deletion leaves
+    for migration in MIGRATIONS[:4]:
+        migration(connection.cursor())
+    connection.execute("PRAGMA user_version = 4")
+    vector = np.ones(3, dtype=EMBEDDING_DTYPE).tobytes()
+    connection.execute("INSERT INTO message_embeddings (ROWID, author_id, content, message_id, channel_id, model, dim, embedding) "
+                       "VALUES (7, 1, 'later', 5, 5, 'm', 3, ?)", (vector,))
+    connection.commit()
+    before = connection.execute("SELECT ROWID, message_id FROM message_embeddings ORDER BY ROWID").fetchall()
+    connection.close()
+
+    db = PersistentData(None, path)
+    try:
+        assert db.cursor.execute("SELECT id, message_id FROM message_embeddings ORDER BY id").fetchall() == before
+        # deleting the newest row doesn't free its id for the next one
+        db.remove_embedding(5)
+        db.add_embedding((1, "again", 5), np.ones(3), channel_id=5)
+        assert db.cursor.execute("SELECT MAX(id) FROM message_embeddings").fetchone()[0] == 8
+    finally:
+        db.close()
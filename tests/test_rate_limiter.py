@@ -0,0 +1,136 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import openai
+import pytest
+from yarl import URL
+
+from llmchat.rate_limiter import (ENDPOINT_COMPLETIONS, ENDPOINT_EMBEDDINGS, PRIORITY_BACKGROUND, PRIORITY_REPLY,
+                                  RateLimiter, parse_reset)
+
+
+def _limiter(requests_per_minute: int = 0, tokens_per_minute: int = 0, retries: int = 2) -> RateLimiter:
+    return RateLimiter(SimpleNamespace(openai_requests_per_minute=requests_per_minute,
+                                       openai_tokens_per_minute=tokens_per_minute,
+                                       openai_rate_limit_retries=retries, openai_reverse_proxy_url=""))
+
+
+def _response(path: str, status: int = 200, **headers):
+    return SimpleNamespace(url=URL(f"https://api.openai.com/v1/{path}"),
+                           response=SimpleNamespace(status=status, headers=headers))
+
+
+def test_parse_reset():
+    assert parse_reset("20ms") == pytest.approx(0.02)
+    assert parse_reset("1s") == 1
+    assert parse_reset("6m0s") == 360
+    assert parse_reset("1h2m3.5s") == pytest.approx(3723.5)
+    assert parse_reset("0.5") == 0.5
+    assert parse_reset("") is None
+    assert parse_reset("soon") is None
+
+
+def test_unlimited_never_waits():
+    async def run():
+        limiter = _limiter()
+        for _ in range(100):
+            await limiter.acquire(ENDPOINT_COMPLETIONS, 10 ** 6)
+        return limiter
+
+    limiter = asyncio.run(run())
+    assert limiter.admitted == 100 and limiter.throttled == 0
+
+
+def test_waits_once_the_tokens_run_out():
+    async def run():
+        # 1000 tokens a second
+        limiter = _limiter(tokens_per_minute=60000)
+        await limiter.acquire(ENDPOINT_COMPLETIONS, 60000)
+        started = time.monotonic()
+        await limiter.acquire(ENDPOINT_COMPLETIONS, 100)
+        return limiter, time.monotonic() - started
+
+    limiter, waited = asyncio.run(run())
+    assert waited >= 0.08
+    assert limiter.throttled == 1
+
+
+def test_replies_go_ahead_of_background_requests():
+    async def run():
+        limiter = _limiter()
+        # both wait for the pause to end, the reply goes first although it came in second
+        await limiter._on_request_end(None, None, _response("chat/completions", status=429, **{"retry-after": "0.05"}))
+        order = []
+
+        async def request(name: str, priority: int):
+            await limiter.acquire(ENDPOINT_COMPLETIONS, 50, priority)
+            order.append(name)
+
+        background = asyncio.create_task(request("background", PRIORITY_BACKGROUND))
+        await asyncio.sleep(0.01)
+        await asyncio.gather(background, request("reply", PRIORITY_REPLY))
+        return order
+
+    assert asyncio.run(run()) == ["reply", "background"]
+
+
+def test_headers_update_the_limits():
+    async def run():
+        limiter = _limiter()
+        await limiter._on_request_end(None, None, _response("chat/completions", **{
+            "x-ratelimit-limit-requests": "6000", "x-ratelimit-remaining-requests": "0"}))
+        started = time.monotonic()
+        await limiter.acquire(ENDPOINT_COMPLETIONS, 1)
+        # the embeddings have limits of their own
+        await limiter.acquire(ENDPOINT_EMBEDDINGS, 1)
+        return time.monotonic() - started
+
+    # 100 requests a second, the next one fits after 10ms
+    assert asyncio.run(run()) >= 0.008
+
+
+def test_429_pauses_the_endpoint():
+    async def run():
+        limiter = _limiter()
+        await limiter._on_request_end(None, None, _response("embeddings", status=429, **{"retry-after": "0.1"}))
+        started = time.monotonic()
+        await limiter.acquire(ENDPOINT_COMPLETIONS, 1)
+        completions = time.monotonic() - started
+        await limiter.acquire(ENDPOINT_EMBEDDINGS, 1)
+        return limiter, completions, time.monotonic() - started
+
+    limiter, completions, embeddings = asyncio.run(run())
+    assert limiter.rate_limited == 1
+    assert completions < 0.05 <= embeddings
+
+
+def test_other_hosts_are_ignored():
+    async def run():
+        limiter = _limiter()
+        await limiter._on_request_end(None, None, SimpleNamespace(
+            url=URL("https://example.com/v1/embeddings"), response=SimpleNamespace(status=429, headers={})))
+        return limiter
+
+    assert asyncio.run(run()).rate_limited == 0
+
+
+def test_run_retries_rate_limits():
+    async def run(error: openai.error.RateLimitError):
+        limiter = _limiter(retries=2)
+        calls = []
+
+        async def request():
+            calls.append(1)
+            if len(calls) == 1:
+                raise error
+            return "done"
+
+        try:
+            return await limiter.run(ENDPOINT_COMPLETIONS, 1, request), len(calls)
+        except openai.error.RateLimitError:
+            return None, len(calls)
+
+    assert asyncio.run(run(openai.error.RateLimitError("slow down"))) == ("done", 2)
+    # out of credit, trying again won't help
+    assert asyncio.run(run(openai.error.RateLimitError("no credit", code="insufficient_quota"))) == (None, 1)
@@ -0,0 +1,85 @@
+import asyncio
+from types import SimpleNamespace
+
+from llmchat.persistence import AsyncPersistentData
+from llmchat.recent_messages import RecentMessages
+
+CHANNEL = SimpleNamespace(id=5, guild=SimpleNamespace(id=1))
+AUTHOR = SimpleNamespace(id=1)
+
+
+def _message(message_id: int, content: str = None):
+    return SimpleNamespace(id=message_id, author=AUTHOR, content=content or f"m{message_id}", channel=CHANNEL)
+
+
+def _open(tmp_path, capacity: int = 8):
+    return AsyncPersistentData.open(None, str(tmp_path / "persistent.db"), recent_messages_capacity=capacity)
+
+
+async def _from_db(data: AsyncPersistentData, count: int):
+    return await data._run(data._db.get_recent_messages, count, CHANNEL.id)
+
+
+def test_ring_keeps_the_newest_rows():
+    recent = RecentMessages(capacity=3)
+    # nothing is known about a channel until it's hydrated
+    recent.push(CHANNEL.id, (1, "before", 99))
+    assert recent.get(CHANNEL.id, 2) is None
+
+    recent.hydrate(CHANNEL.id, [], recent.generation(CHANNEL.id))
+    for i in range(5):
+        recent.push(CHANNEL.id, (1, f"m{i}", 100 + i))
+    assert recent.get(CHANNEL.id, 3) == [(1, "m2", 102), (1, "m3", 103), (1, "m4", 104)]
+    assert recent.get(CHANNEL.id, 2) == [(1, "m3", 103), (1, "m4", 104)]
+    # more than it keeps has to come from the database
+    assert recent.get(CHANNEL.id, 4) is None
+
+
+def test_stale_hydration_is_thrown_away():
+    recent = RecentMessages(capacity=3)
+    generation = recent.generation(CHANNEL.id)
+    recent.push(CHANNEL.id, (1, "raced", 100))
+    recent.hydrate(CHANNEL.id, [], generation)
+    assert recent.get(CHANNEL.id, 1) is None
+
+
+def test_ring_and_database_stay_in_step(tmp_path):
+    async def run():
+        data = await _open(tmp_path)
+        for i in range(12):
+            await data.append(_message(100 + i))
+        # hydrated here, served from memory after this
+        first = await data.get_recent_messages(8, CHANNEL.id)
+        await data.append(_message(112))
+        await data.edit(110, "m110 edited")
+        steps = [(await data.get_recent_messages(8, CHANNEL.id), await _from_db(data, 8))]
+        await data.remove(111)
+        steps.append((await data.get_recent_messages(8, CHANNEL.id), await _from_db(data, 8)))
+        await data.close()
+        return first, steps
+
+    first, steps = asyncio.run(run())
+    assert [r[2] for r in first] == list(range(104, 112))
+    for cached, stored in steps:
+        assert cached == stored
+    assert (1, "m110 edited", 110) in steps[0][0]
+    assert 111 not in [r[2] for r in steps[1][0]]
+
+
+def test_push_during_hydration_is_not_lost(tmp_path):
+    async def run():
+        data = await _open(tmp_path)
+        for i in range(3):
+            await data.append(_message(100 + i))
+        # the window is read on the database thread while a new message comes in
+        reading = asyncio.create_task(data.get_recent_messages(8, CHANNEL.id))
+        await asyncio.sleep(0)
+        await data.append(_message(103))
+        during = await reading
+        after = await data.get_recent_messages(8, CHANNEL.id)
+        await data.close()
+        return during, after
+
+    during, after = asyncio.run(run())
+    assert [r[2] for r in during] == [100, 101, 102]
+    assert [r[2] for r in after] == [100, 101, 102, 103]
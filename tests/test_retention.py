@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from llmchat.ann_index import IVFIndex
+from llmchat.persistence import PersistentData
+
+CHANNEL = SimpleNamespace(id=5, guild=SimpleNamespace(id=1))
+# keep the newest 5 rows of every channel
+KEEP_FIVE = {None: (0, 5)}
+
+
+def _fill(db: PersistentData, count: int = 10) -> np.ndarray:
+    vectors = np.random.default_rng(0).standard_normal((count, 8)).astype(np.float32)
+    for i in range(count):
+        db._insert_history(1, f"m{i}", 100 + i, CHANNEL)
+        db.add_embedding((1, f"m{i}", 100 + i), vectors[i], channel_id=CHANNEL.id)
+    db.flush()
+    return vectors
+
+
+def _hot_embeddings(db: PersistentData) -> list[int]:
+    return [r[0] for r in db.cursor.execute("SELECT message_id FROM message_embeddings ORDER BY message_id")]
+
+
+def test_archives_the_embeddings_of_archived_messages_only(db):
+    vectors = _fill(db)
+    # an old message edited after the newer ones were embedded, its embedding now has the highest id
+    db.remove_embedding(101)
+    db.add_embedding((1, "m1 edited", 101), vectors[1], channel_id=CHANNEL.id)
+
+    assert db.apply_retention(KEEP_FIVE) == 5
+    assert _hot_embeddings(db) == [105, 106, 107, 108, 109]
+    # the archived ones are still recalled, from the archive
+    assert db.get_most_similar(vectors[1] + 0.01, 0.0, CHANNEL.id, 1)[0][0] == (1, "m1 edited", 101)
+    assert db.get_most_similar(vectors[7] + 0.01, 0.0, CHANNEL.id, 1)[0][0] == (1, "m7", 107)
+
+
+def test_archives_speech_embeddings_with_their_rows(db):
+    vector = np.arange(8, dtype=np.float32)
+    db._insert_history(1, "said out loud", -1, CHANNEL)
+    db.add_embedding((1, "said out loud", -1), vector, channel_id=CHANNEL.id)
+    _fill(db)
+
+    db.apply_retention(KEEP_FIVE)
+    assert -1 not in _hot_embeddings(db)
+    query = vector.copy()
+    query[0] += 1
+    assert db.get_most_similar(query, 0.0, CHANNEL.id, 1)[0][0] == (1, "said out loud", -1)
+
+
+def test_archive_uses_the_configured_index(tmp_path):
+    def open_db():
+        return PersistentData(None, str(tmp_path / "persistent.db"), embedding_index=IVFIndex(str(tmp_path / "ann")),
+                              archive_index=IVFIndex(str(tmp_path / "archive-ann")))
+
+    db = open_db()
+    vectors = _fill(db)
+    db.apply_retention(KEEP_FIVE)
+    assert db.get_most_similar(vectors[2] + 0.01, 0.0, CHANNEL.id, 1)[0][0] == (1, "m2", 102)
+    assert len(db.archive.index) == 5
+    db.close()
+
+    # reopened, the archive's index is read back from disk instead of being rebuilt
+    db = open_db()
+    assert db.get_most_similar(vectors[2] + 0.01, 0.0, CHANNEL.id, 1)[0][0] == (1, "m2", 102)
+    assert len(db.archive.index) == 5
+    db.close()
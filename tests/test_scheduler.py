@@ -0,0 +1,163 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from llmchat.scheduler import GenerationScheduler
+
+
+def _config(**overrides):
+    config = dict(llm_reply_debounce=0.02, llm_reply_max_delay=1.0, llm_max_concurrent_replies=2,
+                  llm_reply_queue_size=8, llm_reply_drop_policy="oldest")
+    config.update(overrides)
+    return SimpleNamespace(**config)
+
+
+def _message(message_id: int, channel_id: int = 5):
+    return SimpleNamespace(id=message_id, channel=SimpleNamespace(id=channel_id))
+
+
+class Responder:
+    """
+    Records every reply, each one waits until `release` is set. With `deliver` it starts showing itself right away.
+    """
+
+    def __init__(self, deliver: bool = False, block: bool = True):
+        self.deliver = deliver
+        self.release = asyncio.Event()
+        if not block:
+            self.release.set()
+        self.calls = []
+        self.finished = []
+        self.cancelled = []
+
+    async def __call__(self, messages, turn):
+        ids = [m.id for m in messages]
+        self.calls.append(ids)
+        if self.deliver:
+            turn.deliver()
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled.append(ids)
+            raise
+        self.finished.append(ids)
+
+    async def called(self, count: int):
+        while len(self.calls) < count:
+            await asyncio.sleep(0.005)
+
+
+def test_burst_is_answered_once():
+    async def run():
+        respond = Responder(block=False)
+        scheduler = GenerationScheduler(_config(), respond)
+        for i in range(3):
+            scheduler.submit(_message(i))
+            await asyncio.sleep(0.005)
+        await asyncio.sleep(0.1)
+        await scheduler.close()
+        return respond
+
+    assert asyncio.run(run()).calls == [[0, 1, 2]]
+
+
+def test_max_delay_caps_the_debounce():
+    async def run():
+        respond = Responder(block=False)
+        scheduler = GenerationScheduler(_config(llm_reply_debounce=0.05, llm_reply_max_delay=0.08), respond)
+        # never quiet for long enough, the reply goes out anyway
+        for i in range(8):
+            scheduler.submit(_message(i))
+            await asyncio.sleep(0.02)
+        await asyncio.sleep(0.1)
+        await scheduler.close()
+        return respond
+
+    calls = asyncio.run(run()).calls
+    assert len(calls) >= 2 and sum(calls, []) == list(range(8))
+
+
+def test_newer_message_supersedes_an_undelivered_reply():
+    async def run():
+        respond = Responder()
+        scheduler = GenerationScheduler(_config(), respond)
+        scheduler.submit(_message(1))
+        await respond.called(1)
+        scheduler.submit(_message(2))
+        await respond.called(2)
+        respond.release.set()
+        await asyncio.sleep(0.02)
+        await scheduler.close()
+        return respond
+
+    respond = asyncio.run(run())
+    assert respond.calls == [[1], [1, 2]]
+    assert respond.cancelled == [[1]]
+    assert respond.finished == [[1, 2]]
+
+
+def test_delivered_reply_is_not_cancelled():
+    async def run():
+        respond = Responder(deliver=True)
+        scheduler = GenerationScheduler(_config(), respond)
+        scheduler.submit(_message(1))
+        await respond.called(1)
+        scheduler.submit(_message(2))
+        await asyncio.sleep(0.05)
+        # the newer message waits for the reply being shown
+        calls = list(respond.calls)
+        respond.release.set()
+        await respond.called(2)
+        await asyncio.sleep(0.02)
+        await scheduler.close()
+        return respond, calls
+
+    respond, calls = asyncio.run(run())
+    assert calls == [[1]]
+    assert respond.cancelled == []
+    assert respond.finished == [[1], [2]]
+
+
+@pytest.mark.parametrize("policy, answered", [("oldest", [[1], [3]]), ("newest", [[1], [2]])])
+def test_full_queue_drops_by_policy(policy, answered):
+    async def run():
+        respond = Responder()
+        scheduler = GenerationScheduler(_config(llm_max_concurrent_replies=1, llm_reply_queue_size=1,
+                                                llm_reply_drop_policy=policy), respond)
+        scheduler.submit(_message(1, channel_id=1))
+        await respond.called(1)
+        # one slot busy, one turn queued, the third doesn't fit
+        scheduler.submit(_message(2, channel_id=2))
+        await asyncio.sleep(0.05)
+        scheduler.submit(_message(3, channel_id=3))
+        await asyncio.sleep(0.05)
+        respond.release.set()
+        await respond.called(2)
+        await asyncio.sleep(0.05)
+        await scheduler.close()
+        return respond
+
+    respond = asyncio.run(run())
+    assert respond.finished == answered
+    assert len(respond.calls) == 2
+
+
+def test_close_cancels_everything():
+    async def run():
+        respond = Responder()
+        scheduler = GenerationScheduler(_config(llm_max_concurrent_replies=1), respond)
+        scheduler.submit(_message(1, channel_id=1))
+        await respond.called(1)
+        scheduler.submit(_message(2, channel_id=2))
+        scheduler.submit(_message(3, channel_id=3))
+        await asyncio.sleep(0.05)
+        drivers = [c.driver for c in scheduler._channels.values()]
+        await scheduler.close()
+        return respond, drivers, scheduler
+
+    respond, drivers, scheduler = asyncio.run(run())
+    assert respond.cancelled == [[1]]
+    assert respond.finished == []
+    assert all(d.done() for d in drivers)
+    assert scheduler._channels == {}
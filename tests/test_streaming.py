@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+
+from llmchat.streaming import CHAR_LIMIT, MessageStreamer
+
+
+class FakeMessage:
+    def __init__(self, content: str):
+        self.content = content
+        self.edits = 0
+        self.deleted = False
+
+    async def edit(self, content: str):
+        self.content = content
+        self.edits += 1
+
+    async def delete(self):
+        self.deleted = True
+
+
+class FakeChannel:
+    def __init__(self):
+        self.sent: list[FakeMessage] = []
+
+    async def send(self, content: str, **kwargs):
+        message = FakeMessage(content)
+        self.sent.append(message)
+        return message
+
+
+def _stream(pieces: list[str], edit_interval: float = 0.0, channel: FakeChannel = None):
+    channel = channel or FakeChannel()
+
+    async def run():
+        streamer = MessageStreamer(channel, edit_interval=edit_interval)
+        for piece in pieces:
+            await streamer.feed(piece)
+        return await streamer.finish()
+
+    text, messages = asyncio.run(run())
+    return text, messages, channel
+
+
+def test_short_reply_is_one_message():
+    text, messages, channel = _stream(["  Hello", " there", "!\n"])
+    assert text == "Hello there!"
+    assert [m.content for m in channel.sent] == ["Hello there!"]
+    assert messages == channel.sent
+
+
+def test_rolls_over_at_a_newline():
+    first = "a" * 1500 + "\n" + "b" * 400
+    text, messages, _ = _stream([first, " " + "c" * 300])
+    assert [m.content for m in messages] == ["a" * 1500, "b" * 400 + " " + "c" * 300]
+    assert all(len(m.content) <= CHAR_LIMIT for m in messages)
+
+
+def test_rolls_over_at_a_space_without_newlines():
+    words = " ".join(["word"] * 500)
+    _, messages, _ = _stream([words])
+    assert len(messages) == 2
+    assert all(len(m.content) <= CHAR_LIMIT for m in messages)
+    # nothing lost or cut in the middle of a word
+    assert " ".join(m.content for m in messages) == words
+
+
+def test_hard_cut_without_separators():
+    _, messages, _ = _stream(["x" * 4500])
+    assert [len(m.content) for m in messages] == [CHAR_LIMIT, CHAR_LIMIT, 500]
+
+
+def test_separators_early_in_the_message_are_ignored():
+    # a break in the first half would leave a short message, cut hard instead
+    _, messages, _ = _stream(["ab\n" + "x" * 2500])
+    assert len(messages[0].content) == CHAR_LIMIT
+
+
+def test_edits_are_throttled():
+    async def run(edit_interval: float):
+        channel = FakeChannel()
+        streamer = MessageStreamer(channel, edit_interval=edit_interval)
+        for i in range(20):
+            await streamer.feed(f"{i} ")
+            await asyncio.sleep(0)
+        await streamer._settle()
+        edits = channel.sent[0].edits
+        await streamer.finish()
+        return edits, channel.sent[0]
+
+    edits, message = asyncio.run(run(60))
+    # nothing before the interval passed, one edit to show the whole text at the end
+    assert edits == 0 and message.edits == 1
+    assert message.content == " ".join(str(i) for i in range(20))
+
+    edits, _ = asyncio.run(run(0))
+    assert edits > 0
+
+
+def test_discard_deletes_the_partial_messages():
+    async def run():
+        channel = FakeChannel()
+        streamer = MessageStreamer(channel, edit_interval=60)
+        await streamer.feed("x" * 2500)
+        # superseded by a newer message before it was done
+        await streamer.discard()
+        return channel, streamer
+
+    channel, streamer = asyncio.run(run())
+    assert len(channel.sent) == 2 and all(m.deleted for m in channel.sent)
+    assert streamer.messages == []
+
+
+def test_empty_reply_fails():
+    with pytest.raises(Exception, match="empty"):
+        _stream(["  ", "\n"])
+
+
+def test_before_send_runs_once():
+    calls = []
+
+    async def run():
+        streamer = MessageStreamer(FakeChannel(), edit_interval=0, before_send=lambda: calls.append(1))
+        await streamer.feed("x" * 2500)
+        await streamer.finish()
+
+    asyncio.run(run())
+    assert calls == [1]
@@ -0,0 +1,90 @@
+import asyncio
+from types import SimpleNamespace
+
+from llmchat.persistence import AsyncPersistentData
+from llmchat.summarizer import ChannelSummarizer
+
+CHANNEL = SimpleNamespace(id=5, guild=SimpleNamespace(id=1))
+BOT = 999
+
+
+class Identities:
+    async def get_names(self, ids):
+        return {i: f"user{i}" for i in ids}
+
+
+class FakeLLM:
+    def __init__(self):
+        self.transcripts = []
+
+    async def summarize(self, summary: str, transcript: str, max_tokens: int) -> str:
+        self.transcripts.append(transcript)
+        return f"{summary or ''}[{len(self.transcripts)}]"
+
+
+def _client(db):
+    config = SimpleNamespace(llm_context_messages_count=3, memory_summary_batch=2, memory_summary_idle=60,
+                             memory_summary_max_tokens=100, bot_name="Bot")
+    return SimpleNamespace(config=config, db=db, llm=FakeLLM(), identities=Identities(), user=SimpleNamespace(id=BOT))
+
+
+async def _append(db, start: int, count: int):
+    for i in range(start, start + count):
+        await db.append(SimpleNamespace(id=100 + i, author=SimpleNamespace(id=1), content=f"m{i}", channel=CHANNEL))
+
+
+def _folded(transcripts: list[str]) -> list[str]:
+    return [line.split(": ", 1)[1] for t in transcripts for line in t.splitlines()]
+
+
+def test_folds_evicted_rows_exactly_once(tmp_path):
+    async def run():
+        db = await AsyncPersistentData.open(None, str(tmp_path / "persistent.db"))
+        client = _client(db)
+        summarizer = ChannelSummarizer(client)
+        # 7 rows fell out of the window of 3, in full batches of 2
+        await _append(db, 0, 10)
+        await summarizer._update(CHANNEL.id)
+        first = _folded(client.llm.transcripts)
+        # nothing new fell out, the odd row keeps waiting
+        await summarizer._update(CHANNEL.id)
+        again = _folded(client.llm.transcripts)
+        await _append(db, 10, 2)
+        await summarizer._update(CHANNEL.id)
+        folded = _folded(client.llm.transcripts)
+        stored = await db.get_summary(CHANNEL.id)
+        await db.close()
+        return first, again, folded, stored, await summarizer.get(CHANNEL.id)
+
+    first, again, folded, stored, cached = asyncio.run(run())
+    assert first == [f"m{i}" for i in range(6)]
+    assert again == first
+    assert folded == [f"m{i}" for i in range(8)]
+    assert stored == cached == "[1][2][3][4]"
+
+
+def test_busy_channel_stops_the_pass(tmp_path):
+    async def run():
+        db = await AsyncPersistentData.open(None, str(tmp_path / "persistent.db"))
+        client = _client(db)
+        summarizer = ChannelSummarizer(client)
+        await _append(db, 0, 10)
+
+        summarize = client.llm.summarize
+
+        async def interrupted(summary, transcript, max_tokens):
+            # a message comes in while the first batch is being folded
+            summarizer.touch(CHANNEL.id)
+            return await summarize(summary, transcript, max_tokens)
+
+        client.llm.summarize = interrupted
+        await summarizer._update(CHANNEL.id)
+        await summarizer.close()
+        client.llm.summarize = summarize
+        await summarizer._update(CHANNEL.id)
+        folded = _folded(client.llm.transcripts)
+        await db.close()
+        return folded
+
+    # the first batch was stored before stopping, the next pass picks up after it
+    assert asyncio.run(run()) == [f"m{i}" for i in range(6)]
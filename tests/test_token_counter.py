@@ -0,0 +1,49 @@
+import tiktoken
+
+from llmchat.token_counter import TokenCounter
+
+
+class CountingEncoding:
+    """
+    One token per byte, built locally so no encoding has to be downloaded. Records what gets encoded.
+    """
+
+    def __init__(self):
+        self.encoding = tiktoken.Encoding(name="bytes", pat_str=r"\S+|\s+",
+                                          mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={})
+        self.encoded = []
+
+    def encode(self, text: str) -> list[int]:
+        self.encoded.append(text)
+        return self.encoding.encode(text)
+
+    def encode_batch(self, texts: list[str]) -> list[list[int]]:
+        self.encoded.extend(texts)
+        return self.encoding.encode_batch(texts)
+
+
+def test_counts_are_memoized():
+    encoding = CountingEncoding()
+    counter = TokenCounter(encoding)
+    assert counter.count("hello") == 5
+    assert counter.count("hello") == 5
+    assert encoding.encoded == ["hello"]
+
+
+def test_count_many_only_encodes_misses_once():
+    encoding = CountingEncoding()
+    counter = TokenCounter(encoding)
+    counter.count("cached")
+    assert counter.count_many(["cached", "new one", "cached", "new one", "x"]) == [6, 7, 6, 7, 1]
+    assert encoding.encoded == ["cached", "new one", "x"]
+
+
+def test_least_recently_used_is_evicted():
+    encoding = CountingEncoding()
+    counter = TokenCounter(encoding, max_size=2)
+    counter.count_many(["a", "bb"])
+    counter.count("a")
+    counter.count("ccc")
+    encoding.encoded.clear()
+    counter.count_many(["a", "ccc", "bb"])
+    assert encoding.encoded == ["bb"]
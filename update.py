@@ -92,6 +92,11 @@ def main(args):
         with open("optional/llama-requirements.txt", 'r') as f:
             reqs = [l.strip() for l in f.readlines()]
             process_reqs(reqs, args)
+
+    if yes(input("Would you like to install local embedding dependencies? (Optional if not using Memory.embeddings = local) [Y/n] ")):
+        with open("optional/embedding-requirements.txt", 'r') as f:
+            reqs = [l.strip() for l in f.readlines()]
+            process_reqs(reqs, args)
     
     print("Done!")
 